@@ -1,164 +1,336 @@
-from typing import Tuple, Callable
+import time
+from math import log, inf
+from typing import Tuple, Callable, List, Optional
 
 import torch
 from torch import FloatTensor, LongTensor, Tensor
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from fastai.text import SequentialRNN
 from torch.nn.functional import log_softmax
 
-from langmodels.nn import get_last_layer_activations, take_hidden_state_snapshot, TORCH_LONG_MIN_VAL
-from langmodels.cuda_util import get_device
+from langmodels.cancellation import CancellationToken
+from langmodels.prefix import PrefixConstraint
+from langmodels.nn import take_hidden_state_snapshot, get_encoder_outputs, decode
 from langmodels.nn import restore_snapshot
 
-DEVICE = get_device()
+ROOT_NODE = -1
 
+# the number of steps for which the history of the beam is preallocated
+INITIAL_HISTORY_STEPS = 8
 
-def _get_topk_predictions(model: SequentialRNN, context: FloatTensor, top_k: int) -> Tuple[FloatTensor, LongTensor]:
-    last_token_activations = get_last_layer_activations(model, context)
-    predictions = log_softmax(last_token_activations[:, -1], dim=-1)  # TODO log_softmax not really needed
-    return predictions.topk(top_k, dim=-1)
 
+def _get_log_probs_of_next_subtoken(model: SequentialRNN, context: LongTensor) -> FloatTensor:
+    encoder_outputs = get_encoder_outputs(model, context)
+    # decoding only the last position: all the others are needed only to change the hidden state
+    last_layer = decode(model, encoder_outputs[:, -1])
+    return log_softmax(last_layer, dim=-1)
 
-def _topk_are_full_tokens(full_token_flags_sorted: torch.Tensor, top_k: int) -> bool:
-    return full_token_flags_sorted.size(0) >= top_k and full_token_flags_sorted[top_k-1].item() == (top_k - 1)
 
+class _BeamHistory(object):
+    """
+    Append-only storage of the tree of candidates built by the beam search.
+    For each node, only its last subtoken and a back-pointer to its parent node is stored.
 
-@dataclass
-class FlattenedCandidateList(object):
+    >>> history = _BeamHistory(initial_capacity=2, device='cpu')
+    >>> history.add(LongTensor([7, 8]), LongTensor([ROOT_NODE, ROOT_NODE]))
+    tensor([0, 1])
+    >>> history.add(LongTensor([9, 10, 11]), LongTensor([1, 1, 0]))
+    tensor([2, 3, 4])
+    >>> history.get_sequences([3, 4, 0])
+    [[8, 10], [7, 11], [7]]
     """
-    >>> candidate_list = FlattenedCandidateList.of(LongTensor([[1, 2, 3], [4, 5, 6]]), FloatTensor([0.3, 0.1]))
-    >>> candidate_list
-    FlattenedCandidateList(subtokens=tensor([[1, 2, 3],
-            [4, 5, 6]]), scores=tensor([0.3000, 0.1000]), hidden_indices=tensor([-9223372036854775808, -9223372036854775808]))
-    >>> candidate_list = candidate_list.add(candidate_list)
-    >>> candidate_list
-    FlattenedCandidateList(subtokens=tensor([[1, 2, 3],
-            [4, 5, 6],
-            [1, 2, 3],
-            [4, 5, 6]]), scores=tensor([0.3000, 0.1000, 0.3000, 0.1000]), hidden_indices=tensor([-9223372036854775808, -9223372036854775808, -9223372036854775808,
-            -9223372036854775808]))
-    >>> candidate_list.sort()
-    FlattenedCandidateList(subtokens=tensor([[4, 5, 6],
-            [4, 5, 6],
-            [1, 2, 3],
-            [1, 2, 3]]), scores=tensor([0.1000, 0.1000, 0.3000, 0.3000]), hidden_indices=tensor([-9223372036854775808, -9223372036854775808, -9223372036854775808,
-            -9223372036854775808]))
-    >>> candidate_list.size()
-    4
-    >>> candidate_list.sub_list(torch.LongTensor([3, 2, 1]))
-    FlattenedCandidateList(subtokens=tensor([[4, 5, 6],
-            [1, 2, 3],
-            [4, 5, 6]]), scores=tensor([0.1000, 0.3000, 0.1000]), hidden_indices=tensor([-9223372036854775808, -9223372036854775808, -9223372036854775808]))
-    >>> candidate_list.add_empty_subword_to_all()
-    >>> candidate_list
-    FlattenedCandidateList(subtokens=tensor([[                   1,                    2,                    3,
-             -9223372036854775808],
-            [                   4,                    5,                    6,
-             -9223372036854775808],
-            [                   1,                    2,                    3,
-             -9223372036854775808],
-            [                   4,                    5,                    6,
-             -9223372036854775808]]), scores=tensor([0.3000, 0.1000, 0.3000, 0.1000]), hidden_indices=tensor([-9223372036854775808, -9223372036854775808, -9223372036854775808,
-            -9223372036854775808]))
+    def __init__(self, initial_capacity: int, device):
+        self._subtokens = torch.empty(initial_capacity, dtype=torch.long, device=device)
+        self._parents = torch.empty(initial_capacity, dtype=torch.long, device=device)
+        self._size = 0
+
+    def _ensure_capacity(self, capacity: int) -> None:
+        current_capacity = self._subtokens.size(0)
+        if capacity <= current_capacity:
+            return
+        new_capacity = max(capacity, 2 * current_capacity)
+        for name in ['_subtokens', '_parents']:
+            old_buffer = getattr(self, name)
+            new_buffer = old_buffer.new_empty(new_capacity)
+            new_buffer[:self._size] = old_buffer[:self._size]
+            setattr(self, name, new_buffer)
+
+    def add(self, subtokens: LongTensor, parents: LongTensor) -> LongTensor:
+        n_nodes = subtokens.size(0)
+        self._ensure_capacity(self._size + n_nodes)
+        self._subtokens[self._size:self._size + n_nodes] = subtokens
+        self._parents[self._size:self._size + n_nodes] = parents
+        node_ids = torch.arange(self._size, self._size + n_nodes, dtype=torch.long, device=subtokens.device)
+        self._size += n_nodes
+        return node_ids
+
+    def get_sequences(self, node_ids: List[int]) -> List[List[int]]:
+        subtokens = self._subtokens[:self._size].tolist()
+        parents = self._parents[:self._size].tolist()
+        sequences = []
+        for node_id in node_ids:
+            sequence = []
+            while node_id != ROOT_NODE:
+                sequence.append(subtokens[node_id])
+                node_id = parents[node_id]
+            sequences.append(sequence[::-1])
+        return sequences
+
+
+CompleteTokenPredicate = Callable[[LongTensor], Tensor]
+
+
+class _Beam(object):
     """
-    subtokens: Tensor
-    scores: Tensor
-    hidden_indices: Tensor
+    Beam of candidates for a single context. Scores are negative log probabilities, i.e. the lower the better.
 
-    def __post_init__(self):
-        assert len(self.subtokens.size()) == 2 and isinstance(self.subtokens, LongTensor)
-        assert len(self.scores.size()) == 1 and isinstance(self.scores, FloatTensor)
-        assert len(self.hidden_indices.size()) == 1 and isinstance(self.hidden_indices, LongTensor)
+    Finished candidates (the ones whose last subtoken completes a full token) compete
+    for the slots in the beam with the pending ones.
 
-        assert self.subtokens.size(0) == self.scores.size(0) == self.hidden_indices.size(0)
+    If `prefix_constraint` is specified, subtokens inconsistent with the prefix are masked out before
+    the candidates are selected, so no slots of the beam are spent on them.
+    """
+    def __init__(self, beam_size: int, top_k: int, complete_token_predicate: CompleteTokenPredicate, device,
+                 max_prob: float = 0.0, prefix_constraint: Optional[PrefixConstraint] = None):
+        self.beam_size = beam_size
+        self.top_k = top_k
+        self._complete_token_predicate = complete_token_predicate
+        self._max_pending_score = -log(max_prob) if max_prob > 0.0 else inf
+        self._device = device
+        self._history = _BeamHistory(beam_size * INITIAL_HISTORY_STEPS, device)
+        self._prefix_constraint = prefix_constraint
 
-    def size(self):
-        return self.subtokens.size(0)
+        self.pending_nodes = torch.full((1,), fill_value=ROOT_NODE, dtype=torch.long, device=device)
+        self.pending_scores = torch.zeros(1, dtype=torch.float, device=device)
+        if prefix_constraint is not None:
+            self.pending_prefix_positions = prefix_constraint.initial_positions(1)
+        self.finished_nodes = torch.empty(0, dtype=torch.long, device=device)
+        self.finished_scores = torch.empty(0, dtype=torch.float, device=device)
+        self.n_steps = 0
+        self.stopped_by_prob_threshold = False
+        self.truncated = False
 
-    @staticmethod
-    def of(subtokens: Tensor, scores: Tensor) -> 'FlattenedCandidateList':
-        n_full_tokens = scores.size(0)
-        assert n_full_tokens == subtokens.size(0)
+    def n_pending(self) -> int:
+        return self.pending_nodes.size(0)
 
-        best_tokens = FlattenedCandidateList(subtokens=subtokens, scores=scores,
-                                             hidden_indices=torch.full((n_full_tokens,), fill_value=TORCH_LONG_MIN_VAL, dtype=torch.long, device=DEVICE))
-        return best_tokens
+    def is_done(self) -> bool:
+        """
+        Expanding a pending candidate can only make its score worse, so the score of the best pending candidate
+        is a bound for the scores of all the full tokens that can still be found.
 
-    @staticmethod
-    def empty():
-        return FlattenedCandidateList.of(
-            subtokens=torch.empty((0, 0), dtype=torch.long, device=DEVICE),
-            scores=torch.empty(0, dtype=torch.float, device=DEVICE)
-        )
+        The search is done when top-k finished candidates are better than this bound,
+        or when the probability corresponding to the bound is less than `max_prob`.
+        """
+        if self.n_pending() == 0:
+            return True
+        best_pending_score = self.pending_scores.min().item()
+        if self.finished_scores.size(0) >= self.top_k \
+                and self.finished_scores.kthvalue(self.top_k).values.item() <= best_pending_score:
+            return True
+        if best_pending_score > self._max_pending_score:
+            self.stopped_by_prob_threshold = True
+            return True
+        return False
 
-    def add(self, candidates: 'FlattenedCandidateList') -> 'FlattenedCandidateList':
-        return FlattenedCandidateList(subtokens=torch.cat([self.subtokens, candidates.subtokens], dim=0),
-                                      scores=torch.cat([self.scores, candidates.scores], dim=0),
-                                      hidden_indices=torch.cat([self.hidden_indices, candidates.hidden_indices], dim=0))
+    def step(self, log_probs: FloatTensor) -> Tuple[LongTensor, LongTensor]:
+        """
+        :param log_probs: log-probabilities of the next subtoken for each pending candidate: [n_pending, vocab_size]
+        :return: the rows of `log_probs` the new pending candidates are expanded from
+        (i.e. the rows of the hidden state to be kept), and the last subtokens of the new pending candidates
+        """
+        n_pending, vocab_size = log_probs.size()
+        if self._prefix_constraint is not None:
+            allowed = self._prefix_constraint.get_allowed_subtokens(self.pending_prefix_positions)
+            log_probs = log_probs.masked_fill(~allowed, -inf)
+        # one partial selection over the scores of all the continuations: selecting the best continuations
+        # of each pending candidate first would need buffers of size beam_size ** 2
+        candidate_scores = (self.pending_scores[:, None] - log_probs).view(-1)
+        candidate_scores, candidate_indices = candidate_scores.topk(min(self.beam_size, candidate_scores.size(0)),
+                                                                    largest=False, sorted=False)
 
-    def sort(self) -> 'FlattenedCandidateList':
-        idx_in_score_asc_order = self.scores.argsort()
-        return FlattenedCandidateList(
-            subtokens= self.subtokens[idx_in_score_asc_order],
-            scores= self.scores[idx_in_score_asc_order],
-            hidden_indices=self.hidden_indices[idx_in_score_asc_order]
-        )
+        n_finished = self.finished_scores.size(0)
+        merged_scores = torch.cat([self.finished_scores, candidate_scores])
+        best_scores, best_indices = merged_scores.topk(min(self.beam_size, merged_scores.size(0)),
+                                                       largest=False, sorted=False)
+        if self._prefix_constraint is not None:
+            # masked out subtokens get into the beam if fewer than beam_size continuations are allowed
+            selectable = torch.isfinite(best_scores)
+            best_scores, best_indices = best_scores[selectable], best_indices[selectable]
 
-    def sub_list(self, indices: Tensor) -> 'FlattenedCandidateList':
-        return FlattenedCandidateList(
-            subtokens=self.subtokens[indices],
-            scores=self.scores[indices],
-            hidden_indices=self.hidden_indices[indices],
-        )
+        from_finished = best_indices < n_finished
+        from_pending = ~from_finished
+        kept_finished_nodes = self.finished_nodes[best_indices[from_finished]]
+        kept_finished_scores = best_scores[from_finished]
 
-    @staticmethod
-    def single_empty():
-        return FlattenedCandidateList.of(subtokens=torch.empty(1, 0, device=DEVICE).long(), scores=torch.zeros(1, device=DEVICE).float())
+        candidate_indices = candidate_indices[best_indices[from_pending] - n_finished]
+        candidate_scores = best_scores[from_pending]
+        rows = candidate_indices // vocab_size
+        subtokens = candidate_indices % vocab_size
+        nodes = self._history.add(subtokens, self.pending_nodes[rows])
 
-    def add_empty_subword_to_all(self) -> None:
-        self.subtokens = torch.cat([self.subtokens,
-                   torch.full((self.size(), 1), fill_value=TORCH_LONG_MIN_VAL, dtype=torch.long, device=DEVICE)], dim=-1)
+        complete = self._complete_token_predicate(subtokens)
+        incomplete = ~complete
+        self.finished_nodes = torch.cat([kept_finished_nodes, nodes[complete]])
+        self.finished_scores = torch.cat([kept_finished_scores, candidate_scores[complete]])
+        self.pending_nodes = nodes[incomplete]
+        self.pending_scores = candidate_scores[incomplete]
+        if self._prefix_constraint is not None:
+            self.pending_prefix_positions = self._prefix_constraint.advance(
+                self.pending_prefix_positions[rows[incomplete]], subtokens[incomplete])
+        self.n_steps += 1
 
+        return rows[incomplete], subtokens[incomplete]
 
-def _expand_with_new_candidates(model: SequentialRNN, context: LongTensor, n_predictions: int,
-                                current_candidates: FlattenedCandidateList) -> FlattenedCandidateList:
-    assert len(context.size()) == 2
+    def get_best(self) -> Tuple[List[List[int]], List[float]]:
+        order = self.finished_scores.argsort()[:self.top_k]
+        return self._history.get_sequences(self.finished_nodes[order].tolist()), self.finished_scores[order].tolist()
 
-    loss, num_tokens = _get_topk_predictions(model, context, n_predictions)
-    batch_size = context.size(0)
 
-    return FlattenedCandidateList(scores= (-loss + current_candidates.scores[:, None]).view(-1),
-                                  hidden_indices= torch.arange(0, batch_size, device=DEVICE)[:, None].expand(batch_size, n_predictions).contiguous().view(-1),
-                                  subtokens= torch.cat([current_candidates.subtokens.repeat(n_predictions, 1), num_tokens.view(-1)[:, None]], dim=-1))
+@dataclass(frozen=True)
+class BeamSearchResult(object):
+    subtokens: List[List[int]]
+    scores: List[float]
+    n_steps: int
+    stopped_by_prob_threshold: bool = False
+    # the time budget ran out before the search was done, so the result contains only the candidates found so far
+    truncated: bool = False
 
 
-CompleteTokenPredicate = Callable[[Tensor], Tuple[Tensor, Tensor]]
+BeamSearchHook = Callable[[BeamSearchResult], None]
+
+
+@dataclass
+class BeamSearchStatistics(object):
+    """
+    To see how many expansion steps are skipped thanks to `max_prob`,
+    compare `n_steps` with the one collected for the same contexts with `max_prob` = 0.0
+
+    `hooks` are called with each recorded result, e.g. to export truncation counts to a monitoring system.
+    """
+    n_searches: int = 0
+    n_steps: int = 0
+    n_stopped_by_prob_threshold: int = 0
+    n_truncated: int = 0
+    hooks: List[BeamSearchHook] = field(default_factory=list, repr=False, compare=False)
+
+    def record(self, result: BeamSearchResult) -> None:
+        self.n_searches += 1
+        self.n_steps += result.n_steps
+        if result.stopped_by_prob_threshold:
+            self.n_stopped_by_prob_threshold += 1
+        if result.truncated:
+            self.n_truncated += 1
+        for hook in self.hooks:
+            hook(result)
+
+
+def get_deadline(time_budget_ms: Optional[float]) -> float:
+    """
+    :return: the value of `time.monotonic()` at which the time budget runs out
+    """
+    return time.monotonic() + time_budget_ms / 1000 if time_budget_ms is not None else inf
 
 
 def beam_search(model: SequentialRNN, context: torch.LongTensor, complete_token_predicate: CompleteTokenPredicate,
-                top_k: int, beam_size: int) -> Tuple[Tensor, Tensor]:
+                top_k: int, beam_size: int, max_prob: float = 0.0,
+                time_budget_ms: Optional[float] = None,
+                cancellation_token: Optional[CancellationToken] = None,
+                prefix_constraint: Optional[PrefixConstraint] = None,
+                deadline: Optional[float] = None) -> BeamSearchResult:
+    """
+    Finds top-k full tokens that are the most likely to follow the context.
+
+    At each step, the best `beam_size` continuations of all the pending candidates are selected at once
+    and merged with the finished candidates to choose the new beam. Candidates are stored as back-pointers
+    to their parents. Apart from the scores of the continuations, which have the size of the log-probabilities
+    output by the model, the memory of a step is linear in the beam size, and so is the time of the merge.
+
+    The search stops as soon as none of the pending candidates can reach the probability of `max_prob`.
+    In this case fewer than `top_k` full tokens can be returned, and the ones with the probability less than
+    `max_prob` are not guaranteed to be the most probable ones.
+
+    If `time_budget_ms` is specified and runs out, the best full tokens found so far are returned
+    and the result is marked as truncated. At least one step of the search is always made.
+    The budget is counted from the start of the search unless `deadline` (see `get_deadline`) is passed instead,
+    e.g. to count the time the request waited for the model.
+
+    If `cancellation_token` is cancelled, `OperationCancelled` is raised after the current step.
+
+    If `prefix_constraint` is specified, only full tokens satisfying it are searched for.
+
+    Does not change the hidden state of the model.
+    """
     if len(context.size()) != 1:
-        raise ValueError("The rank of context tensor should be one. Beam search is only possible with batch size = 1.")
+        raise ValueError("The rank of context tensor should be one. "
+                         "Use `batched_beam_search` to run beam search for multiple contexts.")
+
+    return batched_beam_search(model, context.unsqueeze(dim=0), complete_token_predicate,
+                               top_k, beam_size, max_prob, time_budget_ms, cancellation_token,
+                               prefix_constraint, deadline)[0]
+
+
+def batched_beam_search(model: SequentialRNN, contexts: torch.LongTensor,
+                        complete_token_predicate: CompleteTokenPredicate,
+                        top_k: int, beam_size: int, max_prob: float = 0.0,
+                        time_budget_ms: Optional[float] = None,
+                        cancellation_token: Optional[CancellationToken] = None,
+                        prefix_constraint: Optional[PrefixConstraint] = None,
+                        deadline: Optional[float] = None) -> List[BeamSearchResult]:
+    """
+    Runs beam search for multiple independent contexts at once (see `beam_search`).
+    The hidden state of the model has to have one row per context, i.e. its batch size has to be equal
+    to the number of contexts.
+
+    The pending candidates of all the contexts are flattened into one batch, so each step costs one forward pass
+    regardless of the number of contexts. Contexts whose search is done drop out of the batch.
+    The time budget and the prefix constraint are shared by all the contexts.
+
+    Does not change the hidden state of the model.
+    """
+    if len(contexts.size()) != 2:
+        raise ValueError("The rank of contexts tensor should be two: [n_contexts, context_length]")
     if top_k > beam_size:
         raise ValueError(f"N suggestions ({top_k}) cannot be more than the beam size ({beam_size})")
 
-    context = context.unsqueeze(dim=0)
+    if deadline is None:
+        deadline = get_deadline(time_budget_ms)
     hidden_state_snapshot = take_hidden_state_snapshot(model)
-    pending_candidates_sorted = FlattenedCandidateList.single_empty()
-    best_tokens = FlattenedCandidateList.empty()
-    ready_candidate_indices = torch.empty(0)
-    with torch.no_grad():
-        while not _topk_are_full_tokens(ready_candidate_indices, top_k):
-            new_candidates = _expand_with_new_candidates(model, context, beam_size, pending_candidates_sorted)
-            best_tokens.add_empty_subword_to_all()
-            all_candidates = best_tokens.add(new_candidates)
-            best_candidates_sorted = all_candidates.sort().sub_list(torch.arange(beam_size))
-            ready_candidate_indices, pending_candidate_idxs = complete_token_predicate(best_candidates_sorted.subtokens)
-            best_tokens = best_candidates_sorted.sub_list(ready_candidate_indices)
-            pending_candidates_sorted = best_candidates_sorted.sub_list(pending_candidate_idxs)
-            model[0].select_hidden(pending_candidates_sorted.hidden_indices)
-            context = pending_candidates_sorted.subtokens[:, -1:]
-
-    restore_snapshot(model, hidden_state_snapshot)
-
-    return best_tokens.subtokens[:top_k], best_tokens.scores[:top_k]
+    beams = [_Beam(beam_size, top_k, complete_token_predicate, contexts.device, max_prob, prefix_constraint)
+             for _ in range(contexts.size(0))]
+    # for each beam which is not done yet: the index of its first row in the batch and the number of its rows
+    beam_rows = [(beam, i, 1) for i, beam in enumerate(beams)]
+    try:
+        with torch.no_grad():
+            log_probs = _get_log_probs_of_next_subtoken(model, contexts)
+            while True:
+                hidden_rows, last_subtokens, next_beam_rows = [], [], []
+                n_next_rows = 0
+                for beam, first_row, n_rows in beam_rows:
+                    beam_hidden_rows, beam_last_subtokens = beam.step(log_probs[first_row:first_row + n_rows])
+                    if beam.is_done():
+                        continue
+                    hidden_rows.append(beam_hidden_rows + first_row)
+                    last_subtokens.append(beam_last_subtokens)
+                    next_beam_rows.append((beam, n_next_rows, beam_hidden_rows.size(0)))
+                    n_next_rows += beam_hidden_rows.size(0)
+                if not next_beam_rows:
+                    break
+                if cancellation_token is not None:
+                    cancellation_token.check()
+                if time.monotonic() >= deadline:
+                    for beam, _, _ in next_beam_rows:
+                        beam.truncated = True
+                    break
+                model[0].select_hidden(torch.cat(hidden_rows))
+                log_probs = _get_log_probs_of_next_subtoken(model, torch.cat(last_subtokens)[:, None])
+                beam_rows = next_beam_rows
+    finally:
+        restore_snapshot(model, hidden_state_snapshot)
+
+    results = []
+    for beam in beams:
+        subtokens, scores = beam.get_best()
+        results.append(BeamSearchResult(subtokens=subtokens, scores=scores, n_steps=beam.n_steps,
+                                        stopped_by_prob_threshold=beam.stopped_by_prob_threshold,
+                                        truncated=beam.truncated))
+    return results
@@ -0,0 +1,35 @@
+from threading import Event
+
+
+class OperationCancelled(Exception):
+    pass
+
+
+class CancellationToken(object):
+    """
+    Allows to stop a long-running operation (beam search, calculation of entropies) from another thread.
+    The operation checks the token between its steps, so it is stopped not immediately but after the current step.
+
+    >>> token = CancellationToken()
+    >>> token.check()
+    >>> token.cancel()
+    >>> token.cancelled
+    True
+    >>> token.check()
+    Traceback (most recent call last):
+    ...
+    langmodels.cancellation.OperationCancelled
+    """
+    def __init__(self):
+        self._event = Event()
+
+    def cancel(self) -> None:
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def check(self) -> None:
+        if self.cancelled:
+            raise OperationCancelled()
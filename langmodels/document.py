@@ -0,0 +1,95 @@
+import sys
+from typing import List, Tuple, Optional, Type
+
+from codeprep.preprocess.metadata import PreprocessingMetadata
+
+from langmodels.model import TrainedModel, ContextUsage, _format_entropies
+from langmodels.util import split_list_into_nested_chunks
+
+
+def _get_common_prefix_length(lst1: List, lst2: List) -> int:
+    """
+    >>> _get_common_prefix_length(['a', 'b', 'c'], ['a', 'b', 'd', 'e'])
+    2
+    >>> _get_common_prefix_length(['a', 'b'], ['a', 'b', 'c'])
+    2
+    >>> _get_common_prefix_length([], ['a'])
+    0
+    """
+    for i, (elm1, elm2) in enumerate(zip(lst1, lst2)):
+        if elm1 != elm2:
+            return i
+    return min(len(lst1), len(lst2))
+
+
+class ScoredDocument(object):
+    """
+    Keeps entropies of the subtokens of a text which is being edited, e.g. of a file open in an editor.
+    The text is evaluated from the initial state of the model without resetting the context.
+
+    Hidden states are checkpointed every `checkpoint_every` subtokens. When the text is updated,
+    the new subtokens are compared with the old ones, and only the subtokens starting from the last checkpoint
+    before the first changed one are re-scored.
+    """
+    DEFAULT_CHECKPOINT_EVERY = 200
+
+    def __init__(self, trained_model: TrainedModel, extension: str, append_eof: bool = False,
+                 checkpoint_every: int = DEFAULT_CHECKPOINT_EVERY):
+        trained_model._assert_inference_possible_for_file_type(extension)
+        self._trained_model = trained_model
+        self._extension = extension
+        self._append_eof = append_eof
+        self._checkpoint_every = checkpoint_every
+        self._session = trained_model.new_session()
+
+        self._prep_tokens: List[str] = []
+        self._metadata: Optional[PreprocessingMetadata] = None
+        self._subtoken_entropies: List[float] = []
+        # i-th checkpoint is the hidden state after `i * checkpoint_every` subtokens are fed
+        self._checkpoints = [None]
+        self.n_rescored_subtokens = 0
+
+    @property
+    def prep_tokens(self) -> List[str]:
+        return self._prep_tokens
+
+    @property
+    def subtoken_entropies(self) -> List[float]:
+        return self._subtoken_entropies
+
+    def update(self, text: str) -> None:
+        prep_tokens, metadata = self._trained_model.prep_text(text, self._extension, return_metadata=True,
+                                                              append_eof=self._append_eof)
+        if prep_tokens == self._prep_tokens:
+            self._metadata = metadata
+            self.n_rescored_subtokens = 0
+            return
+
+        first_changed = _get_common_prefix_length(self._prep_tokens, prep_tokens)
+        checkpoint_index = min(first_changed // self._checkpoint_every, len(self._checkpoints) - 1)
+        position = checkpoint_index * self._checkpoint_every
+        del self._checkpoints[checkpoint_index + 1:]
+
+        self._session._restore_state(self._checkpoints[checkpoint_index], prep_tokens[:position])
+        subtoken_entropies = self._subtoken_entropies[:position]
+        self.n_rescored_subtokens = len(prep_tokens) - position
+        while position < len(prep_tokens):
+            next_position = min(position + self._checkpoint_every, len(prep_tokens))
+            prep_text_chunks = split_list_into_nested_chunks(prep_tokens[position:next_position], sys.maxsize,
+                                                             sys.maxsize, self._trained_model.MAX_SUBTOKENS_PER_CHUNK)
+            subtoken_entropies.extend(self._session._get_entropies_for_prep_text(prep_text_chunks, sys.maxsize))
+            if next_position - position == self._checkpoint_every:
+                self._checkpoints.append(self._session._hidden_state)
+            position = next_position
+
+        self._prep_tokens, self._metadata, self._subtoken_entropies = prep_tokens, metadata, subtoken_entropies
+
+    def get_entropies(self, full_tokens: bool) -> Tuple[List[float], List[str], List[Type], List[int]]:
+        """
+        Returns the entropies in the same format as `TrainedModel.get_entropies_for_text`.
+        """
+        if self._metadata is None:
+            raise ValueError("The document has not been scored yet. Call `update` first.")
+        prep_text_chunks = [[self._prep_tokens]] if self._prep_tokens else [[]]
+        return _format_entropies(self._subtoken_entropies, self._prep_tokens, self._metadata,
+                                 ContextUsage.from_chunks(prep_text_chunks, 0), full_tokens)
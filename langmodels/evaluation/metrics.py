@@ -21,7 +21,9 @@ def bin_entropy(model: TrainedModel, line: str, extension: str, append_eof: bool
     """
     token_type_subsets = token_type_subsets or {TokenTypeSubset.full_set()}
 
-    all_entropies, tokens, all_token_types, context_lengths = model.get_entropies_for_text(line, extension, full_tokens=full_tokens, append_eof=append_eof, max_context_allowed=max_context_allowed)
+    # the decoder is evaluated only for the tokens that are going to be reported
+    token_type_filter = lambda token_type: any(s.contains(token_type) for s in token_type_subsets)
+    all_entropies, tokens, all_token_types, context_lengths = model.get_entropies_for_text(line, extension, full_tokens=full_tokens, append_eof=append_eof, max_context_allowed=max_context_allowed, token_type_filter=token_type_filter)
     evaluation_results: Dict[TokenTypeSubset, EvaluationResult] = {}
     for token_type_subset in token_type_subsets:
         res = []
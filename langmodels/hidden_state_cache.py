@@ -0,0 +1,105 @@
+import heapq
+from collections import OrderedDict, Counter
+from typing import List, Tuple, Optional
+
+import torch
+from dataclasses import dataclass
+
+HiddenStateSnapshot = List[Tuple[torch.Tensor, torch.Tensor]]
+
+
+def _get_size_in_bytes(snapshot: HiddenStateSnapshot) -> int:
+    size = 0
+    for layer in snapshot:
+        for tensor in (layer if isinstance(layer, (tuple, list)) else [layer]):
+            size += tensor.element_size() * tensor.nelement()
+    return size
+
+
+@dataclass
+class HiddenStateCacheStatistics(object):
+    n_lookups: int = 0
+    n_hits: int = 0
+    # the number of tokens that did not have to be fed thanks to the cache
+    n_reused_tokens: int = 0
+    n_evicted_bytes: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.n_hits / self.n_lookups if self.n_lookups > 0 else 0.0
+
+
+class HiddenStateCache(object):
+    """
+    LRU cache of hidden state snapshots (in the format of `take_hidden_state_snapshot`)
+    keyed by the length and the rolling hash (see `get_prefix_hashes`) of the numericalized token sequence
+    that was fed to the model to reach the state.
+
+    The total size of cached snapshots does not exceed `max_bytes`.
+
+    Snapshots are expected to be taken after each `checkpoint_every` tokens of a text and at its end,
+    so only these lengths are looked up: the multiples of `checkpoint_every`
+    and the lengths of the cached snapshots which are not.
+    """
+    def __init__(self, max_bytes: int, checkpoint_every: int = 1):
+        self.max_bytes = max_bytes
+        self.checkpoint_every = checkpoint_every
+        self._snapshots: OrderedDict = OrderedDict()
+        # the number of cached snapshots of each length which is not a multiple of `checkpoint_every`
+        self._n_snapshots_between_checkpoints: Counter = Counter()
+        self._n_bytes = 0
+        self.statistics = HiddenStateCacheStatistics()
+
+    @property
+    def n_bytes(self) -> int:
+        return self._n_bytes
+
+    def __len__(self) -> int:
+        return len(self._snapshots)
+
+    def find_longest_prefix(self, prefix_hashes: List[int]) -> Tuple[int, Optional[HiddenStateSnapshot]]:
+        """
+        :param prefix_hashes: hashes of all the prefixes of the token sequence, as returned by `get_prefix_hashes`
+        :return: the length of the longest prefix whose snapshot is cached and the snapshot,
+        or (0, None) if there is no cached prefix
+        """
+        self.statistics.n_lookups += 1
+        max_length = len(prefix_hashes) - 1
+        lengths_between_checkpoints = sorted((length for length in self._n_snapshots_between_checkpoints
+                                              if length <= max_length), reverse=True)
+        lengths_at_checkpoints = range(max_length // self.checkpoint_every * self.checkpoint_every, 0,
+                                       -self.checkpoint_every)
+        for length in heapq.merge(lengths_between_checkpoints, lengths_at_checkpoints, reverse=True):
+            key = (length, prefix_hashes[length])
+            if key in self._snapshots:
+                self._snapshots.move_to_end(key)
+                self.statistics.n_hits += 1
+                self.statistics.n_reused_tokens += length
+                return length, self._snapshots[key][0]
+        return 0, None
+
+    def put(self, length: int, prefix_hash: int, snapshot: HiddenStateSnapshot) -> None:
+        key = (length, prefix_hash)
+        if key in self._snapshots:
+            self._snapshots.move_to_end(key)
+            return
+        n_bytes = _get_size_in_bytes(snapshot)
+        if n_bytes > self.max_bytes:
+            return
+        self._snapshots[key] = (snapshot, n_bytes)
+        if length % self.checkpoint_every != 0:
+            self._n_snapshots_between_checkpoints[length] += 1
+        self._n_bytes += n_bytes
+        while self._n_bytes > self.max_bytes:
+            (evicted_length, _), (_, evicted_bytes) = self._snapshots.popitem(last=False)
+            if evicted_length % self.checkpoint_every != 0:
+                self._n_snapshots_between_checkpoints[evicted_length] -= 1
+                if self._n_snapshots_between_checkpoints[evicted_length] == 0:
+                    del self._n_snapshots_between_checkpoints[evicted_length]
+            self._n_bytes -= evicted_bytes
+            self.statistics.n_evicted_bytes += evicted_bytes
+
+    def clear(self) -> None:
+        self._snapshots.clear()
+        self._n_snapshots_between_checkpoints.clear()
+        self._n_bytes = 0
@@ -0,0 +1,136 @@
+from typing import List
+
+import torch
+from dataclasses import dataclass
+from fastai.text import SequentialRNN
+
+from langmodels.beamsearch import INITIAL_HISTORY_STEPS
+from langmodels.nn import take_hidden_state_snapshot, restore_snapshot, decode
+
+# the number of positions the encoder is run for to measure its activations
+N_POSITIONS_TO_MEASURE = 16
+# logits, their exponents in log-sum-exp (or log-softmax in the beam search) and the scores derived from them
+N_COPIES_OF_LOGITS = 3
+# `select_hidden` creates the new hidden state while the old one is still referenced
+N_COPIES_OF_HIDDEN_STATE = 2
+# per row of the beam: values and indices of the two partial selections of a step, the merged scores,
+# and the subtokens and parents preallocated in the history of the beam
+N_BEAM_SELECTION_BYTES_PER_ROW = 2 * (4 + 8) + 2 * 4 + INITIAL_HISTORY_STEPS * 2 * 8
+
+MAX_SUBTOKENS_PER_CHUNK_LIMIT = 2000
+MAX_DECODER_BLOCK_SIZE = 500
+MAX_BATCH_SIZE = 256
+MAX_BEAM_SIZE = 2000
+# the share of the available memory the decoder block can take in the entropy path
+DECODER_MEMORY_SHARE = 0.25
+
+
+def _get_n_distinct_bytes(tensors: List[torch.Tensor]) -> int:
+    """
+    In test mode dropouts return their input, so the same tensor can be returned for several outputs.
+    """
+    storages = {}
+    for tensor in tensors:
+        storages[tensor.data_ptr()] = tensor.element_size() * tensor.nelement()
+    return sum(storages.values())
+
+
+@dataclass(frozen=True)
+class MemoryFootprint(object):
+    n_parameter_bytes: int
+    # per row of the batch
+    n_hidden_state_bytes: int
+    # activations kept by the encoder per position per row of the batch
+    n_encoder_bytes_per_position: int
+    # memory taken by the decoder and the calculation of the loss per position per row of the batch
+    n_decoder_bytes_per_position: int
+
+
+@torch.no_grad()
+def measure_memory_footprint(model: SequentialRNN) -> MemoryFootprint:
+    """
+    Runs the encoder and the decoder on a dummy input and measures the sizes of their outputs.
+    The hidden state of the model is restored afterwards.
+    """
+    n_parameter_bytes = sum(p.element_size() * p.nelement() for p in model.parameters())
+    snapshot = take_hidden_state_snapshot(model)
+    try:
+        hidden_tensors = [t for layer in snapshot for t in (layer if isinstance(layer, (tuple, list)) else [layer])]
+        batch_size = hidden_tensors[0].size(1)
+        n_hidden_state_bytes = sum(t.element_size() * t.nelement() for t in hidden_tensors) // batch_size
+
+        device = next(model.parameters()).device
+        input = torch.zeros((1, N_POSITIONS_TO_MEASURE), dtype=torch.long, device=device)
+        raw_outputs, outputs = model[0](input)
+        n_encoder_bytes_per_position = _get_n_distinct_bytes(raw_outputs + outputs) // N_POSITIONS_TO_MEASURE
+        logits = decode(model, outputs[-1][:, :1])
+        n_decoder_bytes_per_position = N_COPIES_OF_LOGITS * logits.element_size() * logits.nelement()
+    finally:
+        restore_snapshot(model, snapshot)
+    return MemoryFootprint(n_parameter_bytes=n_parameter_bytes, n_hidden_state_bytes=n_hidden_state_bytes,
+                           n_encoder_bytes_per_position=n_encoder_bytes_per_position,
+                           n_decoder_bytes_per_position=n_decoder_bytes_per_position)
+
+
+@dataclass(frozen=True)
+class InferencePlan(object):
+    max_subtokens_per_chunk: int
+    decoder_block_size: int
+    # the number of texts evaluated at once by `TrainedModel.get_entropies_for_texts`
+    batch_size: int
+    beam_size: int
+
+
+def plan_inference(footprint: MemoryFootprint, memory_budget_bytes: int, n_used_bytes: int,
+                   beam_search_batch_size: int = 1, min_beam_size: int = 1) -> InferencePlan:
+    """
+    Chooses the sizes so that the memory needed at the peak of each kind of computation
+    fits into what is left of the budget after `n_used_bytes` (the memory already used, e.g. by the parameters).
+
+    The entropy path keeps the encoder activations of the whole sub-chunk and the decoder output of one block;
+    the beam search keeps the hidden state and the log-probabilities of the next subtoken for each of its rows,
+    and `beam_search_batch_size` beams are searched for at once. The beam is never narrower than `min_beam_size`,
+    since no more suggestions than the beam size can be requested.
+
+    >>> footprint = MemoryFootprint(n_parameter_bytes=10 ** 6, n_hidden_state_bytes=1000,
+    ...                             n_encoder_bytes_per_position=1000, n_decoder_bytes_per_position=10 ** 5)
+    >>> plan_inference(footprint, memory_budget_bytes=5 * 10 ** 6, n_used_bytes=10 ** 6)
+    InferencePlan(max_subtokens_per_chunk=2000, decoder_block_size=10, batch_size=1, beam_size=39)
+    >>> plan_inference(footprint, memory_budget_bytes=10 ** 6, n_used_bytes=10 ** 6)
+    Traceback (most recent call last):
+    ...
+    ValueError: Memory budget (1000000 bytes) is too small: 1000000 bytes are already used, at least 103000 more bytes are needed.
+    >>> plan_inference(footprint, memory_budget_bytes=5 * 10 ** 6, n_used_bytes=10 ** 6, min_beam_size=100)
+    Traceback (most recent call last):
+    ...
+    ValueError: Memory budget (5000000 bytes) is too small for beams of 100 rows: 10216000 bytes are needed, 4000000 are available.
+    """
+    available = memory_budget_bytes - n_used_bytes
+    n_min_needed_bytes = footprint.n_decoder_bytes_per_position + footprint.n_encoder_bytes_per_position + \
+        N_COPIES_OF_HIDDEN_STATE * footprint.n_hidden_state_bytes
+    if available < n_min_needed_bytes:
+        raise ValueError(f'Memory budget ({memory_budget_bytes} bytes) is too small: '
+                         f'{n_used_bytes} bytes are already used, at least {n_min_needed_bytes} more bytes are needed.')
+
+    decoder_block_size = int(available * DECODER_MEMORY_SHARE) // footprint.n_decoder_bytes_per_position
+    decoder_block_size = max(1, min(decoder_block_size, MAX_DECODER_BLOCK_SIZE))
+    available_for_encoder = available - decoder_block_size * footprint.n_decoder_bytes_per_position
+
+    max_subtokens_per_chunk = (available_for_encoder - footprint.n_hidden_state_bytes) // \
+        footprint.n_encoder_bytes_per_position
+    max_subtokens_per_chunk = max(1, min(max_subtokens_per_chunk, MAX_SUBTOKENS_PER_CHUNK_LIMIT))
+    n_bytes_per_text = max_subtokens_per_chunk * footprint.n_encoder_bytes_per_position + \
+        footprint.n_hidden_state_bytes
+    batch_size = max(1, min(available_for_encoder // n_bytes_per_text, MAX_BATCH_SIZE))
+
+    n_bytes_per_beam_row = N_COPIES_OF_HIDDEN_STATE * footprint.n_hidden_state_bytes + \
+        footprint.n_decoder_bytes_per_position + N_BEAM_SELECTION_BYTES_PER_ROW
+    beam_size = available // (beam_search_batch_size * n_bytes_per_beam_row)
+    if beam_size < min_beam_size:
+        raise ValueError(f'Memory budget ({memory_budget_bytes} bytes) is too small for beams of {min_beam_size} rows: '
+                         f'{beam_search_batch_size * min_beam_size * n_bytes_per_beam_row} bytes are needed, '
+                         f'{available} are available.')
+    beam_size = max(1, min(beam_size, MAX_BEAM_SIZE))
+
+    return InferencePlan(max_subtokens_per_chunk=max_subtokens_per_chunk, decoder_block_size=decoder_block_size,
+                         batch_size=batch_size, beam_size=beam_size)
@@ -1,29 +1,44 @@
+import copy
 import logging
 import os
+import sys
+from bisect import bisect_right
 from collections import OrderedDict
+from contextlib import contextmanager
 from threading import Lock
-from typing import List, Dict, Any, Tuple, Optional, Union, Type, Generator
+from typing import List, Dict, Any, Tuple, Optional, Union, Type, Generator, Callable, Sequence
 
+import numpy as np
 import torch
 from dataclasses import dataclass, asdict
-from fastai.text import SequentialRNN, get_language_model, F, Vocab, awd_lstm_lm_config, convert_weights
+from fastai.text import SequentialRNN, get_language_model, Vocab, awd_lstm_lm_config, convert_weights
 from fastai.text.models.transformer import init_transformer
 from math import exp
 from torch import cuda
 
+from codeprep import __version__ as codeprep_version
 from codeprep.api.corpus import PreprocessedCorpus
 from codeprep.pipeline.dataset import normalize_extension_string
 from codeprep.preprocess.metadata import check_metadata_validity, PreprocessingMetadata
 from codeprep.preprocess.placeholders import placeholders
-from codeprep.subtokens import is_terminal_subtoken, FullTokenIterator, SubtokenIterator
-
-from langmodels.beamsearch import beam_search
+from codeprep.subtokens import is_terminal_subtoken
+
+from langmodels.beamsearch import beam_search, BeamSearchStatistics, batched_beam_search, BeamSearchResult, \
+    get_deadline, _get_log_probs_of_next_subtoken
+from langmodels.cancellation import CancellationToken, OperationCancelled
+from langmodels.hidden_state_cache import HiddenStateCache
+from langmodels.memory_planner import InferencePlan, measure_memory_footprint, plan_inference
+from langmodels.prefix import SubtokenTrie
+from langmodels.prep_cache import PrepCache, get_prep_cache_key
+from langmodels.profiling import get_cpu_memory_used_mb
+from langmodels.sampling import sample
 from langmodels.cuda_util import get_device, get_map_location
 from langmodels.lmconfig.datamodel import Corpus, LstmArch, TransformerArch, LMTrainingConfig, GruArch, \
     LMTrainingMetrics, BEST_MODEL_FILE_NAME
 from langmodels.lmconfig.serialization import load_config_or_metrics_from_file, read_value_from_file
-from langmodels.nn import to_test_mode, get_last_layer_activations, TORCH_LONG_MIN_VAL
-from langmodels.util import to_binary_entropy, split_list_into_nested_chunks
+from langmodels.nn import to_test_mode, restore_snapshot, reset_with_batch_size, feed_to_encoder, \
+    get_encoder_outputs, concat_snapshots, get_target_losses
+from langmodels.util import to_binary_entropy, split_list_into_nested_chunks, get_prefix_hashes
 from langmodels.nn import take_hidden_state_snapshot
 
 logger = logging.getLogger(__name__)
@@ -132,7 +147,31 @@ def to_full_token_string(subtokens: List[str], include_debug_tokens=False) -> st
     return full_token
 
 
+def _get_subtoken_text(subtoken: str) -> str:
+    """
+    >>> _get_subtoken_text('re</t>')
+    're'
+    >>> _get_subtoken_text('vol')
+    'vol'
+    """
+    end_of_token = placeholders['compound_word_end']
+    return subtoken[:-len(end_of_token)] if subtoken.endswith(end_of_token) else subtoken
+
+
 PredictionList = List[Tuple[str, float]]
+# index of the subtoken in `TrainedModel.vocab`, the subtoken and its log-probability (natural logarithm)
+SubtokenPredictionList = List[Tuple[int, str, float]]
+
+# prep tokens or their indices in `TrainedModel.vocab`, e.g. a list of ints or a numpy array
+PrepTokens = Union[List[str], Sequence[int]]
+# text can be passed to the inference methods either raw or already preprocessed (possibly in bulk elsewhere),
+# in which case it is not preprocessed again
+TextInput = Union[str, Tuple[PrepTokens, PreprocessingMetadata]]
+
+
+def _is_prep_text_with_metadata(text: Any) -> bool:
+    return isinstance(text, tuple) and len(text) == 2 and isinstance(text[1], PreprocessingMetadata)
+
 
 @dataclass
 class ModelDescription(object):
@@ -158,7 +197,33 @@ class ModelDescription(object):
         return list(map(lambda a: self.__getattribute__(a), ModelDescription.get_attribute_list()))
 
 
-lock = Lock()
+@dataclass
+class GenerationResult(object):
+    # full tokens of each sample; the samples which are not stopped by the length limit end with `<EOL>`
+    continuations: List[List[str]]
+    # log-probabilities of the samples according to the model, i.e. regardless of temperature and `top_p`
+    log_probs: List[float]
+    n_subtokens: int
+    elapsed_seconds: float
+
+    @property
+    def n_tokens(self) -> int:
+        return sum(map(len, self.continuations))
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.n_tokens / self.elapsed_seconds if self.elapsed_seconds > 0 else 0.0
+
+    @property
+    def subtokens_per_second(self) -> float:
+        return self.n_subtokens / self.elapsed_seconds if self.elapsed_seconds > 0 else 0.0
+
+
+@dataclass
+class PredictionResult(object):
+    suggestions: PredictionList
+    # the time budget ran out before the search was done, so the suggestions are the best ones found so far
+    truncated: bool
 
 
 @dataclass(frozen=True)
@@ -247,6 +312,17 @@ class ContextUsage(object):
     def __iter__(self):
         return ContextUsage.ContextUsageIterator(self)
 
+    def to_array(self) -> np.ndarray:
+        """
+        Context lengths for all the predictions, the same as the ones returned by the iterator.
+
+        >>> ContextUsage.from_chunks([[[1]], [[2, 3, 4]], [[5]]], 2).to_array()
+        array([2, 0, 1, 2, 0])
+        >>> ContextUsage.from_chunks([[]], 199).to_array()
+        array([], dtype=int64)
+        """
+        return (np.arange(self.n_predictions(), dtype=np.int64) + self.length_start) % self.reset_at
+
     @staticmethod
     def from_chunks(prep_text_chunks: List[List[List[any]]], context_length_for_next_prediction: int) -> 'ContextUsage':
 
@@ -267,10 +343,591 @@ class ContextUsage(object):
                             length_end=tokens_in_last_chunk if context_reset_times != 0 else tokens_in_first_chunk + context_length_for_next_prediction)
 
 
+NO_CONTEXT_LENGTH = -1
+
+
+def _sum_by_full_tokens(subtoken_values: np.ndarray, word_boundaries: np.ndarray) -> np.ndarray:
+    """
+    >>> _sum_by_full_tokens(np.array([1., 2., 3., np.nan, 5.]), np.array([0, 2, 3, 5]))
+    array([ 3.,  3., nan])
+    >>> _sum_by_full_tokens(np.array([]), np.array([0]))
+    array([], dtype=float64)
+    """
+    if len(word_boundaries) < 2:
+        return np.empty(0, dtype=subtoken_values.dtype)
+    return np.add.reduceat(subtoken_values[:word_boundaries[-1]], word_boundaries[:-1])
+
+
+def _aggregate_entropies(subtoken_entropies: List[Optional[float]], tokens: List[str], word_boundaries: List[int],
+                         token_types: List[Type], context_lengths: np.ndarray, full_tokens: bool) \
+        -> Tuple[np.ndarray, List[str], List[Type], np.ndarray]:
+    """
+    Array version of `_format_entropies`: entropies which are not calculated are `nan`,
+    and context lengths of full tokens consisting of multiple subtokens are `NO_CONTEXT_LENGTH`.
+
+    >>> subtoken_entropies, subtokens = [1., 2., None], ['my', 'class</t>', '//</t>']
+    >>> entropies, tokens, _, context_lengths = _aggregate_entropies(subtoken_entropies, subtokens, [0, 2, 3], [str, str], np.array([0, 1, 2]), True)
+    >>> entropies, tokens, context_lengths
+    (array([ 3., nan]), ['myclass</t>', '//</t>'], array([-1,  2]))
+    """
+    entropies = np.array(subtoken_entropies, dtype=np.float64)
+    word_boundary_array = np.array(word_boundaries, dtype=np.int64)
+    subtokens_in_full_tokens = np.diff(word_boundary_array)
+    if full_tokens:
+        entropies = _sum_by_full_tokens(entropies, word_boundary_array)
+        tokens = ["".join(tokens[start:end]) for start, end in zip(word_boundaries, word_boundaries[1:])]
+        token_types = list(token_types)
+        context_lengths = np.where(subtokens_in_full_tokens == 1,
+                                   context_lengths[word_boundary_array[:-1]], NO_CONTEXT_LENGTH)
+    else:
+        tokens = list(tokens)
+        token_types = [token_types[i] for i in np.repeat(np.arange(len(subtokens_in_full_tokens)),
+                                                         subtokens_in_full_tokens)]
+    return entropies, tokens, token_types, context_lengths
+
+
+EntropyLists = Tuple[List[Optional[float]], List[str], List[Type], List[Optional[int]]]
+# entropies which are not calculated are `nan`, unknown context lengths are `NO_CONTEXT_LENGTH`
+EntropyArrays = Tuple[np.ndarray, List[str], List[Type], np.ndarray]
+
+
+def _format_entropies(subtoken_entropies: List[Optional[float]], tokens: List[str], metadata: PreprocessingMetadata,
+                      context_usage: ContextUsage, full_tokens: bool, as_arrays: bool = False) \
+        -> Union[EntropyLists, EntropyArrays]:
+    entropy_arrays = _aggregate_entropies(subtoken_entropies, tokens, metadata.word_boundaries, metadata.token_types,
+                                          context_usage.to_array(), full_tokens)
+    return entropy_arrays if as_arrays else _to_lists(*entropy_arrays)
+
+
+def _to_lists(entropies: np.ndarray, tokens: List[str], token_types: List[Type], context_lengths: np.ndarray) \
+        -> EntropyLists:
+    entropy_list = entropies.tolist()
+    if np.isnan(entropies).any():
+        entropy_list = [None if np.isnan(entropy) else entropy for entropy in entropy_list]
+    context_length_list = [None if context_length == NO_CONTEXT_LENGTH else context_length
+                           for context_length in context_lengths.tolist()]
+    return entropy_list, tokens, token_types, context_length_list
+
+
+TokenTypeFilter = Callable[[Type], bool]
+
+
+def _get_evaluation_mask(metadata: PreprocessingMetadata, token_type_filter: Optional[TokenTypeFilter]) \
+        -> Optional[List[bool]]:
+    """
+    >>> from codeprep.tokens.containers import SplitContainer, OneLineComment
+    >>> metadata = PreprocessingMetadata(word_boundaries=[0, 1, 3], token_types=[SplitContainer, OneLineComment])
+    >>> _get_evaluation_mask(metadata, lambda t: t == OneLineComment)
+    [False, True, True]
+    >>> _get_evaluation_mask(metadata, None) is None
+    True
+    """
+    if token_type_filter is None:
+        return None
+
+    mask = []
+    for ind, token_type in enumerate(metadata.token_types):
+        n_subtokens = metadata.word_boundaries[ind + 1] - metadata.word_boundaries[ind]
+        mask.extend([token_type_filter(token_type)] * n_subtokens)
+    return mask
+
+
+@torch.no_grad()
+def _get_top_k_next_subtokens(model: SequentialRNN, last_predicted_tokens: torch.Tensor, k: int) \
+        -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Makes one step of the model from its current hidden state without changing it:
+    the encoder creates new hidden state tensors, so the reference to the old ones is enough to put them back.
+
+    :param last_predicted_tokens: [bs, 1]
+    :return: log-probabilities and indices of the top `k` next subtokens, both [bs, k], the most probable first
+    """
+    hidden_state = model[0].hidden
+    try:
+        log_probs = _get_log_probs_of_next_subtoken(model, last_predicted_tokens)
+    finally:
+        restore_snapshot(model, hidden_state)
+    return log_probs.topk(min(k, log_probs.size(-1)), dim=-1)
+
+
+@torch.no_grad()
+def _calculate_entropies(model: SequentialRNN, input: torch.Tensor, targets: torch.Tensor,
+                         mask: Optional[List[bool]], decoder_block_size: int) -> List[Optional[float]]:
+    """
+    Advances the hidden state of the model at all the positions of the input,
+    however, the decoder and the loss are evaluated only at the positions where `mask` is True,
+    and only for `decoder_block_size` positions at a time (see `get_target_losses`).
+    """
+    if mask is not None and not any(mask):
+        feed_to_encoder(model, input)
+        return [None] * len(mask)
+
+    encoder_outputs = get_encoder_outputs(model, input)
+    if mask is None or all(mask):
+        loss = get_target_losses(model, encoder_outputs, targets, decoder_block_size)
+        return to_binary_entropy(loss).view(-1).tolist()
+
+    positions = torch.tensor([i for i, evaluate in enumerate(mask) if evaluate], device=input.device)
+    loss = get_target_losses(model, encoder_outputs[:, positions], targets[:, positions], decoder_block_size)
+    entropies = iter(to_binary_entropy(loss).view(-1).tolist())
+    return [next(entropies) if evaluate else None for evaluate in mask]
+
+
+class InferenceSession(object):
+    """
+    Holds the state of inference (hidden state, context and the last predicted token) of one caller,
+    e.g. of one editor session. The weights are shared with the `TrainedModel` the session is created from,
+    so that one loaded model can serve many sessions.
+
+    Operations of the sessions of the same model are serialized with the model's lock:
+    the hidden state of a session is swapped into the model only for the duration of an operation.
+
+    Completion and scoring requests are cancellable: a new such request of the session cancels the one
+    which is still running or waiting for the lock, so that the stale request does not delay the new one.
+    The cancelled request raises `OperationCancelled` and leaves the state of the session unchanged.
+    """
+    def __init__(self, trained_model: 'TrainedModel'):
+        trained_model._check_model_loaded()
+        self._trained_model = trained_model
+        self._hidden_state = trained_model._initial_snapshot
+        self._context: List[str] = []
+        # last_predicted_token_tensor is a rank-2 tensor!
+        self._last_predicted_token_tensor = trained_model._get_starting_token_tensor()
+        self._running_request: Optional[CancellationToken] = None
+        self._running_request_lock = Lock()
+
+    @property
+    def trained_model(self) -> 'TrainedModel':
+        return self._trained_model
+
+    @property
+    def context(self) -> List[str]:
+        return self._context
+
+    def cancel(self) -> None:
+        """
+        Cancels the completion or scoring request of the session which is currently running, if any.
+        """
+        with self._running_request_lock:
+            if self._running_request is not None:
+                self._running_request.cancel()
+
+    def _start_request(self, cancellation_token: Optional[CancellationToken]) -> CancellationToken:
+        cancellation_token = cancellation_token or CancellationToken()
+        with self._running_request_lock:
+            if self._running_request is not None and self._running_request is not cancellation_token:
+                self._running_request.cancel()
+            self._running_request = cancellation_token
+        return cancellation_token
+
+    def _check_request(self, cancellation_token: CancellationToken) -> None:
+        with self._running_request_lock:
+            if self._running_request is not cancellation_token:
+                cancellation_token.cancel()
+        cancellation_token.check()
+
+    @contextmanager
+    def _activated(self, cancellation_token: Optional[CancellationToken] = None, start_request: bool = True) \
+            -> Generator[SequentialRNN, None, None]:
+        """
+        If `cancellation_token` is passed, the operation pre-empts the running request of the session.
+        If `start_request` is False, the request must have been started already (see `_start_request`):
+        the operation does not pre-empt anything and is cancelled if a newer request has been started since.
+
+        If the operation is cancelled, the hidden state, the context and the last predicted token of the session
+        are left as they were before the operation.
+        """
+        if cancellation_token is not None and start_request:
+            self._start_request(cancellation_token)
+        with self._trained_model._lock:
+            if cancellation_token is not None:
+                self._check_request(cancellation_token)
+            model = self._trained_model.model
+            restore_snapshot(model, self._hidden_state)
+            context_before, last_predicted_token_before = list(self._context), self._last_predicted_token_tensor
+            try:
+                yield model
+            except OperationCancelled:
+                self._context, self._last_predicted_token_tensor = context_before, last_predicted_token_before
+                restore_snapshot(model, self._hidden_state)
+                raise
+            except BaseException:
+                self._hidden_state = model[0].hidden
+                raise
+            else:
+                self._hidden_state = model[0].hidden
+
+    def _save_context(self, prep_tokens: List[str]) -> None:
+        self._context.extend(prep_tokens)
+        if len(self._context) > TrainedModel.SAVE_CONTEXT_LIMIT:
+            self._context = self._context[-TrainedModel.SAVE_CONTEXT_LIMIT:]
+
+    def reset_context(self) -> None:
+        self._context = []
+
+    def get_predictions_and_feed(self, text: TextInput, extension: str, n_suggestions: int, append_eof: bool)\
+            -> Generator[Tuple[PredictionList, str, Type], None, None]:
+        """
+        For each full token of the text, yields the suggestions made right before the token is fed,
+        the token itself and its type.
+        If the text is already preprocessed, `extension` and `append_eof` are ignored.
+
+        Suggestions for `BEAM_SEARCH_BATCH_SIZE` consecutive full tokens are searched for at once:
+        the tokens are fed one by one to collect the hidden state preceding each of them,
+        and then a single batched beam search is run from all these hidden states.
+        """
+        prep_text, numericalized, metadata = self._trained_model._to_numericalized_prep_text(text, extension,
+                                                                                             append_eof)
+        word_boundaries = metadata.word_boundaries
+        full_tokens = [prep_text[start:end] for start, end in zip(word_boundaries, word_boundaries[1:])]
+
+        batch_size = self._trained_model.BEAM_SEARCH_BATCH_SIZE
+        for batch_start in range(0, len(full_tokens), batch_size):
+            batch = full_tokens[batch_start:batch_start + batch_size]
+            with self._activated() as model:
+                snapshots, last_predicted_tokens = [], []
+                for ind, subtokens in enumerate(batch, start=batch_start):
+                    snapshots.append(take_hidden_state_snapshot(model))
+                    last_predicted_tokens.append(self._last_predicted_token_tensor)
+                    self._feed_numericalized_to_model(
+                        model, numericalized[word_boundaries[ind]:word_boundaries[ind + 1]], subtokens)
+                hidden_state_after_batch = take_hidden_state_snapshot(model)
+
+                restore_snapshot(model, concat_snapshots(snapshots))
+                # all the suggestions are needed for the evaluation, so no threshold is applied
+                results = batched_beam_search(model, torch.cat(last_predicted_tokens),
+                                              self._trained_model._complete_token_predicate, n_suggestions,
+                                              self._trained_model.BEAM_SIZE, max_prob=0.0)
+                restore_snapshot(model, hidden_state_after_batch)
+                for result in results:
+                    self._trained_model.beam_search_statistics.record(result)
+
+            for ind, (subtokens, result) in enumerate(zip(batch, results), start=batch_start):
+                yield self._to_prediction_list(result), ''.join(subtokens), metadata.token_types[ind]
+
+    def _feed_prep_tokens_to_model(self, model: SequentialRNN, prep_tokens: List[str]) -> None:
+        """
+        The model has to be activated for this session.
+        """
+        if not prep_tokens:
+            return
+        self._feed_numericalized_to_model(model, self._trained_model.vocab.numericalize(prep_tokens), prep_tokens)
+
+    def _feed_numericalized_to_model(self, model: SequentialRNN, numericalized: Sequence[int],
+                                     prep_tokens: Optional[List[str]] = None) -> None:
+        """
+        The model has to be activated for this session.
+        If `prep_tokens` corresponding to `numericalized` are not passed, only the tokens which fit
+        into the saved context are converted back to prep tokens.
+        """
+        if len(numericalized) == 0:
+            return
+        context_tensor = torch.as_tensor(np.asarray(numericalized, dtype=np.int64),
+                                         device=self._trained_model.device)[None, :]
+        if prep_tokens is None:
+            prep_tokens = self._trained_model._textify(numericalized[-TrainedModel.SAVE_CONTEXT_LIMIT:])
+        self._save_context(prep_tokens)
+        feed_to_encoder(model, torch.cat([self._last_predicted_token_tensor, context_tensor[:, :-1]], dim=1))
+        self._last_predicted_token_tensor = context_tensor[:, -1:]
+
+    def _feed_prep_tokens(self, prep_tokens: List[str]) -> None:
+        with self._activated() as model:
+            self._feed_prep_tokens_to_model(model, prep_tokens)
+
+    def feed_text(self, text: Union[TextInput, PrepTokens], extension: str) -> None:
+        """
+        The text can be raw, preprocessed (with or without metadata) or numericalized.
+        If the text is already preprocessed, `extension` is ignored.
+        """
+        if isinstance(text, str):
+            self._trained_model._assert_inference_possible_for_file_type(extension)
+        if isinstance(text, str) or _is_prep_text_with_metadata(text):
+            prep_text, _ = self._trained_model._to_prep_text(text, extension)
+            self._feed_prep_tokens(prep_text)
+        elif len(text) > 0 and not isinstance(text[0], str):
+            # numericalized text is fed to the model as it is
+            with self._activated() as model:
+                self._feed_numericalized_to_model(model, text)
+        else:
+            self._feed_prep_tokens(list(text))
+
+    def _restore_state(self, hidden_state: Optional[List[Tuple[torch.Tensor, torch.Tensor]]],
+                       fed_prep_tokens: List[str]) -> None:
+        """
+        Sets the session to the state reached by feeding `fed_prep_tokens` after `reset`.
+        `hidden_state` has to be the hidden state of the model in this state (or `None` if no tokens were fed).
+        """
+        if not fed_prep_tokens:
+            self._hidden_state = self._trained_model._initial_snapshot
+            self._last_predicted_token_tensor = self._trained_model._get_starting_token_tensor()
+        else:
+            self._hidden_state = hidden_state
+            self._last_predicted_token_tensor = torch.tensor(
+                [self._trained_model.vocab.numericalize(fed_prep_tokens[-1:])], device=self._trained_model.device)
+        self._context = fed_prep_tokens[-TrainedModel.SAVE_CONTEXT_LIMIT:]
+
+    def reset_to_text(self, text: str, extension: str) -> None:
+        """
+        Sets the session to the state reached by feeding `text` after `reset`,
+        e.g. when a client sends the whole file prefix with each completion request.
+
+        Hidden states for the prefixes of the texts are cached in the model (see `TrainedModel.hidden_state_cache`),
+        so only the part of the text following the longest cached prefix is fed to the model.
+        """
+        self._trained_model._assert_inference_possible_for_file_type(extension)
+
+        prep_text = self._trained_model.prep_text(text, extension=extension)
+        prefix_hashes = get_prefix_hashes(self._trained_model.vocab.numericalize(prep_text))
+        cache = self._trained_model.hidden_state_cache
+        checkpoint_every = cache.checkpoint_every
+        with self._activated() as model:
+            position, snapshot = cache.find_longest_prefix(prefix_hashes)
+            self._restore_state(snapshot, prep_text[:position])
+            restore_snapshot(model, self._hidden_state)
+            while position < len(prep_text):
+                next_position = min((position // checkpoint_every + 1) * checkpoint_every, len(prep_text))
+                self._feed_prep_tokens_to_model(model, prep_text[position:next_position])
+                cache.put(next_position, prefix_hashes[next_position], take_hidden_state_snapshot(model))
+                position = next_position
+
+    def get_entropies_for_text(self, text: TextInput, extension: str, full_tokens: bool,
+                               append_eof: bool, max_context_allowed: int,
+                               token_type_filter: Optional[TokenTypeFilter] = None,
+                               cancellation_token: Optional[CancellationToken] = None,
+                               as_arrays: bool = False) -> Union[EntropyLists, EntropyArrays]:
+        """
+        If the text is already preprocessed, `extension` and `append_eof` are ignored.
+
+        If `token_type_filter` is specified, entropies are calculated only for the tokens
+        whose types satisfy the filter. For the rest of the tokens `None` is returned.
+
+        If `as_arrays` is True, entropies and context lengths are returned as numpy arrays,
+        which saves converting them to Python objects token by token. In this case, entropies which are not
+        calculated are `nan`, and unknown context lengths are `NO_CONTEXT_LENGTH`.
+
+        The request can be cancelled with `cancellation_token` or by a newer request of the session (see `cancel`),
+        in which case `OperationCancelled` is raised.
+        """
+        tokens, numericalized, metadata = self._trained_model._to_numericalized_prep_text(text, extension,
+                                                                                          append_eof)
+        context_length_for_next_prediction = len(self.context)
+        prep_text_chunks = split_list_into_nested_chunks(tokens, max_context_allowed - len(self.context),
+                                                         max_context_allowed, self._trained_model.MAX_SUBTOKENS_PER_CHUNK)
+        context_usage = ContextUsage.from_chunks(prep_text_chunks, context_length_for_next_prediction)
+        evaluation_mask = _get_evaluation_mask(metadata, token_type_filter)
+        subtoken_entropies = self._get_entropies_for_prep_text(prep_text_chunks, max_context_allowed, evaluation_mask,
+                                                               cancellation_token or CancellationToken(),
+                                                               numericalized)
+        return _format_entropies(subtoken_entropies, tokens, metadata, context_usage, full_tokens, as_arrays)
+
+    def iter_entropies_for_text(self, text: TextInput, extension: str, full_tokens: bool,
+                                append_eof: bool, max_context_allowed: int,
+                                token_type_filter: Optional[TokenTypeFilter] = None,
+                                cancellation_token: Optional[CancellationToken] = None) \
+            -> Generator[Tuple[Optional[float], str, Type, Optional[int]], None, None]:
+        """
+        Streaming version of `get_entropies_for_text`: yields (entropy, token, token type, context length)
+        for each token as soon as the sub-chunk completing the token is evaluated,
+        so the results do not have to be kept in memory until the whole text is processed.
+
+        The stream pre-empts the running request of the session once, when it starts, and is cancelled
+        by any newer request of the session, even one made between two yielded tokens.
+        """
+        tokens, numericalized, metadata = self._trained_model._to_numericalized_prep_text(text, extension,
+                                                                                          append_eof)
+        word_boundaries = metadata.word_boundaries
+        prep_text_chunks = split_list_into_nested_chunks(tokens, max_context_allowed - len(self.context),
+                                                         max_context_allowed, self._trained_model.MAX_SUBTOKENS_PER_CHUNK)
+        context_lengths = ContextUsage.from_chunks(prep_text_chunks, len(self.context)).to_array()
+        evaluation_mask = _get_evaluation_mask(metadata, token_type_filter)
+        cancellation_token = self._start_request(cancellation_token)
+
+        # entropies of the subtokens of the full tokens which are not yielded yet
+        pending_entropies: List[Optional[float]] = []
+        n_yielded_full_tokens = 0
+        for sub_chunk_entropies in self._iter_entropies_for_prep_text(prep_text_chunks, max_context_allowed,
+                                                                      evaluation_mask, cancellation_token,
+                                                                      numericalized):
+            pending_entropies.extend(sub_chunk_entropies)
+            start = word_boundaries[n_yielded_full_tokens]
+            n_complete_full_tokens = bisect_right(word_boundaries, start + len(pending_entropies)) - 1
+            if n_complete_full_tokens == n_yielded_full_tokens:
+                continue
+            end = word_boundaries[n_complete_full_tokens]
+            yield from zip(*_to_lists(*_aggregate_entropies(
+                pending_entropies[:end - start], tokens[start:end],
+                [boundary - start for boundary in word_boundaries[n_yielded_full_tokens:n_complete_full_tokens + 1]],
+                metadata.token_types[n_yielded_full_tokens:n_complete_full_tokens],
+                context_lengths[start:end], full_tokens)))
+            pending_entropies = pending_entropies[end - start:]
+            n_yielded_full_tokens = n_complete_full_tokens
+
+    def _get_entropies_for_prep_text(self, prep_text_chunks: List[List[List[str]]],
+                                     max_context_allowed: int,
+                                     evaluation_mask: Optional[List[bool]] = None,
+                                     cancellation_token: Optional[CancellationToken] = None,
+                                     numericalized: Optional[np.ndarray] = None) -> List[Optional[float]]:
+        """
+        changes hidden states of the session!!
+        If the indices of the prep tokens in the vocabulary are passed as `numericalized`,
+        they are fed to the model as they are, otherwise the prep tokens are numericalized.
+        """
+        if prep_text_chunks == [[]]:
+            return []
+
+        loss_list = []
+        position = 0
+
+        with self._activated(cancellation_token) as model:
+            for chunk in prep_text_chunks:
+                for sub_chunk in chunk:
+                    if cancellation_token is not None:
+                        cancellation_token.check()
+                    sub_chunk_mask = evaluation_mask[position:position + len(sub_chunk)] \
+                        if evaluation_mask is not None else None
+                    numericalized_sub_chunk = numericalized[position:position + len(sub_chunk)] \
+                        if numericalized is not None else None
+                    loss_list.extend(self._calculate_entropies_for_sub_chunk(model, sub_chunk, sub_chunk_mask,
+                                                                             numericalized_sub_chunk))
+                    position += len(sub_chunk)
+                if len(self.context) == max_context_allowed:
+                    self._reset(model)
+        return loss_list
+
+    def _iter_entropies_for_prep_text(self, prep_text_chunks: List[List[List[str]]],
+                                      max_context_allowed: int,
+                                      evaluation_mask: Optional[List[bool]] = None,
+                                      cancellation_token: Optional[CancellationToken] = None,
+                                      numericalized: Optional[np.ndarray] = None) \
+            -> Generator[List[Optional[float]], None, None]:
+        """
+        Yields the entropies of each sub-chunk as soon as it is evaluated. The model is activated
+        for each sub-chunk separately, so other sessions are not blocked while the entropies are consumed.
+        The request with `cancellation_token` must have been started already: the sub-chunks do not pre-empt
+        the requests of the session started after it.
+        If cancelled, the state of the session stays as it was after the last evaluated sub-chunk.
+        """
+        if prep_text_chunks == [[]]:
+            return
+
+        position = 0
+        for chunk in prep_text_chunks:
+            for sub_chunk in chunk:
+                sub_chunk_mask = evaluation_mask[position:position + len(sub_chunk)] \
+                    if evaluation_mask is not None else None
+                numericalized_sub_chunk = numericalized[position:position + len(sub_chunk)] \
+                    if numericalized is not None else None
+                with self._activated(cancellation_token, start_request=False) as model:
+                    entropies = self._calculate_entropies_for_sub_chunk(model, sub_chunk, sub_chunk_mask,
+                                                                        numericalized_sub_chunk)
+                position += len(sub_chunk)
+                yield entropies
+            if len(self.context) == max_context_allowed:
+                with self._activated() as model:
+                    self._reset(model)
+
+    def _calculate_entropies_for_sub_chunk(self, model: SequentialRNN, sub_chunk: List[str],
+                                           sub_chunk_mask: Optional[List[bool]],
+                                           numericalized_sub_chunk: Optional[np.ndarray] = None) \
+            -> List[Optional[float]]:
+        if numericalized_sub_chunk is None:
+            numericalized_sub_chunk = np.asarray(self._trained_model.vocab.numericalize(sub_chunk), dtype=np.int64)
+        numericalized_prep_text = torch.as_tensor(numericalized_sub_chunk, device=self._trained_model.device)[None, :]
+
+        self._save_context(sub_chunk)
+        input = torch.cat([self._last_predicted_token_tensor, numericalized_prep_text[:, :-1]], dim=1)
+        entropies = _calculate_entropies(model, input, numericalized_prep_text, sub_chunk_mask,
+                                         self._trained_model.DECODER_BLOCK_SIZE)
+        self._last_predicted_token_tensor = numericalized_prep_text[:, -1:]
+        return entropies
+
+    def _reset(self, model: SequentialRNN) -> None:
+        model.reset()
+        self.reset_context()
+
+    def reset(self) -> None:
+        with self._activated() as model:
+            self._reset(model)
+            self._last_predicted_token_tensor = self._trained_model._get_starting_token_tensor()
+
+    def predict_next_full_token(self, n_suggestions: int = 1, include_debug_tokens: bool = False,
+                                max_prob: float = 0.05, time_budget_ms: Optional[float] = None,
+                                cancellation_token: Optional[CancellationToken] = None,
+                                prefix: str = '', return_result: bool = False) \
+            -> Union[PredictionList, PredictionResult]:
+        """
+        The search for suggestions stops as soon as none of the candidates being built can reach
+        the probability of `max_prob`, so fewer than `n_suggestions` can be returned.
+        Set `max_prob` to 0.0 to always get `n_suggestions` suggestions.
+
+        If `time_budget_ms` runs out, the best suggestions found so far are returned.
+        The budget includes the time the request waits for the model while it is used by other sessions.
+        To find out whether the suggestions were truncated, pass `return_result=True` to get a `PredictionResult`
+        instead of the list of suggestions. The number of truncated searches is also tracked
+        in `TrainedModel.beam_search_statistics`.
+
+        The request can be cancelled with `cancellation_token` or by a newer request of the session (see `cancel`),
+        in which case `OperationCancelled` is raised.
+
+        If `prefix` is specified, e.g. the part of the identifier the user has already typed,
+        only full tokens starting with the prefix are suggested.
+        """
+        deadline = get_deadline(time_budget_ms)
+        cancellation_token = cancellation_token or CancellationToken()
+        prefix_constraint = self._trained_model._subtoken_trie.create_prefix_constraint(
+            prefix, self._trained_model._complete_token_predicate, self._trained_model.device) if prefix else None
+        with self._activated(cancellation_token) as model:
+            result = beam_search(model, self._last_predicted_token_tensor[0],
+                                 self._trained_model._complete_token_predicate, n_suggestions,
+                                 self._trained_model.BEAM_SIZE, max_prob, cancellation_token=cancellation_token,
+                                 prefix_constraint=prefix_constraint, deadline=deadline)
+            self._trained_model.beam_search_statistics.record(result)
+        suggestions = self._to_prediction_list(result, include_debug_tokens)
+        return PredictionResult(suggestions, result.truncated) if return_result else suggestions
+
+    def predict_next_subtokens(self, k: int = 1) -> SubtokenPredictionList:
+        """
+        Returns the `k` most probable next subtokens, the most probable first.
+        Unlike `predict_next_full_token`, makes only one step of the model and does not run the beam search.
+        Does not change the state of the session.
+        """
+        with self._activated() as model:
+            log_probs, subtokens = _get_top_k_next_subtokens(model, self._last_predicted_token_tensor, k)
+        return self._trained_model._to_subtoken_prediction_list(log_probs[0], subtokens[0])
+
+    def generate(self, n_samples: int = 10, max_subtokens: int = 50, temperature: float = 1.0, top_p: float = 1.0,
+                 generator: Optional[torch.Generator] = None) -> GenerationResult:
+        """
+        Samples `n_samples` multi-token continuations of the text fed so far, all of them in one batch.
+        A sample is stopped at the end of the line or after `max_subtokens` subtokens;
+        in the latter case, its last full token can be incomplete and is not returned.
+        Does not change the state of the session.
+        """
+        with self._activated() as model:
+            result = sample(model, self._last_predicted_token_tensor[0], self._trained_model._is_end_of_line,
+                            n_samples, max_subtokens, temperature, top_p, generator)
+        generation_result = GenerationResult(
+            continuations=[self._trained_model._to_full_tokens(subtokens) for subtokens in result.subtokens],
+            log_probs=result.log_probs, n_subtokens=result.n_subtokens, elapsed_seconds=result.elapsed_seconds)
+        logger.debug(f'Generated {generation_result.n_tokens} tokens ({generation_result.n_subtokens} subtokens) '
+                     f'in {generation_result.elapsed_seconds:.3f} s: '
+                     f'{generation_result.tokens_per_second:.1f} tokens/s')
+        return generation_result
+
+    def _to_prediction_list(self, result: BeamSearchResult, include_debug_tokens: bool = False) -> PredictionList:
+        suggestions: PredictionList = []
+        for numericalized_subtokens, score in zip(result.subtokens, result.scores):
+            subtokens = self._trained_model.vocab.textify(numericalized_subtokens, sep=None)
+            full_token = (to_full_token_string(subtokens, include_debug_tokens))
+            suggestions.append((full_token,  1 / exp(score)))
+        return suggestions
+
+
 class TrainedModel(object):
     STARTING_TOKEN = placeholders['ect']
 
-    def __init__(self, path: str, force_use_cpu: bool = False, load_only_description: bool = False):
+    def __init__(self, path: str, force_use_cpu: bool = False, load_only_description: bool = False,
+                 memory_budget_mb: Optional[int] = None):
         if not os.path.exists(path):
             raise FileNotFoundError(f'Path does not exist: {path}')
         self._force_use_cpu = force_use_cpu
@@ -281,7 +938,11 @@ class TrainedModel(object):
         self._metrics = None
         self._config = None
         self._tags = []
-        self._context: List[str] = []
+        self._lock = Lock()
+        self._beam_search_statistics = BeamSearchStatistics()
+        self._hidden_state_cache = HiddenStateCache(self.HIDDEN_STATE_CACHE_MAX_BYTES,
+                                                    self.HIDDEN_STATE_CACHE_CHECKPOINT_EVERY)
+        self._inference_plan: Optional[InferencePlan] = None
         try:
             self._config: LMTrainingConfig = load_config_or_metrics_from_file(path_to_config_file, LMTrainingConfig)
         except FileNotFoundError:
@@ -304,12 +965,12 @@ class TrainedModel(object):
             self._original_vocab = Vocab.load(os.path.join(path, VOCAB_FILE_NAME))
             term_vocab, self._first_nonterm_token = _create_term_vocab(self._original_vocab)
             self._model, self._vocab = self._load_model(path, term_vocab)
+            self._subtoken_trie = SubtokenTrie([_get_subtoken_text(subtoken) for subtoken in self._vocab.itos])
             to_test_mode(self._model)
             self._initial_snapshot = take_hidden_state_snapshot(self._model)
-
-            # last_predicted_token_tensor is a rank-2 tensor!
-            self._last_predicted_token_tensor = torch.tensor([self._vocab.numericalize([self.STARTING_TOKEN])],
-                                                             device=get_device(self._force_use_cpu))
+            self._default_session = InferenceSession(self)
+            if memory_budget_mb is not None:
+                self.plan_inference(memory_budget_mb)
 
     @property
     def id(self):
@@ -329,7 +990,7 @@ class TrainedModel(object):
 
     @property
     def context(self):
-        return self._context
+        return self._get_default_session().context
 
     @property
     def model(self):
@@ -339,6 +1000,51 @@ class TrainedModel(object):
     def vocab(self):
         return self._vocab
 
+    @property
+    def device(self) -> Union[int, str]:
+        return get_device(self._force_use_cpu)
+
+    @property
+    def beam_search_statistics(self) -> BeamSearchStatistics:
+        return self._beam_search_statistics
+
+    @property
+    def hidden_state_cache(self) -> HiddenStateCache:
+        return self._hidden_state_cache
+
+    @property
+    def inference_plan(self) -> Optional[InferencePlan]:
+        return self._inference_plan
+
+    def plan_inference(self, memory_budget_mb: int) -> InferencePlan:
+        """
+        Chooses the sub-chunk length, the decoder block size, the batch size of `get_entropies_for_texts`
+        and the beam width so that inference fits into `memory_budget_mb` (see `plan_inference`),
+        and uses them instead of the defaults from now on. The beam is at least `MIN_PLANNED_BEAM_SIZE` wide,
+        `ValueError` is raised if it does not fit into the budget.
+
+        On cpu, the budget is for the RSS of the process, so the memory already used by the process is taken
+        into account; on gpu, only the parameters of the model and the hidden state cache are.
+        """
+        self._check_model_loaded()
+        with self._lock:
+            footprint = measure_memory_footprint(self._model)
+        if self.device == 'cpu':
+            n_used_bytes = int(get_cpu_memory_used_mb() * 2 ** 20)
+        else:
+            n_used_bytes = footprint.n_parameter_bytes
+        n_used_bytes += self.HIDDEN_STATE_CACHE_MAX_BYTES
+        plan = plan_inference(footprint, memory_budget_mb * 2 ** 20, n_used_bytes, self.BEAM_SEARCH_BATCH_SIZE,
+                              min_beam_size=self.MIN_PLANNED_BEAM_SIZE)
+        self.MAX_SUBTOKENS_PER_CHUNK = plan.max_subtokens_per_chunk
+        self.DECODER_BLOCK_SIZE = plan.decoder_block_size
+        self.ENTROPY_BATCH_SIZE = plan.batch_size
+        self.BEAM_SIZE = plan.beam_size
+        self._inference_plan = plan
+        logger.info(f'Memory footprint of model {self._id}: {footprint}. '
+                    f'Inference plan for the budget of {memory_budget_mb} MB: {plan}')
+        return plan
+
     def _load_model(self, path: str, custom_vocab: Optional[Vocab] = None) -> Tuple[SequentialRNN, Vocab]:
         path_to_model = os.path.join(path, BEST_MODEL_FILE_NAME)
         logger.debug(f"Loading model from: {path_to_model} ...")
@@ -362,20 +1068,56 @@ class TrainedModel(object):
         return model, vocab
 
     BEAM_SIZE = 500
+    # the beam chosen by `plan_inference` has to fit the largest number of suggestions requested by the library itself,
+    # i.e. `DEFAULT_N_MODEL_SUGGESTIONS` of the evaluation
+    MIN_PLANNED_BEAM_SIZE = 100
+    # the number of full tokens whose suggestions are searched for at once in `get_predictions_and_feed`
+    BEAM_SEARCH_BATCH_SIZE = 8
     SAVE_CONTEXT_LIMIT = 1000
-
-    def _save_context(self, prep_tokens: List[str]) -> None:
-        self._context.extend(prep_tokens)
-        if len(self._context) > TrainedModel.SAVE_CONTEXT_LIMIT:
-            self._context = self._context[-TrainedModel.SAVE_CONTEXT_LIMIT:]
-
-    def reset_context(self) -> None:
-        self._context = []
+    # if the text is too big, we break it down to chunks to fit it into gpu memory
+    # big chunks require more memory, small chunks require more time.
+    # Only the activations of the encoder are kept for the whole chunk,
+    # the decoder is evaluated for `DECODER_BLOCK_SIZE` positions at a time
+    MAX_SUBTOKENS_PER_CHUNK = 1000
+    DECODER_BLOCK_SIZE = 200
+    # the number of texts evaluated at once by `get_entropies_for_texts`
+    ENTROPY_BATCH_SIZE = 32
+    # the defaults above are used unless they are chosen for a memory budget by `plan_inference`
+    HIDDEN_STATE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+    # set to a `PrepCache` to cache the results of `prep_text`
+    prep_cache: Optional[PrepCache] = None
+    # hidden states are cached after each `HIDDEN_STATE_CACHE_CHECKPOINT_EVERY` tokens of the text and at its end,
+    # so that texts differing only in the end still share the cached states of their common prefix
+    HIDDEN_STATE_CACHE_CHECKPOINT_EVERY = 64
 
     def prep_corpus(self, corpus: Corpus, **kwargs) -> PreprocessedCorpus:
         return self._prep_function.apply(corpus, **kwargs)
 
     def prep_text(self, text: str, extension: str, **kwargs) -> Union[Tuple[List[str], PreprocessingMetadata], List[str]]:
+        """
+        If `TrainedModel.prep_cache` is set, preprocessing results are looked up in the cache first.
+        The cache is shared by all the models; models with the same preprocessing share the entries.
+        Each call returns its own copy of the cached metadata.
+        """
+        prep_cache = TrainedModel.prep_cache
+        if prep_cache is None:
+            return self._prep_text(text, extension, **kwargs)
+
+        return_metadata: bool = 'return_metadata' in kwargs and kwargs['return_metadata']
+        # results of other versions of codeprep, e.g. in the on-disk tier of the cache, are not used
+        key = get_prep_cache_key(text, extension, self._prep_function.callable.__name__, self._prep_function.params,
+                                 asdict(self._prep_function.options), sorted(kwargs.items()), codeprep_version)
+
+        def prep_text_compactly() -> Tuple[Tuple[str, ...], Optional[PreprocessingMetadata]]:
+            preprocessing_result = self._prep_text(text, extension, **kwargs)
+            tokens, metadata = preprocessing_result if return_metadata else (preprocessing_result, None)
+            # the same subtokens are shared by all the cached entries
+            return tuple(sys.intern(token) for token in tokens), metadata
+
+        tokens, metadata = prep_cache.get_or_compute(key, prep_text_compactly)
+        return (list(tokens), copy.deepcopy(metadata)) if return_metadata else list(tokens)
+
+    def _prep_text(self, text: str, extension: str, **kwargs) -> Union[Tuple[List[str], PreprocessingMetadata], List[str]]:
         import codeprep.api.text as text_api
         return_metadata: bool = 'return_metadata' in kwargs and kwargs['return_metadata']
         text_callable = getattr(text_api, self._prep_function.callable.__name__)
@@ -385,29 +1127,41 @@ class TrainedModel(object):
             check_metadata_validity(*preprocessing_result)
         return preprocessing_result
 
-    def get_predictions_and_feed(self, text: str, extension: str, n_suggestions: int, append_eof: bool)\
-            -> Generator[Tuple[PredictionList, str, Type], None, None]:
-        prep_text, metadata = self.prep_text(text, extension, return_metadata=True, append_eof=append_eof)
+    def _textify(self, prep_tokens: PrepTokens) -> List[str]:
+        if len(prep_tokens) > 0 and not isinstance(prep_tokens[0], str):
+            return self._vocab.textify(prep_tokens, sep=None)
+        return list(prep_tokens)
 
-        for ind, prep_token in FullTokenIterator(prep_text, metadata.word_boundaries, return_full_token_index=True):
-            predictions = self.predict_next_full_token(n_suggestions)
-            self._feed_prep_tokens([prep_token])
+    def _to_prep_text(self, text: TextInput, extension: str, append_eof: bool = False) \
+            -> Tuple[List[str], PreprocessingMetadata]:
+        if isinstance(text, str):
+            return self.prep_text(text, extension, return_metadata=True, append_eof=append_eof)
 
-            yield predictions, prep_token, metadata.token_types[ind]
+        prep_tokens, metadata = text
+        prep_tokens = self._textify(prep_tokens)
+        check_metadata_validity(prep_tokens, metadata)
+        return prep_tokens, metadata
+
+    def _to_numericalized_prep_text(self, text: TextInput, extension: str, append_eof: bool = False) \
+            -> Tuple[List[str], np.ndarray, PreprocessingMetadata]:
+        """
+        Returns the prep tokens of the text together with their indices in the vocabulary.
+        Numericalized text is passed through as it is and is only textified to get the prep tokens.
+        """
+        if isinstance(text, str) or len(text[0]) == 0 or isinstance(text[0][0], str):
+            prep_tokens, metadata = self._to_prep_text(text, extension, append_eof)
+            return prep_tokens, np.asarray(self._vocab.numericalize(prep_tokens), dtype=np.int64), metadata
+
+        numericalized, metadata = text
+        prep_tokens = self._textify(numericalized)
+        check_metadata_validity(prep_tokens, metadata)
+        return prep_tokens, np.asarray(numericalized, dtype=np.int64), metadata
 
     def _check_model_loaded(self, only_description=False):
         if not only_description and self._load_only_description:
             raise RuntimeError("Operation not supported. Only model's description is loaded. "
                                "Prease reload the model with param load_only_description set to False.")
 
-    def _feed_prep_tokens(self, prep_tokens: List[str]) -> None:
-        self._check_model_loaded()
-        context_tensor = torch.tensor([self._vocab.numericalize(prep_tokens)], device=get_device(self._force_use_cpu))
-        with lock:
-            self._save_context(prep_tokens)
-            _ = get_last_layer_activations(self._model, context_tensor[:, :-1])
-            self._last_predicted_token_tensor = context_tensor[:, -1:]
-
     def check_inference_possible_for_file_type(self, extension: str) -> bool:
         try:
             self._assert_inference_possible_for_file_type(extension)
@@ -415,103 +1169,220 @@ class TrainedModel(object):
         except ValueError:
             return False
 
-    def feed_text(self, text: str, extension: str) -> None:
-        self._assert_inference_possible_for_file_type(extension)
+    def _get_starting_token_tensor(self) -> torch.Tensor:
+        return torch.tensor([self._vocab.numericalize([self.STARTING_TOKEN])], device=self.device)
 
-        prep_text, metadata = self.prep_text(text, extension=extension, return_metadata=True)
-        self._feed_prep_tokens(prep_text)
+    def _complete_token_predicate(self, subtokens: torch.Tensor) -> torch.Tensor:
+        return subtokens < self._first_nonterm_token
 
-    def get_entropies_for_text(self, text: str, extension: str, full_tokens: bool,
-                               append_eof: bool, max_context_allowed: int) \
-            -> Tuple[List[float], List[str], List[Type], List[int]]:
-        tokens, metadata = self.prep_text(text, extension, return_metadata=True, append_eof=append_eof)
-        max_subtokens_per_chunk = 200
-        context_length_for_next_prediction = len(self.context)
-        prep_text_chunks = split_list_into_nested_chunks(tokens, max_context_allowed - len(self.context), max_context_allowed, max_subtokens_per_chunk)
-        context_usage = ContextUsage.from_chunks(prep_text_chunks, context_length_for_next_prediction)
-        # if the line is too big, we break it down to chunks to fit it into gpu memory
-        # big chunks require more memory, small chunks require more time
-        subtoken_entropies = self._get_entropies_for_prep_text(prep_text_chunks, max_context_allowed)
-
-        iterator_type = FullTokenIterator if full_tokens else SubtokenIterator
-
-        def formatter(lst: List[Tuple[float, str, int]]) -> Tuple[float, str, int]:
-            entropies, tokens, context_lengths = tuple(zip(*lst))
-            return sum(entropies), "".join(tokens), context_lengths[0] if len(context_lengths) == 1 else None
-
-        iterator = iterator_type(list(zip(subtoken_entropies, tokens, context_usage)), metadata.word_boundaries,
-                                 format=formatter, return_full_token_index=True)
-        e, t, tt, ct = [], [], [], []
-        for ind, (entropy, token, context_length) in iterator:
-            e.append(entropy)
-            t.append(token)
-            tt.append(metadata.token_types[ind])
-            ct.append(context_length)
-        return e, t, tt, ct
+    def _is_end_of_line(self, subtokens: torch.Tensor) -> torch.Tensor:
+        end_of_line = self._vocab.stoi.get(placeholders['olc_end'])
+        if end_of_line is None:
+            return torch.zeros_like(subtokens, dtype=torch.bool)
+        return subtokens == end_of_line
 
-    def _get_entropies_for_prep_text(self, prep_text_chunks: List[List[List[str]]],
-                                     max_context_allowed: int) -> List[float]:
+    def _to_full_tokens(self, subtokens: List[int]) -> List[str]:
         """
-        changes hidden states of the model!!
+        Subtokens following the last complete full token are dropped.
         """
-        with lock:
-            self._check_model_loaded()
-
-        if prep_text_chunks == [[]]:
-            return []
+        full_tokens = []
+        full_token_start = 0
+        for i, subtoken in enumerate(subtokens):
+            if subtoken < self._first_nonterm_token:
+                full_tokens.append(to_full_token_string(self._vocab.textify(subtokens[full_token_start:i + 1],
+                                                                            sep=None)))
+                full_token_start = i + 1
+        return full_tokens
+
+    def new_session(self) -> InferenceSession:
+        """
+        Creates a new inference session starting from the initial state of the model.
+        The session shares the weights with this model but has its own hidden state and context.
+        """
+        return InferenceSession(self)
 
-        loss_list = []
+    def _get_default_session(self) -> InferenceSession:
+        self._check_model_loaded()
+        return self._default_session
 
-        for chunk in prep_text_chunks:
-            for sub_chunk in chunk:
-                numericalized_prep_text = torch.tensor([self._vocab.numericalize(sub_chunk)],
-                                                       device=get_device(self._force_use_cpu))
-
-                self._save_context(sub_chunk)
-                last_layer = get_last_layer_activations(self._model, torch.cat([self._last_predicted_token_tensor, numericalized_prep_text[:, :-1]], dim=1))
-                loss = F.cross_entropy(last_layer.view(-1, last_layer.shape[-1]),
-                                       numericalized_prep_text.view(-1),
-                                       reduction='none')
-                binary_loss = to_binary_entropy(loss)
-                loss_list.extend(binary_loss.tolist())
-                self._last_predicted_token_tensor = numericalized_prep_text[:, -1:]
-            if len(self.context) == max_context_allowed:
-                self._reset()
-        return loss_list
+    def reset_context(self) -> None:
+        self._get_default_session().reset_context()
 
-    def _reset(self) -> None:
-        self._model.reset()
-        self.reset_context()
+    def get_predictions_and_feed(self, text: TextInput, extension: str, n_suggestions: int, append_eof: bool)\
+            -> Generator[Tuple[PredictionList, str, Type], None, None]:
+        return self._get_default_session().get_predictions_and_feed(text, extension, n_suggestions, append_eof)
+
+    def feed_text(self, text: Union[TextInput, PrepTokens], extension: str) -> None:
+        self._get_default_session().feed_text(text, extension)
+
+    def reset_to_text(self, text: str, extension: str) -> None:
+        self._get_default_session().reset_to_text(text, extension)
+
+    def get_entropies_for_text(self, text: TextInput, extension: str, full_tokens: bool,
+                               append_eof: bool, max_context_allowed: int,
+                               token_type_filter: Optional[TokenTypeFilter] = None,
+                               cancellation_token: Optional[CancellationToken] = None,
+                               as_arrays: bool = False) -> Union[EntropyLists, EntropyArrays]:
+        return self._get_default_session().get_entropies_for_text(text, extension, full_tokens,
+                                                                  append_eof, max_context_allowed, token_type_filter,
+                                                                  cancellation_token, as_arrays)
+
+    def iter_entropies_for_text(self, text: TextInput, extension: str, full_tokens: bool,
+                                append_eof: bool, max_context_allowed: int,
+                                token_type_filter: Optional[TokenTypeFilter] = None,
+                                cancellation_token: Optional[CancellationToken] = None) \
+            -> Generator[Tuple[Optional[float], str, Type, Optional[int]], None, None]:
+        return self._get_default_session().iter_entropies_for_text(text, extension, full_tokens, append_eof,
+                                                                   max_context_allowed, token_type_filter,
+                                                                   cancellation_token)
 
     def reset(self) -> None:
-        with lock:
-            self._check_model_loaded()
-            self._reset()
-            self._last_predicted_token_tensor = torch.tensor([self._vocab.numericalize([self.STARTING_TOKEN])],
-                                                             device=get_device(self._force_use_cpu))
-
-    def predict_next_full_token(self, n_suggestions: int = 1, include_debug_tokens: bool = False, max_prob: float = 0.05) -> PredictionList:
-        with lock:
-            self._check_model_loaded()
-
-            def complete_token_predicate(last_predictions: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
-                full_token_flags_sorted = last_predictions[:, -1] < self._first_nonterm_token
-                ready_candidate_idxs = full_token_flags_sorted.nonzero().squeeze(dim=1)
-                pending_candidate_idxs = (full_token_flags_sorted == 0).nonzero().squeeze(dim=1)
-                return ready_candidate_idxs, pending_candidate_idxs
-
-            numericalized_subtokens_list, scores = beam_search(self._model, self._last_predicted_token_tensor[0], complete_token_predicate, n_suggestions, self.BEAM_SIZE)
-            suggestions: PredictionList = []
-            for numericalized_subtokens, score in zip(numericalized_subtokens_list, scores):
-                try:
-                    start_of_empty_numbers = numericalized_subtokens.tolist().index(TORCH_LONG_MIN_VAL)
-                except ValueError:
-                    start_of_empty_numbers = len(numericalized_subtokens)
-                numericalized_subtokens = numericalized_subtokens[:start_of_empty_numbers]
-                subtokens = self._vocab.textify(numericalized_subtokens, sep=None)
-                full_token = (to_full_token_string(subtokens, include_debug_tokens))
-                suggestions.append((full_token,  1 / exp(score.item())))
-            return suggestions
+        self._get_default_session().reset()
+
+    def predict_next_full_token(self, n_suggestions: int = 1, include_debug_tokens: bool = False,
+                                max_prob: float = 0.05, time_budget_ms: Optional[float] = None,
+                                cancellation_token: Optional[CancellationToken] = None,
+                                prefix: str = '', return_result: bool = False) \
+            -> Union[PredictionList, PredictionResult]:
+        return self._get_default_session().predict_next_full_token(n_suggestions, include_debug_tokens,
+                                                                   max_prob, time_budget_ms, cancellation_token,
+                                                                   prefix, return_result)
+
+    def predict_next_subtokens(self, k: int = 1) -> SubtokenPredictionList:
+        return self._get_default_session().predict_next_subtokens(k)
+
+    def generate(self, n_samples: int = 10, max_subtokens: int = 50, temperature: float = 1.0, top_p: float = 1.0,
+                 generator: Optional[torch.Generator] = None) -> GenerationResult:
+        return self._get_default_session().generate(n_samples, max_subtokens, temperature, top_p, generator)
+
+    def predict_next_subtokens_for_sessions(self, sessions: List[InferenceSession], k: int = 1) \
+            -> List[SubtokenPredictionList]:
+        """
+        Batched form of `InferenceSession.predict_next_subtokens`: the hidden states of the sessions
+        are combined into one batch, and the next subtokens are predicted for all of them in one step.
+        Does not change the states of the sessions.
+        """
+        self._check_model_loaded()
+        for session in sessions:
+            if session.trained_model is not self:
+                raise ValueError('All the sessions have to be created by this model.')
+        if not sessions:
+            return []
+
+        with self._lock:
+            hidden_state = self._model[0].hidden
+            restore_snapshot(self._model, concat_snapshots([session._hidden_state for session in sessions]))
+            try:
+                log_probs, subtokens = _get_top_k_next_subtokens(
+                    self._model, torch.cat([session._last_predicted_token_tensor for session in sessions]), k)
+            finally:
+                restore_snapshot(self._model, hidden_state)
+        return [self._to_subtoken_prediction_list(row_log_probs, row_subtokens)
+                for row_log_probs, row_subtokens in zip(log_probs, subtokens)]
+
+    def _to_subtoken_prediction_list(self, log_probs: torch.Tensor, subtokens: torch.Tensor) \
+            -> SubtokenPredictionList:
+        subtokens = subtokens.tolist()
+        return list(zip(subtokens, self._vocab.textify(subtokens, sep=None), log_probs.tolist()))
+
+    def get_entropies_for_texts(self, texts: List[TextInput], extension: str, full_tokens: bool,
+                                append_eof: bool, max_context_allowed: int,
+                                token_type_filter: Optional[TokenTypeFilter] = None,
+                                cancellation_token: Optional[CancellationToken] = None,
+                                as_arrays: bool = False, batch_size: Optional[int] = None) \
+            -> List[Union[EntropyLists, EntropyArrays]]:
+        """
+        Calculates entropies for multiple independent texts packing them into padded batches.
+        Texts of similar length are put into the same batch to waste less computation on padding.
+
+        Each text is evaluated starting from the initial state of the model, i.e. the result for each text
+        is the same as the one returned by `get_entropies_for_text` with the same arguments right after `reset`
+        is called. Does not change the state of the model.
+
+        If `as_arrays` is True, the results are returned as numpy arrays (see `get_entropies_for_text`).
+        """
+        self._check_model_loaded()
+        if batch_size is None:
+            batch_size = self.ENTROPY_BATCH_SIZE
+        cancellation_token = cancellation_token or CancellationToken()
+        prep_texts = [self._to_numericalized_prep_text(text, extension, append_eof) for text in texts]
+        # bucketing texts by length
+        text_indices = sorted(range(len(texts)), key=lambda i: len(prep_texts[i][0]))
+
+        results: List[Optional[Union[EntropyLists, EntropyArrays]]] = [None] * len(texts)
+        for batch_start in range(0, len(text_indices), batch_size):
+            batch_indices = text_indices[batch_start:batch_start + batch_size]
+            batch_entropies = self._get_entropies_for_prep_texts([prep_texts[i][1] for i in batch_indices],
+                                                                 max_context_allowed, cancellation_token)
+            for text_index, subtoken_entropies in zip(batch_indices, batch_entropies):
+                tokens, _, metadata = prep_texts[text_index]
+                evaluation_mask = _get_evaluation_mask(metadata, token_type_filter)
+                if evaluation_mask is not None:
+                    subtoken_entropies = [entropy if evaluated else None
+                                          for entropy, evaluated in zip(subtoken_entropies, evaluation_mask)]
+                prep_text_chunks = split_list_into_nested_chunks(tokens, max_context_allowed,
+                                                                 max_context_allowed, self.MAX_SUBTOKENS_PER_CHUNK)
+                context_usage = ContextUsage.from_chunks(prep_text_chunks, 0)
+                results[text_index] = _format_entropies(subtoken_entropies, tokens, metadata,
+                                                        context_usage, full_tokens, as_arrays)
+        return results
+
+    def _get_entropies_for_prep_texts(self, numericalized_prep_texts: List[np.ndarray], max_context_allowed: int,
+                                      cancellation_token: CancellationToken) -> List[List[float]]:
+        """
+        Takes the prep texts numericalized with the vocabulary of the model.
+        Each prep text gets its own row of the hidden state. Texts are padded at the end,
+        so padding does not influence the entropies of the actual tokens.
+        The hidden state of the model is restored after the calculation.
+        """
+        max_length = max(map(len, numericalized_prep_texts), default=0)
+        if max_length == 0:
+            return [[] for _ in numericalized_prep_texts]
+
+        device = self.device
+        batch_size = len(numericalized_prep_texts)
+        padded_prep_texts = torch.full((batch_size, max_length), fill_value=PAD_TOKEN_INDEX,
+                                       dtype=torch.long, device=device)
+        for row, numericalized_prep_text in enumerate(numericalized_prep_texts):
+            if len(numericalized_prep_text) > 0:
+                padded_prep_texts[row, :len(numericalized_prep_text)] = torch.as_tensor(numericalized_prep_text,
+                                                                                        device=device)
+        last_predicted_token_tensor = torch.full((batch_size, 1), fill_value=self._vocab.numericalize([self.STARTING_TOKEN])[0],
+                                                 dtype=torch.long, device=device)
+
+        # all the texts start with an empty context, so the chunk boundaries are the same for all of them
+        position_chunks = split_list_into_nested_chunks(list(range(max_length)), max_context_allowed,
+                                                        max_context_allowed, self.MAX_SUBTOKENS_PER_CHUNK)
+        loss_list = []
+        # the length of the context saved by a session evaluating the texts one by one
+        context_length = 0
+        with self._lock, torch.no_grad():
+            hidden_state_snapshot = take_hidden_state_snapshot(self._model)
+            try:
+                reset_with_batch_size(self._model, batch_size)
+                for chunk in position_chunks:
+                    for sub_chunk in chunk:
+                        cancellation_token.check()
+                        targets = padded_prep_texts[:, sub_chunk[0]:sub_chunk[-1] + 1]
+                        encoder_outputs = get_encoder_outputs(self._model, torch.cat([last_predicted_token_tensor,
+                                                                                      targets[:, :-1]], dim=1))
+                        # the decoder block is shared by all the rows of the batch
+                        loss = get_target_losses(self._model, encoder_outputs, targets,
+                                                 max(1, self.DECODER_BLOCK_SIZE // batch_size))
+                        loss_list.append(to_binary_entropy(loss))
+                        last_predicted_token_tensor = targets[:, -1:]
+                    # the same rule as in `InferenceSession._get_entropies_for_prep_text`,
+                    # where the saved context is limited to `SAVE_CONTEXT_LIMIT` tokens
+                    context_length = min(context_length + sum(map(len, chunk)), self.SAVE_CONTEXT_LIMIT)
+                    if context_length == max_context_allowed:
+                        reset_with_batch_size(self._model, batch_size)
+                        context_length = 0
+            finally:
+                restore_snapshot(self._model, hidden_state_snapshot)
+
+        all_losses = torch.cat(loss_list, dim=1)
+        return [all_losses[row, :len(numericalized_prep_text)].tolist()
+                for row, numericalized_prep_text in enumerate(numericalized_prep_texts)]
 
     def _format_layers_config(self) -> str:
         if isinstance(self._config.arch, TransformerArch):
@@ -23,12 +23,36 @@ def take_hidden_state_snapshot(model: SequentialRNN) -> List[Tuple[torch.Tensor,
     return [(hl[0].clone(), hl[1].clone()) if isinstance(hl, (tuple, list)) else hl.clone() for hl in model[0].hidden]
 
 
+def _get_batch_size(snapshot: List[Tuple[torch.Tensor, torch.Tensor]]) -> int:
+    first_layer = snapshot[0]
+    hidden = first_layer[0] if isinstance(first_layer, (tuple, list)) else first_layer
+    return hidden.size(1)
+
+
+def concat_snapshots(snapshots: List[List[Tuple[torch.Tensor, torch.Tensor]]]) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """
+    Combines hidden states with batch size = 1 into one hidden state whose i-th row is the i-th snapshot.
+    """
+    result = []
+    for layers in zip(*snapshots):
+        if isinstance(layers[0], (tuple, list)):
+            result.append(tuple(torch.cat(tensors, dim=1) for tensors in zip(*layers)))
+        else:
+            result.append(torch.cat(layers, dim=1))
+    return result
+
+
 def restore_snapshot(model: SequentialRNN, snapshot: List[Tuple[torch.Tensor, torch.Tensor]]):
     model[0].hidden = snapshot
-    model[0].bs = snapshot[0][0].size(0)
+    model[0].bs = _get_batch_size(snapshot)
 
 
-def get_last_layer_activations(model: SequentialRNN, input: torch.FloatTensor) -> Optional[torch.FloatTensor]:
+def reset_with_batch_size(model: SequentialRNN, bs: int) -> None:
+    model[0].bs = bs
+    model.reset()
+
+
+def _check_is_rank_2(input: torch.Tensor) -> None:
     tensor_rank = len(input.size())
     if tensor_rank != 2:
         if tensor_rank == 0:
@@ -40,6 +64,10 @@ def get_last_layer_activations(model: SequentialRNN, input: torch.FloatTensor) -
 
         raise ValueError(f'This method accepts tensors of rank 2. {error_msg}')
 
+
+def get_last_layer_activations(model: SequentialRNN, input: torch.FloatTensor) -> Optional[torch.FloatTensor]:
+    _check_is_rank_2(input)
+
     if input.nelement() == 0:
         return None
 
@@ -47,6 +75,55 @@ def get_last_layer_activations(model: SequentialRNN, input: torch.FloatTensor) -
     return last_layer_activations
 
 
+def get_encoder_outputs(model: SequentialRNN, input: torch.LongTensor) -> Optional[torch.FloatTensor]:
+    """
+    Advances the hidden state of the model and returns the outputs of the last layer of the encoder
+    which can be later passed to `decode`.
+    """
+    _check_is_rank_2(input)
+
+    if input.nelement() == 0:
+        return None
+
+    _, outputs = model[0](input)
+    return outputs[-1]
+
+
+def decode(model: SequentialRNN, encoder_outputs: torch.FloatTensor) -> torch.FloatTensor:
+    linear_decoder = model[1]
+    return linear_decoder.decoder(linear_decoder.output_dp(encoder_outputs))
+
+
+def get_target_losses(model: SequentialRNN, encoder_outputs: torch.FloatTensor, targets: torch.LongTensor,
+                      block_size: int) -> torch.FloatTensor:
+    """
+    Calculates cross-entropy losses (in nats) of the targets given the encoder outputs: [bs, seq_len].
+
+    The decoder and the log-sum-exp are evaluated for at most `block_size` positions at a time,
+    so that the logits are never materialized for the whole sequence: only the losses are kept.
+    """
+    losses = []
+    for start in range(0, targets.size(1), block_size):
+        logits = decode(model, encoder_outputs[:, start:start + block_size])
+        target_logits = logits.gather(-1, targets[:, start:start + block_size].unsqueeze(-1)).squeeze(-1)
+        losses.append(torch.logsumexp(logits, dim=-1) - target_logits)
+    return torch.cat(losses, dim=1)
+
+
+def feed_to_encoder(model: SequentialRNN, input: torch.LongTensor) -> None:
+    """
+    Advances the hidden state of the model without running the decoder.
+    The decoder is the most expensive layer for big vocabularies, and its output is not needed
+    when the input is only used as context.
+    """
+    _check_is_rank_2(input)
+
+    if input.nelement() == 0:
+        return
+
+    model[0](input)
+
+
 class GRU(Module):
 
     initrange=0.1
@@ -0,0 +1,100 @@
+from typing import List, Dict, Callable
+
+import torch
+from torch import LongTensor, Tensor
+
+
+class PrefixConstraint(object):
+    """
+    Restricts the beam search to the full tokens starting with the given prefix.
+
+    The state of a candidate is the number of characters of the prefix its subtokens already cover,
+    so the subtokens allowed to follow a candidate depend only on this number.
+    """
+    def __init__(self, allowed_subtokens: Tensor, subtoken_lengths: LongTensor):
+        """
+        :param allowed_subtokens: [len(prefix) + 1, vocab_size] boolean mask:
+        i-th row is the mask of subtokens that can follow a candidate covering the first i characters of the prefix
+        :param subtoken_lengths: the number of characters in each subtoken: [vocab_size]
+        """
+        self._allowed_subtokens = allowed_subtokens
+        self._subtoken_lengths = subtoken_lengths
+        self._prefix_length = allowed_subtokens.size(0) - 1
+
+    def initial_positions(self, n: int) -> LongTensor:
+        return torch.zeros(n, dtype=torch.long, device=self._subtoken_lengths.device)
+
+    def get_allowed_subtokens(self, positions: LongTensor) -> Tensor:
+        return self._allowed_subtokens[positions]
+
+    def advance(self, positions: LongTensor, subtokens: LongTensor) -> LongTensor:
+        return (positions + self._subtoken_lengths[subtokens]).clamp(max=self._prefix_length)
+
+
+class _TrieNode(object):
+    def __init__(self):
+        self.children: Dict[str, '_TrieNode'] = {}
+        self.subtokens: List[int] = []
+
+
+class SubtokenTrie(object):
+    """
+    Trie over the texts of the subtokens of a vocabulary.
+
+    >>> trie = SubtokenTrie(['get', 'ge', 'getter', 'set', 'g'])
+    >>> sorted(trie.find_starting_with('ge'))
+    [0, 1, 2]
+    >>> sorted(trie.find_prefixes_of('gets'))
+    [0, 1, 4]
+    """
+    def __init__(self, texts: List[str]):
+        self._vocab_size = len(texts)
+        self._subtoken_lengths = torch.tensor([len(text) for text in texts], dtype=torch.long)
+        self._root = _TrieNode()
+        for subtoken, text in enumerate(texts):
+            node = self._root
+            for char in text:
+                node = node.children.setdefault(char, _TrieNode())
+            node.subtokens.append(subtoken)
+
+    def find_starting_with(self, prefix: str) -> List[int]:
+        node = self._root
+        for char in prefix:
+            if char not in node.children:
+                return []
+            node = node.children[char]
+        result = []
+        nodes_to_visit = [node]
+        while nodes_to_visit:
+            node = nodes_to_visit.pop()
+            result.extend(node.subtokens)
+            nodes_to_visit.extend(node.children.values())
+        return result
+
+    def find_prefixes_of(self, text: str) -> List[int]:
+        node = self._root
+        result = list(node.subtokens)
+        for char in text:
+            if char not in node.children:
+                break
+            node = node.children[char]
+            result.extend(node.subtokens)
+        return result
+
+    def create_prefix_constraint(self, prefix: str, complete_token_predicate: Callable[[LongTensor], Tensor],
+                                 device) -> PrefixConstraint:
+        """
+        A subtoken can follow a candidate if it starts with the rest of the prefix, or if it is a part of the rest
+        of the prefix and does not complete the full token.
+        """
+        is_complete = complete_token_predicate(torch.arange(self._vocab_size, dtype=torch.long))
+        allowed_subtokens = torch.ones(len(prefix) + 1, self._vocab_size, dtype=torch.bool)
+        for position in range(len(prefix)):
+            rest = prefix[position:]
+            allowed = torch.zeros(self._vocab_size, dtype=torch.bool)
+            allowed[self.find_starting_with(rest)] = True
+            parts_of_rest = torch.tensor([subtoken for subtoken in self.find_prefixes_of(rest)
+                                          if self._subtoken_lengths[subtoken] < len(rest)], dtype=torch.long)
+            allowed[parts_of_rest] = ~is_complete[parts_of_rest]
+            allowed_subtokens[position] = allowed
+        return PrefixConstraint(allowed_subtokens.to(device), self._subtoken_lengths.to(device))
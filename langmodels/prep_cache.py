@@ -0,0 +1,120 @@
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Optional
+
+from dataclasses import dataclass
+
+from langmodels.file_util import check_path_writable
+
+logger = logging.getLogger(__name__)
+
+
+def get_prep_cache_key(text: str, *args: Any) -> str:
+    """
+    Content-addressed key of preprocessing `text` with the parameters specified by `args`:
+    extension, prep function, its params and options, the version of the preprocessing library etc.
+    Reprs of the `args` are used, so they should be deterministic.
+
+    >>> get_prep_cache_key('int i = 0;', 'java', 'bpe', ['10k']) == get_prep_cache_key('int i = 0;', 'java', 'bpe', ['10k'])
+    True
+    >>> get_prep_cache_key('int i = 0;', 'java', 'bpe', ['10k']) == get_prep_cache_key('int i = 0;', 'java', 'bpe', ['5k'])
+    False
+    """
+    hasher = hashlib.sha256(text.encode('utf-8', errors='surrogatepass'))
+    for arg in args:
+        hasher.update(b'\0')
+        hasher.update(repr(arg).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+@dataclass
+class PrepCacheStatistics(object):
+    n_memory_hits: int = 0
+    n_disk_hits: int = 0
+    n_misses: int = 0
+
+
+class PrepCache(object):
+    """
+    Cache of preprocessing results (prep tokens and, if requested, `PreprocessingMetadata`)
+    with an in-memory LRU tier and an optional on-disk tier.
+
+    Keys include the prep function with its params and options (see `get_prep_cache_key`),
+    so one cache can be shared by models, and the models with the same preprocessing share the entries.
+
+    The cached values are returned to all the callers as they are, so they must not be changed by the callers.
+    """
+    def __init__(self, max_entries_in_memory: int = 10000, path: Optional[str] = None):
+        self.max_entries_in_memory = max_entries_in_memory
+        self.path = path
+        if path is not None:
+            check_path_writable(path)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = Lock()
+        self.statistics = PrepCacheStatistics()
+
+    def _get_path_on_disk(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key)
+
+    def _put_in_memory(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries_in_memory:
+                self._entries.popitem(last=False)
+
+    def _load_from_disk(self, key: str) -> Optional[Any]:
+        path = self._get_path_on_disk(key)
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError):
+            logger.warning(f'Corrupted prep cache entry: {path}. Removing it.')
+            os.remove(path)
+            return None
+
+    def _save_to_disk(self, key: str, value: Any) -> None:
+        path = self._get_path_on_disk(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # a unique temporary file, so that threads and processes writing the same entry do not collide
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any]) -> Any:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.statistics.n_memory_hits += 1
+                return value
+        if self.path is not None:
+            value = self._load_from_disk(key)
+            if value is not None:
+                with self._lock:
+                    self.statistics.n_disk_hits += 1
+                self._put_in_memory(key, value)
+                return value
+        with self._lock:
+            self.statistics.n_misses += 1
+        value = compute()
+        self._put_in_memory(key, value)
+        if self.path is not None:
+            self._save_to_disk(key, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
@@ -1,7 +1,7 @@
 import logging
 import os
 from threading import Lock
-from typing import List
+from typing import List, Optional
 
 import requests
 
@@ -42,8 +42,9 @@ def list_pretrained_models(cached: bool = False) -> None:
     print(_get_all_models_query(cached=cached).sorted_by_entropy())
 
 
-def load_from_path(path: str, force_use_cpu: bool = False, load_description_only: bool = False) -> TrainedModel:
-    return TrainedModel(path, force_use_cpu, load_description_only)
+def load_from_path(path: str, force_use_cpu: bool = False, load_description_only: bool = False,
+                   memory_budget_mb: Optional[int] = None) -> TrainedModel:
+    return TrainedModel(path, force_use_cpu, load_description_only, memory_budget_mb)
 
 
 MODEL_DATA_FILES = [BEST_MODEL_FILE_NAME, VOCAB_FILE_NAME]
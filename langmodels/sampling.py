@@ -0,0 +1,112 @@
+import time
+from math import inf
+from typing import Callable, List, Optional
+
+import torch
+from torch import FloatTensor, LongTensor, Tensor
+from dataclasses import dataclass
+from fastai.text import SequentialRNN
+from torch.nn.functional import log_softmax
+
+from langmodels.beamsearch import _get_log_probs_of_next_subtoken
+from langmodels.nn import take_hidden_state_snapshot, restore_snapshot
+
+# returns a boolean tensor telling which of the subtokens stop the sample
+StopPredicate = Callable[[LongTensor], Tensor]
+
+
+def _restrict_to_nucleus(log_probs: FloatTensor, top_p: float) -> FloatTensor:
+    """
+    Keeps only the most probable subtokens whose total probability reaches `top_p`.
+
+    >>> _restrict_to_nucleus(torch.tensor([[0.5, 0.1, 0.3, 0.1]]).log(), 0.7).exp()
+    tensor([[0.5000, 0.0000, 0.3000, 0.0000]])
+    """
+    sorted_log_probs, sorted_indices = log_probs.sort(dim=-1, descending=True)
+    sorted_probs = sorted_log_probs.exp()
+    # a subtoken is outside of the nucleus if the more probable subtokens already cover `top_p`
+    outside_of_nucleus = sorted_probs.cumsum(dim=-1) - sorted_probs >= top_p
+    sorted_log_probs = sorted_log_probs.masked_fill(outside_of_nucleus, -inf)
+    return torch.full_like(log_probs, -inf).scatter(-1, sorted_indices, sorted_log_probs)
+
+
+@dataclass
+class SamplingResult(object):
+    # subtokens of each sample including the one which stopped it
+    subtokens: List[List[int]]
+    # log-probabilities of the samples according to the model, i.e. regardless of temperature and `top_p`
+    log_probs: List[float]
+    # False if the sample was stopped by the length limit
+    stopped_by_predicate: List[bool]
+    n_steps: int
+    elapsed_seconds: float
+
+    @property
+    def n_subtokens(self) -> int:
+        return sum(map(len, self.subtokens))
+
+    @property
+    def subtokens_per_second(self) -> float:
+        return self.n_subtokens / self.elapsed_seconds if self.elapsed_seconds > 0 else 0.0
+
+
+@torch.no_grad()
+def sample(model: SequentialRNN, context: torch.LongTensor, stop_predicate: StopPredicate,
+           n_samples: int, max_subtokens: int, temperature: float = 1.0, top_p: float = 1.0,
+           generator: Optional[torch.Generator] = None) -> SamplingResult:
+    """
+    Draws `n_samples` continuations of the context in parallel. The hidden state of the model
+    after the context is expanded to `n_samples` rows, and the rows of the samples that are stopped
+    (by `stop_predicate` or after `max_subtokens` subtokens) are dropped from the batch.
+
+    The hidden state of the model is not changed.
+
+    :param context: 1-D tensor of subtokens to be fed before the sampling starts
+    :param temperature: the logits are divided by it before sampling
+    :param top_p: nucleus sampling: only the most probable subtokens with the total probability of `top_p`
+    can be sampled at each step
+    """
+    if temperature <= 0:
+        raise ValueError(f'Temperature has to be positive: {temperature}')
+    if not 0 < top_p <= 1:
+        raise ValueError(f'Top p has to be in (0, 1]: {top_p}')
+
+    start_time = time.perf_counter()
+    device = context.device
+    subtokens = torch.empty((n_samples, max_subtokens), dtype=torch.long, device=device)
+    lengths = torch.zeros(n_samples, dtype=torch.long, device=device)
+    log_probs_of_samples = torch.zeros(n_samples, dtype=torch.float, device=device)
+    stopped_by_predicate = torch.zeros(n_samples, dtype=torch.bool, device=device)
+
+    hidden_state_snapshot = take_hidden_state_snapshot(model)
+    n_steps = 0
+    try:
+        log_probs = _get_log_probs_of_next_subtoken(model, context[None, :])
+        model[0].select_hidden(torch.zeros(n_samples, dtype=torch.long, device=device))
+        log_probs = log_probs.expand(n_samples, -1)
+        # indices of the samples which are not stopped yet, each of them has its row in the hidden state
+        pending = torch.arange(n_samples, device=device)
+        while n_steps < max_subtokens and pending.numel() > 0:
+            sampling_log_probs = log_softmax(log_probs / temperature, dim=-1) if temperature != 1.0 else log_probs
+            if top_p < 1.0:
+                sampling_log_probs = _restrict_to_nucleus(sampling_log_probs, top_p)
+            next_subtokens = torch.multinomial(sampling_log_probs.exp(), 1, generator=generator)
+
+            subtokens[pending, n_steps] = next_subtokens[:, 0]
+            lengths[pending] += 1
+            log_probs_of_samples[pending] += log_probs.gather(-1, next_subtokens)[:, 0]
+            n_steps += 1
+
+            stop = stop_predicate(next_subtokens[:, 0])
+            stopped_by_predicate[pending[stop]] = True
+            rows_to_keep = (~stop).nonzero()[:, 0]
+            pending = pending[rows_to_keep]
+            if n_steps < max_subtokens and pending.numel() > 0:
+                model[0].select_hidden(rows_to_keep)
+                log_probs = _get_log_probs_of_next_subtoken(model, next_subtokens[rows_to_keep])
+    finally:
+        restore_snapshot(model, hidden_state_snapshot)
+
+    return SamplingResult(subtokens=[row[:length] for row, length in zip(subtokens.tolist(), lengths.tolist())],
+                          log_probs=log_probs_of_samples.tolist(), stopped_by_predicate=stopped_by_predicate.tolist(),
+                          n_steps=n_steps, elapsed_seconds=time.perf_counter() - start_time)
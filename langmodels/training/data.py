@@ -1,84 +1,213 @@
 import os
+import time
 import typing
-from collections import Counter
+from collections import Counter, deque
 from concurrent.futures.process import ProcessPoolExecutor
 from dataclasses import dataclass
-from functools import reduce
+from itertools import repeat
 from pprint import pformat
 
 import logging
 
 import numpy as np
 from codeprep.util import merge_dicts_
-from fastai.basic_data import DataBunch
+from fastai.basic_data import DataBunch, DeviceDataLoader
 from fastai.core import partition_by_cores
 from fastai.data_block import PreProcessor
 from fastai.layers import FlattenedLoss, CrossEntropyFlat
 from fastai.text import LMLabelList, Vocab, TextList
 from pathlib import Path
-from typing import Sequence, Collection, List, Tuple
+from typing import Sequence, Collection, List, Tuple, Dict, Optional, Generator
 
 from tqdm import tqdm
 
 from langmodels.profiling import get_cpu_memory_used_mb
 from langmodels.tensor_ops import contains_no_value
 
+if typing.TYPE_CHECKING:
+    from langmodels.training.token_store import TokenStore
+
 
 logger = logging.getLogger(__name__)
 
 
 UNKNOWN_TOKEN_INDEX = 0
+# marks the tokens not found in the vocabulary until they are replaced with `UNKNOWN_TOKEN_INDEX`
+_NOT_IN_VOCAB = -1
+# the size of the output buffer of a worker is first estimated from the size of its files
+ESTIMATED_BYTES_PER_TOKEN = 4
+
+
+@dataclass
+class NumericalizedFiles(object):
+    """
+    Numericalized tokens of multiple files stored in one flat array:
+    tokens of the i-th file are `tokens[offsets[i]:offsets[i + 1]]`.
+    """
+    tokens: np.ndarray
+    offsets: np.ndarray
+    # unknown tokens of each file
+    unks: List[Counter]
+    elapsed_seconds: float
+
+    def split(self) -> List[np.ndarray]:
+        """
+        The arrays of the files are views of `tokens`, so no data is copied.
+        """
+        return [self.tokens[start:end] for start, end in zip(self.offsets, self.offsets[1:])]
+
+    @property
+    def tokens_per_second(self) -> float:
+        return len(self.tokens) / self.elapsed_seconds if self.elapsed_seconds > 0 else 0.0
+
+
+def _to_object_array(arrays: List[np.ndarray]) -> np.ndarray:
+    """
+    Unlike `np.array(arrays)`, never copies the arrays into one 2-d array, even if all of them have the same length.
+    """
+    result = np.empty(len(arrays), dtype=object)
+    for i, array in enumerate(arrays):
+        result[i] = array
+    return result
 
 
 class Numericalizer(PreProcessor):
+    """
+    If `token_store` is passed, the tokens of the files are not numericalized but read from the store.
+    """
     def __init__(self, vocab: Vocab, n_cpus: int = os.cpu_count(),
-                 allow_unks: bool = False, large_databunch: bool = False):
+                 allow_unks: bool = False, large_databunch: bool = False,
+                 token_store: Optional['TokenStore'] = None):
         super().__init__()
         self.vocab = vocab
         self.n_cpus = n_cpus
         self.allow_unks = allow_unks
         self.large_databunch = large_databunch
+        self.token_store = token_store
+        # `vocab.stoi` is a defaultdict, looking up a token which is not there would add it
+        self._stoi: Dict[str, int] = {token: index for index, token in enumerate(vocab.itos)}
 
-    def process_one(self, item: str):
+    def _numericalize_file(self, item: str, buffer: np.ndarray, position: int, unks: Counter) -> Tuple[np.ndarray, int]:
+        """
+        Writes the numericalized tokens of the file into `buffer` starting at `position`.
+        The vocabulary is looked up once per token, unknown tokens are found among the looked up indices.
+        If the buffer is too small, a bigger one is allocated.
+
+        :return: the buffer and the number of tokens written
+        """
         with open(item, 'r') as f:
             prep_tokens = [token for line in f for token in line.rstrip('\n').split(' ')]
-            unks = Counter()
-            for prep_token in prep_tokens:
-                if prep_token not in self.vocab.itos:
-                    if self.allow_unks:
-                        unks.update([prep_token])
-                    else:
-                        raise ValueError(f'{[prep_token]} is not present in the vocabulary.\n'
-                                         f'Vocab size is {len(self.vocab.itos)}. Vocab is {self.vocab.itos}')
-            numericalized_tokens = np.array(self.vocab.numericalize(prep_tokens), dtype=np.int64)
-            return numericalized_tokens, unks
+        n_tokens = len(prep_tokens)
+        if position + n_tokens > len(buffer):
+            new_buffer = np.empty(max(2 * len(buffer), position + n_tokens), dtype=np.int64)
+            new_buffer[:position] = buffer[:position]
+            buffer = new_buffer
+        numericalized_tokens = buffer[position:position + n_tokens]
+        numericalized_tokens[:] = np.fromiter(map(self._stoi.get, prep_tokens, repeat(_NOT_IN_VOCAB)),
+                                              dtype=np.int64, count=n_tokens)
+
+        unk_positions = np.flatnonzero(numericalized_tokens == _NOT_IN_VOCAB)
+        if len(unk_positions) > 0:
+            if not self.allow_unks:
+                raise ValueError(f'{[prep_tokens[unk_positions[0]]]} is not present in the vocabulary.\n'
+                                 f'Vocab size is {len(self.vocab.itos)}. Vocab is {self.vocab.itos}')
+            unks.update(prep_tokens[i] for i in unk_positions)
+            numericalized_tokens[unk_positions] = UNKNOWN_TOKEN_INDEX
+        return buffer, n_tokens
+
+    def process_one(self, item: str):
+        unks = Counter()
+        buffer, n_tokens = self._numericalize_file(item, np.empty(0, dtype=np.int64), 0, unks)
+        return buffer[:n_tokens], unks
 
     def process(self, ds: Collection) -> None:
         ds.vocab = self.vocab
+        if self.token_store is not None:
+            # unknown tokens are checked and reported when the store is loaded
+            ds.items = _to_object_array([self.token_store.get_tokens(item) for item in ds.items])
+            return
         tokens, unks = self._process_in_parallel(ds.items)
         ds.items = np.array(tokens)
         if self.allow_unks:
             logger.warning(f"Encountered the following unknown tokens "
                            f"{sorted(unks.items(), reverse=True, key=lambda x:x[1])}")
 
-    def _process_on_one_core(self, items: Collection[str]) -> List[Tuple[np.ndarray, typing.Mapping[str, int]]]:
-        items = tqdm(items) if self.large_databunch else items
-        return [self.process_one(item) for item in items]
+    def _process_on_one_core(self, items: Collection[str]) -> NumericalizedFiles:
+        """
+        Tokens of all the files are written into one preallocated buffer,
+        so that a worker sends back one array instead of an array per file.
+        """
+        start_time = time.perf_counter()
+        buffer = np.empty(sum(os.path.getsize(item) for item in items) // ESTIMATED_BYTES_PER_TOKEN + 1,
+                          dtype=np.int64)
+        offsets = np.zeros(len(items) + 1, dtype=np.int64)
+        unks = [Counter() for _ in items]
+        for i, item in enumerate(tqdm(items) if self.large_databunch else items):
+            buffer, n_tokens = self._numericalize_file(item, buffer, offsets[i], unks[i])
+            offsets[i + 1] = offsets[i] + n_tokens
+        # no other references to the buffer exist yet, so it can be shrunk in place
+        buffer.resize(offsets[-1], refcheck=False)
+        return NumericalizedFiles(buffer, offsets, unks, time.perf_counter() - start_time)
 
-    def _process_in_parallel(self, texts: Collection[str]) -> Tuple[List[np.ndarray], typing.Mapping[str, int]]:
+    def _log_throughput(self, worker: int, numericalized_files: NumericalizedFiles) -> None:
+        log = logger.info if self.large_databunch else logger.debug
+        log(f'Worker {worker}: numericalized {len(numericalized_files.tokens)} tokens '
+            f'from {len(numericalized_files.offsets) - 1} files in {numericalized_files.elapsed_seconds:.2f} s '
+            f'({numericalized_files.tokens_per_second:.0f} tokens/s)')
+
+    def _collect(self, from_all_cores: List[NumericalizedFiles]) -> Tuple[List[np.ndarray], List[Counter]]:
+        all_tokens, all_unks = [], []
+        for worker, numericalized_files in enumerate(from_all_cores):
+            self._log_throughput(worker, numericalized_files)
+            all_tokens.extend(numericalized_files.split())
+            all_unks.extend(numericalized_files.unks)
+        return all_tokens, all_unks
+
+    def numericalize_files(self, files: Collection[str]) -> Tuple[List[np.ndarray], List[Counter]]:
+        """
+        :return: numericalized tokens and unknown tokens of each file
+        """
         if self.n_cpus <= 1:
-            if len(texts) == 0:
-                return [[]], Counter()
-            all_tokens, unk_list = zip(*self._process_on_one_core(texts))
-            return list(all_tokens), reduce(lambda x, y: merge_dicts_(x, y)[0], unk_list, {})
+            from_all_cores = [self._process_on_one_core(files)]
+        else:
+            with ProcessPoolExecutor(self.n_cpus) as e:
+                from_all_cores = list(e.map(self._process_on_one_core, partition_by_cores(files, self.n_cpus)))
+        return self._collect(from_all_cores)
+
+    def iter_numericalized_files(self, files: Sequence[str], n_files_per_batch: int) \
+            -> Generator[Tuple[List[np.ndarray], List[Counter]], None, None]:
+        """
+        Numericalizes the files in batches of `n_files_per_batch` files and yields the numericalized tokens
+        and unknown tokens of the files of each batch, in the order of the batches.
+
+        One pool of workers is used for all the batches. The next batch is numericalized
+        while the current one is consumed, so at most two batches are kept in memory.
+        """
+        batches = [files[start:start + n_files_per_batch] for start in range(0, len(files), n_files_per_batch)]
+        if self.n_cpus <= 1:
+            for batch in batches:
+                yield self._collect([self._process_on_one_core(batch)])
+            return
+
         with ProcessPoolExecutor(self.n_cpus) as e:
-            all_tokens = []
-            all_unks = {}
-            for from_one_core in e.map(self._process_on_one_core, partition_by_cores(texts, self.n_cpus)):
-                for tokens, unks in from_one_core:
-                    all_tokens.append(tokens)
-                    merge_dicts_(all_unks, unks)
-            return all_tokens, all_unks
+            # futures of the parts of the batches which are submitted but not yielded yet
+            submitted = deque()
+            for batch in batches:
+                submitted.append([e.submit(self._process_on_one_core, part)
+                                  for part in partition_by_cores(batch, self.n_cpus)])
+                if len(submitted) > 1:
+                    yield self._collect([future.result() for future in submitted.popleft()])
+            while submitted:
+                yield self._collect([future.result() for future in submitted.popleft()])
+
+    def _process_in_parallel(self, texts: Collection[str]) -> Tuple[List[np.ndarray], typing.Mapping[str, int]]:
+        if self.n_cpus <= 1 and len(texts) == 0:
+            return [[]], Counter()
+        all_tokens, unks_per_file = self.numericalize_files(texts)
+        all_unks = {}
+        for unks in unks_per_file:
+            merge_dicts_(all_unks, unks)
+        return all_tokens, all_unks
 
 
 @dataclass
@@ -102,15 +231,23 @@ class EmptyDataBunch(object):
 
 def create_databunch(path_to_prep_dataset: str, file_paths: Sequence[Path], vocab: Vocab,
                      bs: int, bptt: int, device: str,
-                     only_validation_files: bool = False, allow_unks: bool = False, verbose: bool = True) -> DataBunch:
+                     only_validation_files: bool = False, allow_unks: bool = False, verbose: bool = True,
+                     token_store: Optional['TokenStore'] = None,
+                     valid_dl: Optional[DeviceDataLoader] = None) -> DataBunch:
+    """
+    If `valid_dl` is passed, e.g. the one of a databunch created earlier, all the files are used for training,
+    and `valid_dl` is used for validation instead of creating a new one.
+    """
     if verbose:
         logger.info(f'Getting preprocessed corpus from {path_to_prep_dataset}')
-    numericalizer = Numericalizer(vocab, allow_unks=allow_unks, large_databunch=verbose)
+    numericalizer = Numericalizer(vocab, allow_unks=allow_unks, large_databunch=verbose, token_store=token_store)
     text_list = TextList(file_paths, path=path_to_prep_dataset, processor=numericalizer)
 
     if verbose:
         logger.info("Splitting into training/validation sets")
-    if only_validation_files:
+    if valid_dl is not None:
+        split_list = text_list.split_none()
+    elif only_validation_files:
         split_list = text_list.split_by_valid_func(lambda f: True)
     else:
         split_list = text_list.split_by_folder()
@@ -126,6 +263,8 @@ def create_databunch(path_to_prep_dataset: str, file_paths: Sequence[Path], voca
     if verbose:
         logger.info("Creating data bunches")
     data_bunched = labelled_list.databunch(bs=bs, bptt=bptt, device=device)
+    if valid_dl is not None:
+        data_bunched.valid_dl = valid_dl
     return data_bunched
 
 
@@ -1,6 +1,11 @@
 import logging
 import os
+import time
+from itertools import chain
+from queue import Queue, Full, Empty
+from threading import Thread, Event, Lock
 
+from fastai.basic_data import DeviceDataLoader, DataBunch
 from fastai.basic_train import LearnerCallback, Learner
 from fastai.callback import Callback
 from fastai.text import Vocab
@@ -10,8 +15,11 @@ from typing import Any, Optional, List, Tuple
 from codeprep.api.corpus import PreprocessedCorpus
 from langmodels.file_util import get_all_files
 from langmodels.training.data import create_databunch, check_data
+from langmodels.training.token_store import TokenStore
 
 BIG_EPOCH_FILE_LIMIT = 10 * 1000
+# how often the prefetching thread waiting for a free place in the queue checks if it has to stop
+PREFETCHING_POLL_INTERVAL_SECONDS = 1.0
 
 TRAIN_SUBDIR = 'train'
 TEST_SUBDIR = 'test'
@@ -22,12 +30,26 @@ logger = logging.getLogger(__name__)
 
 
 class EpochFileLoader(LearnerCallback):
+    """
+    Loads a new portion of training files at the beginning of each sub-epoch.
+
+    If `token_store` is passed, the databunch of the next sub-epoch is prepared in a background thread
+    while the current one is trained on. At most `n_prefetched_epochs` ready databunches are kept in the queue.
+    The training files of the databunches which are still prefetched when the training ends
+    are used in the next training.
+    Without the token store, the files are numericalized by worker processes, which are not forked
+    from a background thread while the model is trained, so the databunch is prepared when the sub-epoch begins.
+    The time the training waits for the data is logged for each sub-epoch.
+    """
     def __init__(self, learner: Learner, prep_corpus: PreprocessedCorpus,
-                 vocab: Vocab, bs: int, bptt: int, device: str, n_files_per_epoch: Optional[int], allow_unks: bool):
+                 vocab: Vocab, bs: int, bptt: int, device: str, n_files_per_epoch: Optional[int], allow_unks: bool,
+                 token_store: Optional[TokenStore] = None, n_prefetched_epochs: int = 1):
         super().__init__(learner)
 
         if n_files_per_epoch is not None and n_files_per_epoch <= 0:
             raise ValueError(f'The value of n_files_per_epoch should be > 0 or None but is {n_files_per_epoch}')
+        if n_prefetched_epochs <= 0:
+            raise ValueError(f'The value of n_prefetched_epochs should be > 0 but is {n_prefetched_epochs}')
 
         self.prep_corpus = prep_corpus
         self.vocab: Vocab = vocab
@@ -36,40 +58,125 @@ class EpochFileLoader(LearnerCallback):
         self.device: str = device
         self.n_files_per_epoch = n_files_per_epoch
         self.allow_unks = allow_unks
+        self.token_store = token_store
 
         self.path_to_train_files = os.path.join(self.prep_corpus.path_to_prep_dataset, TRAIN_SUBDIR)
         self.valid_and_test_files = self._load_valid_and_test_files()
+        # the validation set does not change from sub-epoch to sub-epoch, so its data loader is created only once
+        self.valid_dl: Optional[DeviceDataLoader] = None
         self.train_files_iterator = self._reset_train_file_iterator()
 
+        self.n_prefetched_epochs = n_prefetched_epochs
+        # one databunch is built at a time, e.g. the one still being built after the previous training has ended
+        # is finished before the new training starts building its databunches
+        self._build_lock = Lock()
+        # databunches with their training files or the exception which stopped the preparation of the data,
+        # if they are prefetched
+        self._prefetched: Optional[Queue] = None
+        self._stop_prefetching: Optional[Event] = None
+
     def _reset_train_file_iterator(self):
         return get_all_files(self.path_to_train_files, None)
 
-    def _handle_empty_training_files_list(self, **kwargs):
-        if 'after_empty_epoch' in kwargs:
-            raise ValueError("Looks like your training set is empty.")
-        else:
-            self.on_epoch_begin(after_empty_epoch=True, **kwargs)
-
-    def on_epoch_begin(self, **kwargs: Any) -> None:
+    def _create_next_databunch(self) -> Tuple[DataBunch, List[Path]]:
         train_files, all_files_read = self._get_next_training_files(self.n_files_per_epoch)
         if all_files_read:
             self.train_files_iterator = self._reset_train_file_iterator()
         if len(train_files) == 0:
-            self._handle_empty_training_files_list(**kwargs)
-            return
+            # the files of the previous sub-epoch might have been the last ones
+            train_files, all_files_read = self._get_next_training_files(self.n_files_per_epoch)
+            if all_files_read:
+                self.train_files_iterator = self._reset_train_file_iterator()
+            if len(train_files) == 0:
+                raise ValueError("Looks like your training set is empty.")
         small_epoch = len(train_files) < BIG_EPOCH_FILE_LIMIT
         if self.n_files_per_epoch is not None:
             train_subfolders = {f.relative_to(self.path_to_train_files).parts[0] for f in train_files}
             logger.info(f"Using projects for training: {','.join(train_subfolders)}")
-        databunch = create_databunch(self.prep_corpus.path_to_prep_dataset, self.valid_and_test_files + train_files,
+        # once the validation data loader is created, only the training files are read
+        files = self.valid_and_test_files + train_files if self.valid_dl is None else train_files
+        databunch = create_databunch(self.prep_corpus.path_to_prep_dataset, files,
                                      self.vocab, bs=self.bs, bptt=self.bptt,
-                                     device=self.device, verbose=not small_epoch, allow_unks=self.allow_unks)
+                                     device=self.device, verbose=not small_epoch, allow_unks=self.allow_unks,
+                                     token_store=self.token_store, valid_dl=self.valid_dl)
+        self.valid_dl = databunch.valid_dl
         check_data(databunch, self.vocab, allow_unks=self.allow_unks, verbose=not small_epoch)
+        return databunch, train_files
+
+    def _return_training_files(self, prefetched: Queue, last_item: Any) -> None:
+        """
+        Puts the training files of the databunches which will not be trained on back
+        to the front of `train_files_iterator`. Has to be called with `_build_lock` held.
+        """
+        items = []
+        while True:
+            try:
+                items.append(prefetched.get_nowait())
+            except Empty:
+                break
+        items.append(last_item)
+        train_files = [file for item in items if isinstance(item, tuple) for file in item[1]]
+        self.train_files_iterator = chain(train_files, self.train_files_iterator)
+
+    def _prefetch(self, prefetched: Queue, stop_prefetching: Event) -> None:
+        """
+        Once the prefetching is stopped, the queue is not read anymore, so the thread
+        returns the training files of the databunches left in it.
+        """
+        while True:
+            with self._build_lock:
+                if stop_prefetching.is_set():
+                    self._return_training_files(prefetched, None)
+                    return
+                try:
+                    item = self._create_next_databunch()
+                except Exception as e:
+                    item = e
+            while True:
+                if stop_prefetching.is_set():
+                    with self._build_lock:
+                        self._return_training_files(prefetched, item)
+                    return
+                try:
+                    prefetched.put(item, timeout=PREFETCHING_POLL_INTERVAL_SECONDS)
+                    break
+                except Full:
+                    pass
+            if isinstance(item, Exception):
+                # the databunches prefetched before the error can still be trained on
+                stop_prefetching.wait()
+
+    def on_train_begin(self, **kwargs: Any) -> None:
+        if self.token_store is None:
+            return
+        self._prefetched = Queue(maxsize=self.n_prefetched_epochs)
+        self._stop_prefetching = Event()
+        Thread(target=self._prefetch, args=(self._prefetched, self._stop_prefetching),
+               name='EpochFileLoader', daemon=True).start()
+
+    def on_epoch_begin(self, **kwargs: Any) -> None:
+        start_time = time.perf_counter()
+        if self._prefetched is not None:
+            item = self._prefetched.get()
+            if isinstance(item, Exception):
+                raise item
+            databunch, _ = item
+        else:
+            with self._build_lock:
+                databunch, _ = self._create_next_databunch()
+        logger.info(f'Waited {time.perf_counter() - start_time:.2f} s for the data of epoch {kwargs.get("epoch")}')
         self.learn.data = databunch
         train_dl = self.learn.data.train_dl
         if isinstance(train_dl, Callback):
             train_dl.on_train_begin()
 
+    def on_train_end(self, **kwargs: Any) -> None:
+        if self._stop_prefetching is not None:
+            # the prefetching thread returns the training files of the databunches which are not trained on,
+            # including the one being built, so there is no need to wait for it
+            self._stop_prefetching.set()
+        self._prefetched, self._stop_prefetching = None, None
+
     def _load_valid_and_test_files(self) -> List[Path]:
         path_to_valid_files = os.path.join(self.prep_corpus.path_to_prep_dataset, VALID_SUBDIR)
         path_to_test_files = os.path.join(self.prep_corpus.path_to_prep_dataset, TEST_SUBDIR)
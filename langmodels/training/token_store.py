@@ -0,0 +1,287 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from collections import Counter
+from pathlib import Path
+from typing import List, Dict, Union, Optional, Tuple
+
+import numpy as np
+from dataclasses import dataclass
+from fastai.text import Vocab
+
+from langmodels.file_util import get_all_files
+from langmodels.training.data import Numericalizer
+
+logger = logging.getLogger(__name__)
+
+TOKEN_STORE_VERSION = 2
+TOKEN_STORE_DIR_SUFFIX = '_token_store'
+TOKENS_FILE_NAME = 'tokens.bin'
+SPANS_FILE_NAME = 'spans.npy'
+INDEX_FILE_NAME = 'index.json'
+
+# files are numericalized and appended to the store in batches, so that the corpus is never fully in memory;
+# the same workers numericalize all the batches
+N_FILES_PER_WRITE = 1000
+# when more than this share of the stored tokens belongs to removed or changed files, the store is rewritten
+MAX_STALE_TOKENS_SHARE = 0.5
+
+
+def get_token_dtype(vocab_size: int) -> np.dtype:
+    """
+    >>> get_token_dtype(10000)
+    dtype('uint16')
+    >>> get_token_dtype(100000)
+    dtype('int32')
+    """
+    return np.dtype(np.uint16) if vocab_size <= np.iinfo(np.uint16).max + 1 else np.dtype(np.int32)
+
+
+def get_vocab_key(vocab: Vocab) -> str:
+    return hashlib.sha256('\n'.join(vocab.itos).encode('utf-8', errors='surrogatepass')).hexdigest()[:16]
+
+
+def get_token_store_path(path_to_prep_dataset: str, vocab: Vocab) -> str:
+    """
+    The store is kept next to the prep dataset and not inside of it,
+    so that its files are not taken for the files of the corpus.
+    """
+    return os.path.join(os.path.normpath(path_to_prep_dataset) + TOKEN_STORE_DIR_SUFFIX, get_vocab_key(vocab))
+
+
+# path relative to the prep dataset, size and modification time in ns
+FileKey = Tuple[str, int, int]
+
+
+def _get_file_key(path_to_prep_dataset: str, file: Union[str, Path]) -> FileKey:
+    stat = os.stat(file)
+    return os.path.relpath(file, path_to_prep_dataset), stat.st_size, stat.st_mtime_ns
+
+
+@dataclass
+class TokenStoreStatistics(object):
+    # files whose tokens were found in the store
+    n_hits: int = 0
+    # new or changed files which were numericalized
+    n_misses: int = 0
+    # files which are not in the prep dataset anymore
+    n_removed: int = 0
+
+
+class TokenStore(object):
+    """
+    Numericalized files of a prep dataset stored in one flat binary file of compact token ids
+    and an index of the spans of the files in it.
+
+    The tokens are read through `np.memmap`: `get_tokens` returns views of the memory-mapped file,
+    so that the memory used for the corpus does not depend on its size.
+
+    The store is updated incrementally (see `update_token_store`): the tokens of new and changed files
+    are appended to the binary file, the tokens of removed and changed files are left there until the store
+    is rewritten.
+    """
+    def __init__(self, path: str, path_to_prep_dataset: str):
+        self.path = path
+        self.path_to_prep_dataset = path_to_prep_dataset
+        with open(os.path.join(path, INDEX_FILE_NAME), 'r') as f:
+            index = json.load(f)
+        if index.get('version') != TOKEN_STORE_VERSION:
+            raise ValueError(f'Token store {path} has version {index.get("version")}, '
+                             f'however version {TOKEN_STORE_VERSION} is expected')
+        self.dtype = np.dtype(index['dtype'])
+        self.file_keys: List[FileKey] = [tuple(key) for key in index['files']]
+        # unknown tokens of the files that have them
+        self.unks_per_file: Dict[str, Dict[str, int]] = index['unks']
+        self.spans = np.load(os.path.join(path, SPANS_FILE_NAME))
+        self._file_indices: Dict[str, int] = {key[0]: i for i, key in enumerate(self.file_keys)}
+        self.statistics = TokenStoreStatistics()
+        n_stored_tokens = os.path.getsize(os.path.join(path, TOKENS_FILE_NAME)) // self.dtype.itemsize
+        # a file of size 0 cannot be memory-mapped
+        self._tokens = np.memmap(os.path.join(path, TOKENS_FILE_NAME), dtype=self.dtype, mode='r',
+                                 shape=(n_stored_tokens,)) if n_stored_tokens > 0 else np.zeros(0, dtype=self.dtype)
+
+    def __len__(self) -> int:
+        return len(self.file_keys)
+
+    @property
+    def n_tokens(self) -> int:
+        return int((self.spans[:, 1] - self.spans[:, 0]).sum()) if len(self.spans) > 0 else 0
+
+    @property
+    def n_stored_tokens(self) -> int:
+        """
+        Including the tokens of the removed and changed files that are still in the binary file.
+        """
+        return len(self._tokens)
+
+    @property
+    def unks(self) -> Counter:
+        result = Counter()
+        for unks in self.unks_per_file.values():
+            result.update(unks)
+        return result
+
+    def _get_relative_path(self, file: Union[str, Path]) -> str:
+        return os.path.relpath(file, self.path_to_prep_dataset)
+
+    def __contains__(self, file: Union[str, Path]) -> bool:
+        return self._get_relative_path(file) in self._file_indices
+
+    def get_tokens(self, file: Union[str, Path]) -> np.ndarray:
+        relative_path = self._get_relative_path(file)
+        if relative_path not in self._file_indices:
+            raise ValueError(f'{file} is not in the token store {self.path}. '
+                             f'Use `load_or_build_token_store` to update the store if the prep dataset has changed.')
+        start, end = self.spans[self._file_indices[relative_path]]
+        return self._tokens[start:end]
+
+
+def _load_token_store_if_valid(path: str, path_to_prep_dataset: str) -> Optional[TokenStore]:
+    if not os.path.exists(path):
+        return None
+    try:
+        return TokenStore(path, path_to_prep_dataset)
+    except (ValueError, KeyError, OSError) as e:
+        logger.warning(f'Token store {path} cannot be used and will be rebuilt: {e}')
+        return None
+
+
+def _write_tokens(f, files: List[Path], numericalizer: Numericalizer, position: int,
+                  dtype: np.dtype) -> Tuple[np.ndarray, List[Counter]]:
+    """
+    Numericalizes the files and writes their tokens to `f` whose current end is at `position`.
+
+    :return: the spans of the files and their unknown tokens
+    """
+    spans = np.zeros((len(files), 2), dtype=np.int64)
+    all_unks = []
+    for tokens, unks in numericalizer.iter_numericalized_files(files, N_FILES_PER_WRITE):
+        for i, file_tokens in enumerate(tokens, start=len(all_unks)):
+            f.write(file_tokens.astype(dtype).tobytes())
+            spans[i] = position, position + len(file_tokens)
+            position += len(file_tokens)
+        all_unks.extend(unks)
+        logger.info(f'Numericalized {len(all_unks)} of {len(files)} files')
+    return spans, all_unks
+
+
+def _write_index(path: str, dtype: np.dtype, file_keys: List[FileKey], spans: np.ndarray,
+                 unks_per_file: Dict[str, Dict[str, int]]) -> None:
+    """
+    The index files are replaced atomically, the index is replaced last.
+    """
+    tmp_spans_path = os.path.join(path, f'{SPANS_FILE_NAME}.{os.getpid()}.tmp')
+    with open(tmp_spans_path, 'wb') as f:
+        np.save(f, spans)
+    os.replace(tmp_spans_path, os.path.join(path, SPANS_FILE_NAME))
+    tmp_index_path = os.path.join(path, f'{INDEX_FILE_NAME}.{os.getpid()}.tmp')
+    with open(tmp_index_path, 'w') as f:
+        json.dump({'version': TOKEN_STORE_VERSION, 'dtype': dtype.name, 'files': file_keys, 'unks': unks_per_file}, f)
+    os.replace(tmp_index_path, os.path.join(path, INDEX_FILE_NAME))
+
+
+def update_token_store(path: str, path_to_prep_dataset: str, files: List[Path],
+                       numericalizer: Numericalizer) -> TokenStore:
+    """
+    Makes the store at `path` contain exactly `files`. A file is numericalized only if it is not in the store yet
+    or if its size or modification time has changed since it was numericalized.
+
+    If the store does not exist, too many of its tokens are stale or its tokens file is truncated in the middle
+    of a token, a new store is written to a temporary directory, reusing the tokens of unchanged files,
+    and then replaces the old one.
+    Otherwise, the tokens of the new and changed files are appended to the existing store.
+
+    The store must not be updated by multiple processes at once.
+    """
+    dtype = get_token_dtype(len(numericalizer.vocab.itos))
+    old_store = _load_token_store_if_valid(path, path_to_prep_dataset)
+    if old_store is not None and old_store.dtype != dtype:
+        old_store = None
+    old_files = {key[0]: (key, i) for i, key in enumerate(old_store.file_keys)} if old_store is not None else {}
+
+    file_keys = [_get_file_key(path_to_prep_dataset, file) for file in files]
+    statistics = TokenStoreStatistics()
+    spans = np.zeros((len(files), 2), dtype=np.int64)
+    unks_per_file = {}
+    files_to_numericalize = []
+    for i, file_key in enumerate(file_keys):
+        old_key, old_index = old_files.get(file_key[0], (None, None))
+        if old_key == file_key:
+            statistics.n_hits += 1
+            spans[i] = old_store.spans[old_index]
+            if file_key[0] in old_store.unks_per_file:
+                unks_per_file[file_key[0]] = old_store.unks_per_file[file_key[0]]
+        else:
+            statistics.n_misses += 1
+            files_to_numericalize.append(i)
+    statistics.n_removed = len(set(old_files) - {file_key[0] for file_key in file_keys})
+
+    if old_store is not None and statistics.n_misses == 0 and statistics.n_removed == 0:
+        old_store.statistics = statistics
+        return old_store
+
+    n_live_tokens = int((spans[:, 1] - spans[:, 0]).sum())
+    # the tokens file ends with a part of a token if writing to it was interrupted,
+    # the tokens appended after it would not be aligned
+    rewrite = old_store is None or \
+        os.path.getsize(os.path.join(path, TOKENS_FILE_NAME)) % dtype.itemsize != 0 or \
+        old_store.n_stored_tokens - n_live_tokens > MAX_STALE_TOKENS_SHARE * old_store.n_stored_tokens
+    write_path = f'{path}.{os.getpid()}.tmp' if rewrite else path
+    if rewrite:
+        if os.path.exists(write_path):
+            shutil.rmtree(write_path)
+        os.makedirs(write_path)
+    with open(os.path.join(write_path, TOKENS_FILE_NAME), 'wb' if rewrite else 'ab') as f:
+        position = f.tell() // dtype.itemsize
+        if rewrite and old_store is not None:
+            # reusing the tokens of the unchanged files
+            changed = set(files_to_numericalize)
+            for i in range(len(files)):
+                if i not in changed:
+                    start, end = spans[i]
+                    f.write(old_store._tokens[start:end].tobytes())
+                    spans[i] = position, position + end - start
+                    position += end - start
+        new_spans, new_unks = _write_tokens(f, [files[i] for i in files_to_numericalize], numericalizer,
+                                            position, dtype)
+    for i, span, unks in zip(files_to_numericalize, new_spans, new_unks):
+        spans[i] = span
+        if unks:
+            unks_per_file[file_keys[i][0]] = dict(unks)
+    _write_index(write_path, dtype, file_keys, spans, unks_per_file)
+
+    if rewrite:
+        old_path = f'{path}.{os.getpid()}.old'
+        if os.path.exists(path):
+            os.replace(path, old_path)
+        os.replace(write_path, path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+    token_store = TokenStore(path, path_to_prep_dataset)
+    token_store.statistics = statistics
+    return token_store
+
+
+def load_or_build_token_store(path_to_prep_dataset: str, vocab: Vocab, allow_unks: bool = False) -> TokenStore:
+    """
+    The store is kept per prep dataset and vocabulary. Only new and changed files of the prep dataset
+    are numericalized, the numbers of files found and not found in the store are reported.
+    """
+    path = get_token_store_path(path_to_prep_dataset, vocab)
+    logger.info(f'Updating token store in {path}')
+    files = list(get_all_files(path_to_prep_dataset, None))
+    token_store = update_token_store(path, path_to_prep_dataset, files, Numericalizer(vocab, allow_unks=allow_unks))
+    statistics = token_store.statistics
+    logger.info(f'Token store contains {token_store.n_tokens} tokens of {len(token_store)} files. '
+                f'Files found in the store: {statistics.n_hits}, new or changed files numericalized: '
+                f'{statistics.n_misses}, removed files: {statistics.n_removed}')
+    unks = token_store.unks
+    if unks:
+        if not allow_unks:
+            raise ValueError(f'The token store {path} contains tokens which are not present in the vocabulary: '
+                             f'{sorted(unks)}')
+        logger.warning(f"Encountered the following unknown tokens "
+                       f"{sorted(unks.items(), reverse=True, key=lambda x: x[1])}")
+    return token_store
@@ -26,6 +26,7 @@ from langmodels.tensor_ops import mrr
 from langmodels.training.data import EmptyDataBunch, create_databunch
 from langmodels.training.schedule import ReduceLRCallback
 from langmodels.training.subepoch_files import EpochFileLoader
+from langmodels.training.token_store import load_or_build_token_store
 from langmodels.training.tracking import FirstModelTrainedCallback, LrLogger, RetryingSaveModelCalback, \
     MetricSavingCallback, report_experiment_terminated_mormally
 from langmodels.util import HOME
@@ -62,9 +63,11 @@ def run_validation(trained_model: TrainedModel, corpus: Corpus, only_validation_
 
     logger.info(f"Vocab size: {len(trained_model.vocab.itos)}")
     all_files = [f for f in get_all_files(prep_corpus.path_to_prep_dataset, None)]
+    token_store = load_or_build_token_store(prep_corpus.path_to_prep_dataset, trained_model.vocab, allow_unks=True)
     databunch = create_databunch(prep_corpus.path_to_prep_dataset, all_files, trained_model.vocab,
                                  bs=config.bs, bptt=config.bptt, device=device_id,
-                                 only_validation_files=only_validation_files, allow_unks=True)
+                                 only_validation_files=only_validation_files, allow_unks=True,
+                                 token_store=token_store)
 
     class DetupleCallback(Callback):
         def on_loss_begin(self, last_output: Tuple[torch.Tensor, torch.Tensor, torch.Tensor], **kwargs):
@@ -111,6 +114,7 @@ def train(training_config: LMTrainingConfig = LMTrainingConfig(),
     experiment_run.log_vocab(vocab)
 
     device = device_options.get_device_id()
+    token_store = load_or_build_token_store(prep_corpus.path_to_prep_dataset, vocab, allow_unks=allow_unks)
 
     config = create_custom_config(training_config)
     arch_class = training_config.arch.get_module()
@@ -122,7 +126,7 @@ def train(training_config: LMTrainingConfig = LMTrainingConfig(),
     else:
         data_bunch = create_databunch(prep_corpus.path_to_prep_dataset, get_all_files(prep_corpus.path_to_prep_dataset, None),
                                      vocab, bs=training_config.bs, bptt=training_config.bptt,
-                                     device=device, verbose=True, allow_unks=allow_unks)
+                                     device=device, verbose=True, allow_unks=allow_unks, token_store=token_store)
 
     learner = language_model_learner(data_bunch, arch_class, opt_func=training.optimizer.get_callable(),
                                      drop_mult=dropout_multiplier,
@@ -137,7 +141,8 @@ def train(training_config: LMTrainingConfig = LMTrainingConfig(),
         files_per_epoch = training_config.training.sub_epochs.n_files
         learner.callbacks.append(EpochFileLoader(learner, prep_corpus, vocab,
                                                  bs=training_config.bs, bptt=training_config.bptt, device=device,
-                                                 n_files_per_epoch=files_per_epoch, allow_unks=allow_unks))
+                                                 n_files_per_epoch=files_per_epoch, allow_unks=allow_unks,
+                                                 token_store=token_store))
 
 
     add_callbacks(experiment_run, learner, vocab, tune, save_every_epoch=save_every_epoch)
@@ -89,6 +89,26 @@ def split_list_into_nested_chunks(lst: List,
     return chunks
 
 
+ROLLING_HASH_BASE = 1_000_003
+ROLLING_HASH_MODULUS = 2 ** 61 - 1
+
+
+def get_prefix_hashes(lst: List[int]) -> List[int]:
+    """
+    Returns polynomial rolling hashes of all the prefixes of the list, the i-th hash is the hash of `lst[:i]`.
+
+    >>> hashes = get_prefix_hashes([5, 7, 5])
+    >>> len(hashes)
+    4
+    >>> hashes[2] == get_prefix_hashes([5, 7, 9])[2]
+    True
+    >>> hashes[2] == get_prefix_hashes([7, 5])[2]
+    False
+    """
+    hashes = [0]
+    for element in lst:
+        hashes.append((hashes[-1] * ROLLING_HASH_BASE + element + 1) % ROLLING_HASH_MODULUS)
+    return hashes
 
 
 HOME = os.environ['HOME']
\ No newline at end of file
@@ -2,7 +2,7 @@ from unittest.mock import Mock
 
 from codeprep.tokens.containers import SplitContainer, OneLineComment
 from langmodels.evaluation.customization import TokenTypeSubset
-from langmodels.evaluation.metrics import bin_entropy, mrr
+from langmodels.evaluation.metrics import bin_entropy, mrr, DEFAULT_N_MODEL_SUGGESTIONS
 from langmodels.evaluation.definitions import EvaluationResult
 from langmodels.model import TrainedModel
 
@@ -110,3 +110,7 @@ def test_mrr_default_all_token_types():
 
     assert sorted(actual, key=lambda s: str(s)) == sorted(expected, key=lambda s: str(s))
 
+
+
+def test_planned_beam_fits_suggestions_requested_by_evaluation():
+    assert TrainedModel.MIN_PLANNED_BEAM_SIZE >= DEFAULT_N_MODEL_SUGGESTIONS
@@ -0,0 +1,154 @@
+import os
+import time
+from concurrent.futures.thread import ThreadPoolExecutor
+
+import pytest
+import torch
+
+from langmodels import project_dir
+from langmodels.cancellation import CancellationToken, OperationCancelled
+from langmodels.repository import load_from_path
+
+PATH_TO_MODEL = os.path.join(project_dir, 'data/models/dev_10k_1_10_190923.132328')
+
+
+def test_sessions_do_not_share_state():
+    trained_model = load_from_path(PATH_TO_MODEL)
+    expected_first = trained_model.new_session()
+    expected_first.feed_text('public static void', extension='java')
+    expected_first_predictions = expected_first.predict_next_full_token(n_suggestions=5)
+    expected_second = trained_model.new_session()
+    expected_second.feed_text('int i =', extension='java')
+    expected_second_predictions = expected_second.predict_next_full_token(n_suggestions=5)
+
+    first_session = trained_model.new_session()
+    second_session = trained_model.new_session()
+    first_session.feed_text('public static', extension='java')
+    second_session.feed_text('int i', extension='java')
+    first_session.feed_text('void', extension='java')
+    second_session.feed_text('=', extension='java')
+
+    assert first_session.predict_next_full_token(n_suggestions=5) == expected_first_predictions
+    assert second_session.predict_next_full_token(n_suggestions=5) == expected_second_predictions
+    assert trained_model.context == []
+
+
+def test_sessions_in_multiple_threads():
+    trained_model = load_from_path(PATH_TO_MODEL)
+    texts = ['public static void', 'int i =', 'return', 'import java.']
+
+    def predict(text: str):
+        session = trained_model.new_session()
+        session.feed_text(text, extension='java')
+        return session.predict_next_full_token(n_suggestions=3)
+
+    expected = [predict(text) for text in texts]
+    with ThreadPoolExecutor(len(texts)) as executor:
+        actual = list(executor.map(predict, texts))
+
+    assert actual == expected
+
+
+def test_cancelled_request_does_not_change_session_state():
+    trained_model = load_from_path(PATH_TO_MODEL)
+    session = trained_model.new_session()
+    session.feed_text('public static', extension='java')
+    expected_predictions = session.predict_next_full_token(n_suggestions=5)
+    cancellation_token = CancellationToken()
+    cancellation_token.cancel()
+
+    with pytest.raises(OperationCancelled):
+        session.get_entropies_for_text('void main', extension='java', full_tokens=True,
+                                       append_eof=False, max_context_allowed=1000,
+                                       cancellation_token=cancellation_token)
+    with pytest.raises(OperationCancelled):
+        session.predict_next_full_token(n_suggestions=5, cancellation_token=cancellation_token)
+
+    assert session.predict_next_full_token(n_suggestions=5) == expected_predictions
+
+
+def test_time_spent_waiting_for_model_counts_against_time_budget():
+    trained_model = load_from_path(PATH_TO_MODEL)
+    session = trained_model.new_session()
+    session.feed_text('public static', extension='java')
+
+    def predict():
+        return session.predict_next_full_token(n_suggestions=5, max_prob=0.0, time_budget_ms=50, return_result=True)
+
+    with ThreadPoolExecutor(1) as executor:
+        with trained_model._lock:
+            future = executor.submit(predict)
+            time.sleep(0.2)
+        result = future.result()
+
+    assert result.truncated
+    assert not session.predict_next_full_token(n_suggestions=5, max_prob=0.0, return_result=True).truncated
+
+
+def test_reset_to_text_same_as_feeding_text_from_scratch():
+    trained_model = load_from_path(PATH_TO_MODEL)
+    text = 'public class Main {\n    public static void main(String[] args) {\n        int i ='
+    expected_session = trained_model.new_session()
+    expected_session.feed_text(text, extension='java')
+    expected_predictions = expected_session.predict_next_full_token(n_suggestions=5)
+
+    session = trained_model.new_session()
+    session.reset_to_text(text[:text.rindex('{') + 1], extension='java')
+    session.reset_to_text(text, extension='java')
+
+    assert session.predict_next_full_token(n_suggestions=5) == expected_predictions
+    assert session.context == expected_session.context
+    assert trained_model.hidden_state_cache.statistics.n_hits == 1
+
+
+def test_predicted_next_subtokens_same_for_single_and_batched_sessions():
+    trained_model = load_from_path(PATH_TO_MODEL)
+    sessions = [trained_model.new_session() for _ in range(3)]
+    sessions[0].feed_text('public static void', extension='java')
+    sessions[1].feed_text('int i =', extension='java')
+
+    expected = [session.predict_next_subtokens(k=5) for session in sessions]
+    actual = trained_model.predict_next_subtokens_for_sessions(sessions, k=5)
+
+    for expected_predictions, actual_predictions in zip(expected, actual):
+        assert len(expected_predictions) == 5
+        assert [p[:2] for p in expected_predictions] == [p[:2] for p in actual_predictions]
+        assert [p[2] for p in expected_predictions] == pytest.approx([p[2] for p in actual_predictions], abs=1e-5)
+    # the state of the sessions is not changed
+    assert sessions[0].predict_next_subtokens(k=5) == expected[0]
+
+
+def test_generation_does_not_change_session_state():
+    trained_model = load_from_path(PATH_TO_MODEL)
+    session = trained_model.new_session()
+    session.feed_text('public static void main(String[] args) {', extension='java')
+    expected_predictions = session.predict_next_full_token(n_suggestions=5)
+
+    result = session.generate(n_samples=20, max_subtokens=30, temperature=0.8, top_p=0.9,
+                              generator=torch.Generator().manual_seed(0))
+
+    assert len(result.continuations) == len(result.log_probs) == 20
+    for continuation in result.continuations:
+        assert '<EOL>' not in continuation[:-1]
+    assert result.n_subtokens <= 20 * 30
+    assert session.predict_next_full_token(n_suggestions=5) == expected_predictions
+
+
+def test_request_started_while_streaming_entropies_cancels_stream():
+    trained_model = load_from_path(PATH_TO_MODEL)
+    session = trained_model.new_session()
+    text = 'public class MyClass {\n    int myVariable = 0;\n}'
+    stream = session.iter_entropies_for_text(text, extension='java', full_tokens=True,
+                                             append_eof=True, max_context_allowed=5)
+    next(stream)
+
+    with ThreadPoolExecutor(2) as executor:
+        with trained_model._lock:
+            prediction_future = executor.submit(session.predict_next_full_token, n_suggestions=5)
+            time.sleep(0.1)
+            stream_future = executor.submit(list, stream)
+            time.sleep(0.1)
+
+        assert len(prediction_future.result()) > 0
+        with pytest.raises(OperationCancelled):
+            stream_future.result()
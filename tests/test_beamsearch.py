@@ -1,10 +1,114 @@
+import math
 import os
+from heapq import heappush, heappop
+from typing import List, Tuple, Callable
 
+import pytest
 import torch
+from torch import nn
+from torch.nn.functional import one_hot, log_softmax
 
 from langmodels import project_dir
+from langmodels.beamsearch import beam_search, batched_beam_search, BeamSearchStatistics, _Beam
+from langmodels.cancellation import CancellationToken, OperationCancelled
+from langmodels.prefix import SubtokenTrie
 from langmodels.repository import load_from_path
 
+VOCAB_SIZE = 6
+FIRST_NON_TERM = 2
+
+
+class BigramEncoder(nn.Module):
+    """
+    Outputs one-hot encodings of the input tokens,
+    so that the next-token distribution depends only on the last token.
+    """
+    def __init__(self):
+        super().__init__()
+        self.bs = 1
+        self.reset()
+
+    def forward(self, input: torch.Tensor):
+        outputs = one_hot(input, VOCAB_SIZE).float()
+        self.hidden = [h + input.size(1) for h in self.hidden]
+        return [outputs], [outputs]
+
+    def reset(self):
+        self.hidden = [torch.zeros(1, self.bs, 1)]
+
+    def select_hidden(self, idxs):
+        self.hidden = [h[:, idxs, :] for h in self.hidden]
+        self.bs = len(idxs)
+
+
+class BigramDecoder(nn.Module):
+    def __init__(self, log_probs: torch.Tensor):
+        super().__init__()
+        self.decoder = nn.Linear(VOCAB_SIZE, VOCAB_SIZE, bias=False)
+        self.decoder.weight.data = log_probs.t().contiguous()
+        self.output_dp = nn.Identity()
+
+
+def create_bigram_model(seed: int) -> Tuple[nn.Module, torch.Tensor]:
+    generator = torch.Generator().manual_seed(seed)
+    log_probs = log_softmax(torch.randn(VOCAB_SIZE, VOCAB_SIZE, generator=generator), dim=-1)
+    return nn.Sequential(BigramEncoder(), BigramDecoder(log_probs)), log_probs
+
+
+def exact_top_k(log_probs: torch.Tensor, last_token: int, top_k: int,
+                accept: Callable[[List[int]], bool] = lambda sequence: True) -> List[Tuple[List[int], float]]:
+    heap = [(0.0, [])]
+    result = []
+    while len(result) < top_k:
+        score, sequence = heappop(heap)
+        if sequence and sequence[-1] < FIRST_NON_TERM:
+            if accept(sequence):
+                result.append((sequence, score))
+            continue
+        previous = sequence[-1] if sequence else last_token
+        for token in range(VOCAB_SIZE):
+            heappush(heap, (score - log_probs[previous, token].item(), sequence + [token]))
+    return result
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_beam_step_keeps_best_candidates_even_if_they_continue_one_candidate(seed):
+    generator = torch.Generator().manual_seed(seed)
+    beam = _Beam(beam_size=4, top_k=2, complete_token_predicate=lambda t: t < FIRST_NON_TERM, device='cpu')
+    beam.step(log_softmax(torch.randn(1, VOCAB_SIZE, generator=generator), dim=-1))
+    # the worst pending candidate has the most probable continuations
+    log_probs = log_softmax(torch.randn(beam.n_pending(), VOCAB_SIZE, generator=generator), dim=-1)
+    log_probs[beam.pending_scores.argmax()] = torch.tensor([-10.] * (VOCAB_SIZE - 4) + [-1.4] * 4)
+    all_scores = torch.cat([beam.finished_scores, (beam.pending_scores[:, None] - log_probs).view(-1)])
+
+    beam.step(log_probs)
+
+    expected = all_scores.sort().values[:4]
+    actual = torch.cat([beam.finished_scores, beam.pending_scores]).sort().values
+    assert actual.tolist() == pytest.approx(expected.tolist())
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_beam_search_finds_most_probable_full_tokens(seed):
+    model, log_probs = create_bigram_model(seed)
+
+    result = beam_search(model, torch.tensor([3]), lambda t: t < FIRST_NON_TERM, top_k=4, beam_size=100)
+
+    expected = exact_top_k(log_probs, 3, top_k=4)
+    assert result.subtokens == [sequence for sequence, _ in expected]
+    assert result.scores == pytest.approx([score for _, score in expected], abs=1e-4)
+
+
+def test_beam_search_does_not_change_hidden_state():
+    model, _ = create_bigram_model(0)
+    model[0](torch.tensor([[2, 3]]))
+    before = [h.clone() for h in model[0].hidden]
+
+    beam_search(model, torch.tensor([3]), lambda t: t < FIRST_NON_TERM, top_k=2, beam_size=10)
+
+    for b, a in zip(before, model[0].hidden):
+        assert torch.equal(b, a)
+
 
 def test_hidden_state_not_changed_after_beam_search():
     trained_model = load_from_path(os.path.join(project_dir, 'data/models/dev_10k_1_10_190923.132328'))
@@ -15,4 +119,102 @@ def test_hidden_state_not_changed_after_beam_search():
 
     for aa,bb in zip(after, before):
         for a, b in zip(aa, bb):
-            assert torch.equal(b, a)
\ No newline at end of file
+            assert torch.equal(b, a)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_beam_search_with_prob_threshold_finds_all_probable_full_tokens(seed):
+    model, log_probs = create_bigram_model(seed)
+    max_prob = 0.05
+
+    result = beam_search(model, torch.tensor([3]), lambda t: t < FIRST_NON_TERM, top_k=4, beam_size=100,
+                         max_prob=max_prob)
+
+    expected = [(sequence, score) for sequence, score in exact_top_k(log_probs, 3, top_k=4)
+                if math.exp(-score) >= max_prob]
+    assert result.subtokens[:len(expected)] == [sequence for sequence, _ in expected]
+    assert result.scores[:len(expected)] == pytest.approx([score for _, score in expected], abs=1e-4)
+
+
+def test_beam_search_stops_when_no_candidate_can_reach_prob_threshold():
+    model, _ = create_bigram_model(0)
+
+    result = beam_search(model, torch.tensor([3]), lambda t: t < FIRST_NON_TERM, top_k=4, beam_size=100,
+                         max_prob=1.0)
+
+    assert result.n_steps == 1
+    assert result.stopped_by_prob_threshold
+    assert all(len(sequence) == 1 for sequence in result.subtokens)
+
+
+def test_batched_beam_search_same_as_for_single_contexts():
+    model, _ = create_bigram_model(0)
+    last_tokens = [2, 3, 4, 5]
+    expected = [beam_search(model, torch.tensor([token]), lambda t: t < FIRST_NON_TERM, top_k=3, beam_size=10)
+                for token in last_tokens]
+
+    model[0].bs = len(last_tokens)
+    model[0].reset()
+    actual = batched_beam_search(model, torch.tensor(last_tokens)[:, None], lambda t: t < FIRST_NON_TERM,
+                                 top_k=3, beam_size=10)
+
+    assert [r.subtokens for r in actual] == [r.subtokens for r in expected]
+    for a, e in zip(actual, expected):
+        assert a.scores == pytest.approx(e.scores, abs=1e-5)
+    assert model[0].bs == len(last_tokens)
+
+
+def test_beam_search_returns_candidates_found_so_far_when_time_budget_runs_out():
+    model, log_probs = create_bigram_model(0)
+
+    result = beam_search(model, torch.tensor([3]), lambda t: t < FIRST_NON_TERM, top_k=4, beam_size=100,
+                         time_budget_ms=0)
+
+    assert result.truncated
+    assert result.n_steps == 1
+    assert all(len(sequence) == 1 and sequence[0] < FIRST_NON_TERM for sequence in result.subtokens)
+
+
+def test_truncated_searches_are_reported_to_hooks():
+    model, _ = create_bigram_model(0)
+    statistics = BeamSearchStatistics()
+    reported = []
+    statistics.hooks.append(reported.append)
+
+    statistics.record(beam_search(model, torch.tensor([3]), lambda t: t < FIRST_NON_TERM, top_k=4, beam_size=100,
+                                  time_budget_ms=0))
+    statistics.record(beam_search(model, torch.tensor([3]), lambda t: t < FIRST_NON_TERM, top_k=4, beam_size=100))
+
+    assert statistics.n_truncated == 1
+    assert [result.truncated for result in reported] == [True, False]
+
+
+def test_cancelled_beam_search_restores_hidden_state():
+    model, _ = create_bigram_model(0)
+    model[0](torch.tensor([[2, 3]]))
+    before = [h.clone() for h in model[0].hidden]
+    cancellation_token = CancellationToken()
+    cancellation_token.cancel()
+
+    with pytest.raises(OperationCancelled):
+        beam_search(model, torch.tensor([3]), lambda t: t < FIRST_NON_TERM, top_k=4, beam_size=100,
+                    cancellation_token=cancellation_token)
+
+    for b, a in zip(before, model[0].hidden):
+        assert torch.equal(b, a)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_beam_search_finds_most_probable_full_tokens_starting_with_prefix(seed):
+    model, log_probs = create_bigram_model(seed)
+    texts = ['ab', 'c', 'a', 'b', 'ca', 'bb']
+    prefix = 'abc'
+    prefix_constraint = SubtokenTrie(texts).create_prefix_constraint(prefix, lambda t: t < FIRST_NON_TERM, 'cpu')
+
+    result = beam_search(model, torch.tensor([3]), lambda t: t < FIRST_NON_TERM, top_k=3, beam_size=100,
+                         prefix_constraint=prefix_constraint)
+
+    expected = exact_top_k(log_probs, 3, top_k=3,
+                           accept=lambda sequence: ''.join(texts[s] for s in sequence).startswith(prefix))
+    assert result.subtokens == [sequence for sequence, _ in expected]
+    assert result.scores == pytest.approx([score for _, score in expected], abs=1e-4)
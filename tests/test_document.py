@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+from langmodels import project_dir
+from langmodels.document import ScoredDocument
+from langmodels.repository import load_from_path
+
+PATH_TO_MODEL = os.path.join(project_dir, 'data/models/dev_10k_1_10_190923.132328')
+
+TEXT = '''public class Main {
+    public static void main(String[] args) {
+        int i = 0;
+        System.out.println(i);
+    }
+}
+'''
+
+
+def test_entropies_after_edit_same_as_for_text_scored_from_scratch():
+    trained_model = load_from_path(PATH_TO_MODEL)
+    edited_text = TEXT.replace('println(i)', 'println(i + 1)')
+    document = ScoredDocument(trained_model, 'java', checkpoint_every=8)
+    document.update(TEXT)
+
+    document.update(edited_text)
+
+    trained_model.reset()
+    expected = trained_model.get_entropies_for_text(edited_text, 'java', full_tokens=False,
+                                                    append_eof=False, max_context_allowed=10000)
+    actual = document.get_entropies(full_tokens=False)
+    assert actual[0] == pytest.approx(expected[0], abs=1e-4)
+    assert actual[1:3] == expected[1:3]
+    assert document.n_rescored_subtokens < len(document.prep_tokens)
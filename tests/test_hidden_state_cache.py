@@ -0,0 +1,57 @@
+import torch
+
+from langmodels.hidden_state_cache import HiddenStateCache
+from langmodels.util import get_prefix_hashes
+
+
+def snapshot(value: float):
+    # one layer of LSTM with 2 hidden units: 2 * 2 * 4 bytes
+    return [(torch.full((1, 1, 2), value), torch.full((1, 1, 2), value))]
+
+
+def test_longest_cached_prefix_is_found():
+    cache = HiddenStateCache(max_bytes=1000)
+    hashes = get_prefix_hashes([4, 8, 15, 16, 23])
+    cache.put(2, hashes[2], snapshot(2.))
+    cache.put(4, hashes[4], snapshot(4.))
+
+    length, found = cache.find_longest_prefix(get_prefix_hashes([4, 8, 15, 16, 42]))
+
+    assert length == 4
+    assert torch.equal(found[0][0], snapshot(4.)[0][0])
+    assert cache.find_longest_prefix(get_prefix_hashes([42, 8])) == (0, None)
+    assert cache.statistics.hit_rate == 0.5
+
+
+def test_least_recently_used_snapshots_are_evicted():
+    cache = HiddenStateCache(max_bytes=32)
+    hashes = get_prefix_hashes([1, 2, 3])
+    cache.put(1, hashes[1], snapshot(1.))
+    cache.put(2, hashes[2], snapshot(2.))
+    cache.find_longest_prefix(hashes[:2])
+
+    cache.put(3, hashes[3], snapshot(3.))
+
+    assert len(cache) == 2
+    assert cache.n_bytes == 32
+    assert cache.statistics.n_evicted_bytes == 16
+    assert cache.find_longest_prefix(hashes[:3])[0] == 1
+
+
+def test_only_checkpoints_and_cached_lengths_between_them_are_looked_up():
+    cache = HiddenStateCache(max_bytes=1000, checkpoint_every=4)
+    hashes = get_prefix_hashes(list(range(11)))
+    cache.put(4, hashes[4], snapshot(4.))
+    cache.put(6, hashes[6], snapshot(6.))
+    looked_up_lengths = []
+
+    class RecordingHashes(list):
+        def __getitem__(self, index):
+            looked_up_lengths.append(index)
+            return super().__getitem__(index)
+
+    length, _ = cache.find_longest_prefix(RecordingHashes(hashes))
+
+    assert length == 6
+    assert looked_up_lengths == [8, 6]
+    assert cache.find_longest_prefix(hashes[:6])[0] == 4
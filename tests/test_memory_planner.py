@@ -0,0 +1,39 @@
+import pytest
+
+from langmodels.memory_planner import MemoryFootprint, plan_inference, N_BEAM_SELECTION_BYTES_PER_ROW
+
+
+FOOTPRINT = MemoryFootprint(n_parameter_bytes=10 ** 7, n_hidden_state_bytes=10 ** 3,
+                            n_encoder_bytes_per_position=10 ** 4, n_decoder_bytes_per_position=10 ** 5)
+
+
+def test_bigger_budget_gives_bigger_sizes():
+    small = plan_inference(FOOTPRINT, memory_budget_bytes=2 * 10 ** 7, n_used_bytes=10 ** 7)
+    big = plan_inference(FOOTPRINT, memory_budget_bytes=2 * 10 ** 8, n_used_bytes=10 ** 7)
+
+    assert small.max_subtokens_per_chunk < big.max_subtokens_per_chunk
+    assert small.decoder_block_size < big.decoder_block_size
+    assert small.batch_size <= big.batch_size
+    assert small.beam_size < big.beam_size
+
+
+def test_planned_sizes_fit_into_budget():
+    available = 2 * 10 ** 7
+    plan = plan_inference(FOOTPRINT, memory_budget_bytes=available + 10 ** 7, n_used_bytes=10 ** 7)
+
+    entropy_path_bytes = plan.batch_size * (plan.max_subtokens_per_chunk * FOOTPRINT.n_encoder_bytes_per_position
+                                            + FOOTPRINT.n_hidden_state_bytes) \
+        + plan.decoder_block_size * FOOTPRINT.n_decoder_bytes_per_position
+    beam_search_bytes = plan.beam_size * (2 * FOOTPRINT.n_hidden_state_bytes + FOOTPRINT.n_decoder_bytes_per_position
+                                          + N_BEAM_SELECTION_BYTES_PER_ROW)
+    assert entropy_path_bytes <= available
+    assert beam_search_bytes <= available
+
+
+def test_beam_is_not_narrower_than_min_beam_size():
+    plan = plan_inference(FOOTPRINT, memory_budget_bytes=2 * 10 ** 7, n_used_bytes=10 ** 7, min_beam_size=50)
+
+    assert plan.beam_size >= 50
+
+    with pytest.raises(ValueError):
+        plan_inference(FOOTPRINT, memory_budget_bytes=2 * 10 ** 7, n_used_bytes=10 ** 7, min_beam_size=200)
@@ -1,7 +1,13 @@
+import os
+
+import numpy as np
+import pytest
 from codeprep.preprocess.placeholders import placeholders
 from fastai.text import Vocab
 
-from langmodels.model import _create_term_vocab
+from langmodels import project_dir
+from langmodels.model import _create_term_vocab, NO_CONTEXT_LENGTH
+from langmodels.repository import load_from_path
 
 cpe = placeholders['compound_word_end']
 
@@ -44,3 +50,141 @@ def test_only_non_terminals():
 
     assert expected_itos == actual_vocab.itos
     assert 0 == actual_first_non_term_index
+
+
+@pytest.mark.parametrize('max_context_allowed', [7, 1200])
+def test_batched_entropies_same_as_for_single_texts(max_context_allowed):
+    trained_model = load_from_path(os.path.join(project_dir, 'data/models/dev_10k_1_10_190923.132328'))
+    # the last text is longer than the context saved by the model
+    texts = ['public class MyClass {', '', 'int i = 0;\nreturn i;', 'public', 'int myVariable = i + 1;\n' * 200]
+
+    actual = trained_model.get_entropies_for_texts(texts, extension='java', full_tokens=True,
+                                                   append_eof=False, max_context_allowed=max_context_allowed,
+                                                   token_type_filter=lambda t: t.__name__ != 'OneLineComment',
+                                                   batch_size=3)
+
+    for text, (entropies, tokens, token_types, context_lengths) in zip(texts, actual):
+        trained_model.reset()
+        expected_entropies, expected_tokens, expected_token_types, expected_context_lengths = \
+            trained_model.get_entropies_for_text(text, extension='java', full_tokens=True,
+                                                 append_eof=False, max_context_allowed=max_context_allowed,
+                                                 token_type_filter=lambda t: t.__name__ != 'OneLineComment')
+        assert expected_entropies == pytest.approx(entropies, abs=1e-4)
+        assert expected_tokens == tokens
+        assert expected_token_types == token_types
+        assert expected_context_lengths == context_lengths
+
+
+def test_entropies_calculated_only_for_filtered_token_types():
+    trained_model = load_from_path(os.path.join(project_dir, 'data/models/dev_10k_1_10_190923.132328'))
+    text = 'public class MyClass { // my comment'
+
+    expected_entropies, expected_tokens, expected_token_types, _ = \
+        trained_model.get_entropies_for_text(text, extension='java', full_tokens=True, append_eof=False,
+                                             max_context_allowed=1000)
+    trained_model.reset()
+    actual_entropies, actual_tokens, actual_token_types, _ = \
+        trained_model.get_entropies_for_text(text, extension='java', full_tokens=True, append_eof=False,
+                                             max_context_allowed=1000,
+                                             token_type_filter=lambda t: t.__name__ == 'SplitContainer')
+
+    assert expected_tokens == actual_tokens
+    assert expected_token_types == actual_token_types
+    for expected, actual, token_type in zip(expected_entropies, actual_entropies, actual_token_types):
+        if token_type.__name__ == 'SplitContainer':
+            assert expected == pytest.approx(actual, abs=1e-4)
+        else:
+            assert actual is None
+
+
+def test_entropies_for_preprocessed_text_same_as_for_raw_text():
+    trained_model = load_from_path(os.path.join(project_dir, 'data/models/dev_10k_1_10_190923.132328'))
+    text = 'public class MyClass {'
+    prep_tokens, metadata = trained_model.prep_text(text, extension='java', return_metadata=True)
+
+    expected = trained_model.get_entropies_for_text(text, extension='java', full_tokens=True,
+                                                    append_eof=False, max_context_allowed=1000)
+    trained_model.reset()
+    actual = trained_model.get_entropies_for_text((prep_tokens, metadata), extension='java', full_tokens=True,
+                                                  append_eof=False, max_context_allowed=1000)
+    trained_model.reset()
+    numericalized = trained_model.vocab.numericalize(prep_tokens)
+    actual_numericalized = trained_model.get_entropies_for_text((numericalized, metadata), extension='java',
+                                                                full_tokens=True, append_eof=False,
+                                                                max_context_allowed=1000)
+
+    assert actual == expected
+    assert actual_numericalized == expected
+
+
+
+def test_entropies_for_numericalized_texts_same_as_for_raw_texts():
+    trained_model = load_from_path(os.path.join(project_dir, 'data/models/dev_10k_1_10_190923.132328'))
+    texts = ['public class MyClass {', 'int myVariable = 0;']
+    numericalized_texts = []
+    for text in texts:
+        prep_tokens, metadata = trained_model.prep_text(text, extension='java', return_metadata=True)
+        numericalized_texts.append((np.array(trained_model.vocab.numericalize(prep_tokens)), metadata))
+
+    expected = trained_model.get_entropies_for_texts(texts, extension='java', full_tokens=True,
+                                                     append_eof=False, max_context_allowed=1000)
+    actual = trained_model.get_entropies_for_texts(numericalized_texts, extension='java', full_tokens=True,
+                                                   append_eof=False, max_context_allowed=1000)
+    actual_streamed = list(trained_model.iter_entropies_for_text(numericalized_texts[0], extension='java',
+                                                                 full_tokens=True, append_eof=False,
+                                                                 max_context_allowed=1000))
+
+    assert actual == expected
+    assert [entropy for entropy, _, _, _ in actual_streamed] == pytest.approx(expected[0][0], abs=1e-4)
+    assert [rest for _, *rest in actual_streamed] == [list(rest) for rest in zip(*expected[0][1:])]
+
+def test_feeding_preprocessed_text_same_as_feeding_raw_text():
+    trained_model = load_from_path(os.path.join(project_dir, 'data/models/dev_10k_1_10_190923.132328'))
+    text = 'public class MyClass {'
+    prep_tokens = trained_model.prep_text(text, extension='java')
+    numericalized = trained_model.vocab.numericalize(prep_tokens)
+    expected_session = trained_model.new_session()
+    expected_session.feed_text(text, extension='java')
+    expected_predictions = expected_session.predict_next_full_token(n_suggestions=5)
+
+    for prep_text in [prep_tokens, tuple(prep_tokens), numericalized, tuple(numericalized), np.array(numericalized)]:
+        session = trained_model.new_session()
+        session.feed_text(prep_text, extension='java')
+
+        assert session.predict_next_full_token(n_suggestions=5) == expected_predictions
+        assert session.context == expected_session.context
+
+
+def test_streamed_entropies_same_as_returned_at_once():
+    trained_model = load_from_path(os.path.join(project_dir, 'data/models/dev_10k_1_10_190923.132328'))
+    text = 'public class MyClass {\n    int myVariable = 0;\n}'
+
+    expected = trained_model.get_entropies_for_text(text, extension='java', full_tokens=True,
+                                                    append_eof=True, max_context_allowed=5)
+    trained_model.reset()
+    actual = list(trained_model.iter_entropies_for_text(text, extension='java', full_tokens=True,
+                                                        append_eof=True, max_context_allowed=5))
+
+    assert [entropy for entropy, _, _, _ in actual] == pytest.approx(expected[0], abs=1e-4)
+    assert [rest for _, *rest in actual] == [list(rest) for rest in zip(*expected[1:])]
+
+
+def test_entropies_as_arrays_same_as_lists():
+    trained_model = load_from_path(os.path.join(project_dir, 'data/models/dev_10k_1_10_190923.132328'))
+    text = 'public class MyClass { // my comment'
+
+    expected_entropies, expected_tokens, expected_token_types, expected_context_lengths = \
+        trained_model.get_entropies_for_text(text, extension='java', full_tokens=True, append_eof=False,
+                                             max_context_allowed=1000,
+                                             token_type_filter=lambda t: t.__name__ == 'SplitContainer')
+    trained_model.reset()
+    entropies, tokens, token_types, context_lengths = \
+        trained_model.get_entropies_for_text(text, extension='java', full_tokens=True, append_eof=False,
+                                             max_context_allowed=1000,
+                                             token_type_filter=lambda t: t.__name__ == 'SplitContainer',
+                                             as_arrays=True)
+
+    assert [None if np.isnan(entropy) else entropy for entropy in entropies] == expected_entropies
+    assert tokens == expected_tokens
+    assert token_types == expected_token_types
+    assert [None if length == NO_CONTEXT_LENGTH else length for length in context_lengths] == expected_context_lengths
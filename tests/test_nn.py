@@ -0,0 +1,44 @@
+import os
+
+import torch
+import torch.nn.functional as F
+
+from langmodels import project_dir
+from langmodels.nn import feed_to_encoder, get_last_layer_activations, take_hidden_state_snapshot, restore_snapshot, \
+    get_encoder_outputs, get_target_losses
+from langmodels.repository import load_from_path
+
+
+def test_feeding_to_encoder_changes_hidden_state_as_full_model():
+    trained_model = load_from_path(os.path.join(project_dir, 'data/models/dev_10k_1_10_190923.132328'))
+    model = trained_model.model
+    input = torch.tensor([trained_model.vocab.numericalize(['public</t>', 'static</t>', 'void</t>'])],
+                         device=trained_model.device)
+    initial_snapshot = take_hidden_state_snapshot(model)
+
+    get_last_layer_activations(model, input)
+    expected = take_hidden_state_snapshot(model)
+    restore_snapshot(model, initial_snapshot)
+    feed_to_encoder(model, input)
+    actual = take_hidden_state_snapshot(model)
+
+    for expected_layer, actual_layer in zip(expected, actual):
+        for e, a in zip(expected_layer, actual_layer):
+            assert torch.equal(e, a)
+
+
+def test_target_losses_calculated_in_blocks_same_as_cross_entropy():
+    trained_model = load_from_path(os.path.join(project_dir, 'data/models/dev_10k_1_10_190923.132328'))
+    model = trained_model.model
+    tokens = trained_model.vocab.numericalize(['public</t>', 'static</t>', 'void</t>', 'main</t>', '(</t>'])
+    input = torch.tensor([tokens[:-1]], device=trained_model.device)
+    targets = torch.tensor([tokens[1:]], device=trained_model.device)
+    initial_snapshot = take_hidden_state_snapshot(model)
+
+    last_layer = get_last_layer_activations(model, input)
+    expected = F.cross_entropy(last_layer.view(-1, last_layer.shape[-1]), targets.view(-1), reduction='none')
+    restore_snapshot(model, initial_snapshot)
+    actual = get_target_losses(model, get_encoder_outputs(model, input), targets, block_size=3)
+
+    assert actual.shape == targets.shape
+    assert torch.allclose(expected, actual.view(-1), atol=1e-5)
@@ -0,0 +1,63 @@
+from concurrent.futures.thread import ThreadPoolExecutor
+from threading import Barrier
+
+from langmodels.prep_cache import PrepCache
+
+
+class CountingPrep(object):
+    def __init__(self, result):
+        self.result = result
+        self.n_calls = 0
+
+    def __call__(self):
+        self.n_calls += 1
+        return self.result
+
+
+def test_result_is_computed_once():
+    cache = PrepCache(max_entries_in_memory=10)
+    prep = CountingPrep((('int</t>', 'i</t>'), None))
+
+    assert cache.get_or_compute('key', prep) == (('int</t>', 'i</t>'), None)
+    assert cache.get_or_compute('key', prep) == (('int</t>', 'i</t>'), None)
+    assert prep.n_calls == 1
+    assert cache.statistics.n_memory_hits == 1
+
+
+def test_least_recently_used_entries_are_evicted_from_memory():
+    cache = PrepCache(max_entries_in_memory=2)
+    prep = CountingPrep((('a</t>',), None))
+    for key in ['1', '2', '1', '3', '1', '2']:
+        cache.get_or_compute(key, prep)
+
+    assert prep.n_calls == 4
+
+
+def test_entries_are_loaded_from_disk(tmp_path):
+    prep = CountingPrep((('int</t>', 'i</t>'), None))
+    PrepCache(path=str(tmp_path)).get_or_compute('key', prep)
+
+    cache = PrepCache(path=str(tmp_path))
+
+    assert cache.get_or_compute('key', prep) == (('int</t>', 'i</t>'), None)
+    assert prep.n_calls == 1
+    assert cache.statistics.n_disk_hits == 1
+
+
+def test_same_entry_computed_by_multiple_threads(tmp_path):
+    cache = PrepCache(max_entries_in_memory=0, path=str(tmp_path))
+    n_threads = 8
+    # all the threads compute and save the entry at the same time
+    barrier = Barrier(n_threads)
+    prep = CountingPrep(tuple(f'token{i}</t>' for i in range(100000)))
+
+    def compute():
+        barrier.wait()
+        return prep()
+
+    with ThreadPoolExecutor(n_threads) as executor:
+        results = list(executor.map(lambda _: cache.get_or_compute('key', compute), range(n_threads)))
+
+    assert results == [prep.result] * n_threads
+    assert cache.statistics.n_misses == n_threads
+    assert [path.name for path in tmp_path.glob('**/*') if path.is_file()] == ['key']
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+from fastai.text import Vocab
+
+from langmodels.training import data
+from langmodels.training.data import Numericalizer, create_databunch
+
+
+VOCAB = Vocab(['`unk', '`pad', '1', 'My', 'Class', 'hi'])
+
+
+def write_files(tmp_path, contents):
+    paths = []
+    for i, content in enumerate(contents):
+        path = tmp_path / f'file{i}'
+        path.write_text(content)
+        paths.append(path)
+    return paths
+
+
+@pytest.mark.parametrize('n_cpus', [1, 2])
+def test_files_numericalized_and_unks_counted(tmp_path, n_cpus):
+    paths = write_files(tmp_path, ['1\nMy Class\n', 'hi Bye\n1 Bye', 'Class'])
+    numericalizer = Numericalizer(VOCAB, n_cpus=n_cpus, allow_unks=True)
+
+    tokens, unks = numericalizer._process_in_parallel(paths)
+
+    assert [t.tolist() for t in tokens] == [[2, 3, 4], [5, 0, 2, 0], [4]]
+    assert dict(unks) == {'Bye': 2}
+
+
+def test_unknown_token_not_allowed(tmp_path):
+    paths = write_files(tmp_path, ['1 My\n', 'hi Bye'])
+
+    with pytest.raises(ValueError):
+        Numericalizer(VOCAB, n_cpus=1)._process_in_parallel(paths)
+
+
+def test_process_one_same_as_vocab_numericalize(tmp_path):
+    path, = write_files(tmp_path, ['My Class 1\nhi'])
+
+    tokens, unks = Numericalizer(VOCAB, n_cpus=1).process_one(path)
+
+    assert np.array_equal(tokens, VOCAB.numericalize(['My', 'Class', '1', 'hi']))
+    assert not unks
+
+
+@pytest.mark.parametrize('n_cpus', [1, 2])
+def test_batches_numericalized_by_one_pool_of_workers(tmp_path, monkeypatch, n_cpus):
+    paths = write_files(tmp_path, ['1\nMy Class\n', 'hi Bye\n1 Bye', 'Class', 'My', 'hi hi'])
+    n_pools = []
+
+    class CountingProcessPoolExecutor(data.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            n_pools.append(self)
+
+    monkeypatch.setattr(data, 'ProcessPoolExecutor', CountingProcessPoolExecutor)
+    numericalizer = Numericalizer(VOCAB, n_cpus=n_cpus, allow_unks=True)
+
+    batches = list(numericalizer.iter_numericalized_files(paths, n_files_per_batch=2))
+
+    assert [[t.tolist() for t in tokens] for tokens, _ in batches] == [[[2, 3, 4], [5, 0, 2, 0]], [[4], [3]], [[5, 5]]]
+    assert [[dict(file_unks) for file_unks in unks] for _, unks in batches] == [[{}, {'Bye': 2}], [{}, {}], [{}]]
+    assert len(n_pools) == (1 if n_cpus > 1 else 0)
+
+
+def test_databunch_with_given_validation_data_loader_uses_all_files_for_training(tmp_path):
+    for subdir, content in [('train', '1 My Class hi'), ('valid', 'My Class 1')]:
+        (tmp_path / subdir).mkdir()
+        write_files(tmp_path / subdir, [content] * 2)
+    train_files = sorted((tmp_path / 'train').iterdir())
+    valid_files = sorted((tmp_path / 'valid').iterdir())
+    databunch = create_databunch(str(tmp_path), train_files + valid_files, VOCAB, bs=1, bptt=2, device='cpu',
+                                 verbose=False)
+
+    next_databunch = create_databunch(str(tmp_path), train_files, VOCAB, bs=1, bptt=2, device='cpu',
+                                      verbose=False, valid_dl=databunch.valid_dl)
+
+    assert len(databunch.train_ds) == len(databunch.valid_ds) == 2
+    assert len(next_databunch.train_ds) == 2
+    assert next_databunch.valid_dl is databunch.valid_dl
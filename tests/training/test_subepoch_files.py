@@ -0,0 +1,163 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from langmodels.training import subepoch_files
+from langmodels.training.subepoch_files import EpochFileLoader
+
+
+class FakeLearner(object):
+    pass
+
+
+class FakeDataBunch(object):
+    def __init__(self, files, valid_dl):
+        self.files = files
+        self.valid_dl = valid_dl if valid_dl is not None else object()
+        self.train_dl = None
+
+
+@pytest.fixture
+def prep_dataset(tmp_path):
+    for subdir, name in [('train/project0', 'file0'), ('train/project0', 'file1'), ('train/project1', 'file2'),
+                         ('valid', 'file3'), ('test', 'file4')]:
+        (tmp_path / subdir).mkdir(parents=True, exist_ok=True)
+        (tmp_path / subdir / name).write_text('1 My Class')
+    return tmp_path
+
+
+@pytest.fixture
+def created_databunches(monkeypatch):
+    created_databunches = []
+
+    def create_databunch(path_to_prep_dataset, file_paths, vocab, valid_dl=None, **kwargs):
+        created_databunches.append(FakeDataBunch(file_paths, valid_dl))
+        return created_databunches[-1]
+
+    monkeypatch.setattr(subepoch_files, 'create_databunch', create_databunch)
+    monkeypatch.setattr(subepoch_files, 'check_data', lambda *args, **kwargs: None)
+    return created_databunches
+
+
+def create_loader(learner, prep_dataset, n_files_per_epoch=2, **kwargs) -> EpochFileLoader:
+    return EpochFileLoader(learner, SimpleNamespace(path_to_prep_dataset=str(prep_dataset)), vocab=None,
+                           bs=2, bptt=3, device='cpu', n_files_per_epoch=n_files_per_epoch, allow_unks=False,
+                           **kwargs)
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def get_prefetching_threads():
+    return [thread for thread in threading.enumerate() if thread.name == 'EpochFileLoader']
+
+
+@pytest.mark.parametrize('token_store', [None, object()])
+def test_validation_data_loader_created_once(prep_dataset, created_databunches, token_store):
+    learner = FakeLearner()
+    loader = create_loader(learner, prep_dataset, token_store=token_store)
+
+    loader.on_train_begin()
+    used_databunches = []
+    for epoch in range(4):
+        loader.on_epoch_begin(epoch=epoch)
+        used_databunches.append(learner.data)
+    loader.on_train_end()
+
+    first_files = {file.relative_to(prep_dataset).parts[0] for file in used_databunches[0].files}
+    assert first_files == {'train', 'valid', 'test'}
+    for databunch in used_databunches[1:]:
+        assert all(file.relative_to(prep_dataset).parts[0] == 'train' for file in databunch.files)
+        assert databunch.valid_dl is used_databunches[0].valid_dl
+
+
+@pytest.mark.parametrize('n_prefetched_epochs', [1, 2])
+def test_number_of_prefetched_databunches_is_bounded(prep_dataset, created_databunches, n_prefetched_epochs):
+    learner = FakeLearner()
+    loader = create_loader(learner, prep_dataset, token_store=object(), n_prefetched_epochs=n_prefetched_epochs)
+
+    loader.on_train_begin()
+    # the ones in the queue and the one waiting for a free place in it
+    wait_until(lambda: len(created_databunches) == n_prefetched_epochs + 1)
+    time.sleep(0.1)
+
+    assert len(created_databunches) == n_prefetched_epochs + 1
+    loader.on_epoch_begin(epoch=0)
+    assert learner.data is created_databunches[0]
+    wait_until(lambda: len(created_databunches) == n_prefetched_epochs + 2)
+    assert len(created_databunches) == n_prefetched_epochs + 2
+    loader.on_train_end()
+
+
+def test_error_while_prefetching_raised_when_epoch_begins(prep_dataset, created_databunches, monkeypatch):
+    def check_data(databunch, *args, **kwargs):
+        if len(created_databunches) == 2:
+            raise ValueError('Unknown is found')
+
+    monkeypatch.setattr(subepoch_files, 'check_data', check_data)
+    learner = FakeLearner()
+    loader = create_loader(learner, prep_dataset, token_store=object())
+
+    loader.on_train_begin()
+    loader.on_epoch_begin(epoch=0)
+    with pytest.raises(ValueError, match='Unknown is found'):
+        loader.on_epoch_begin(epoch=1)
+    loader.on_train_end()
+
+
+def test_prefetching_stopped_and_restarted_with_training(prep_dataset, created_databunches):
+    learner = FakeLearner()
+    loader = create_loader(learner, prep_dataset, token_store=object())
+
+    for _ in range(2):
+        loader.on_train_begin()
+        loader.on_epoch_begin(epoch=0)
+        assert learner.data is not None
+        loader.on_train_end()
+
+    for thread in get_prefetching_threads():
+        thread.join(timeout=5.0)
+        assert not thread.is_alive()
+
+
+def test_training_end_does_not_wait_for_databunch_being_built(prep_dataset, created_databunches, monkeypatch):
+    def check_data(databunch, *args, **kwargs):
+        if len(created_databunches) > 1:
+            time.sleep(1.0)
+
+    monkeypatch.setattr(subepoch_files, 'check_data', check_data)
+    learner = FakeLearner()
+    loader = create_loader(learner, prep_dataset, token_store=object())
+    loader.on_train_begin()
+    loader.on_epoch_begin(epoch=0)
+
+    start_time = time.perf_counter()
+    loader.on_train_end()
+
+    assert time.perf_counter() - start_time < 0.5
+
+
+def test_prefetched_training_files_used_in_next_training(prep_dataset, created_databunches, monkeypatch):
+    monkeypatch.setattr(subepoch_files, 'PREFETCHING_POLL_INTERVAL_SECONDS', 0.01)
+    learner = FakeLearner()
+    loader = create_loader(learner, prep_dataset, n_files_per_epoch=1, token_store=object())
+    trained_files = []
+
+    for n_epochs in [1, 2]:
+        loader.on_train_begin()
+        for epoch in range(n_epochs):
+            loader.on_epoch_begin(epoch=epoch)
+            trained_files.extend(file for file in learner.data.files
+                                 if file.relative_to(prep_dataset).parts[0] == 'train')
+        # the ones in the queue and the one waiting for a free place in it
+        wait_until(lambda: len(created_databunches) == len(trained_files) + 2)
+        loader.on_train_end()
+        for thread in get_prefetching_threads():
+            thread.join(timeout=5.0)
+
+    assert sorted(trained_files) == sorted((prep_dataset / 'train').glob('*/*'))
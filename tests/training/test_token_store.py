@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+import pytest
+from fastai.text import Vocab
+
+from langmodels.training.data import Numericalizer
+from langmodels.training.token_store import load_or_build_token_store, get_token_store_path, TOKENS_FILE_NAME
+
+
+VOCAB = Vocab(['`unk', '`pad', '1', 'My', 'Class', 'hi'])
+
+
+@pytest.fixture
+def prep_dataset(tmp_path):
+    path = tmp_path / 'prep_dataset'
+    for subdir, name, content in [('train', 'file0', '1\nMy Class\n'), ('train', 'file1', 'hi 1'),
+                                  ('valid', 'file2', 'Class Bye')]:
+        (path / subdir).mkdir(parents=True, exist_ok=True)
+        (path / subdir / name).write_text(content)
+    return path
+
+
+def test_token_store_same_as_numericalized_files(prep_dataset):
+    token_store = load_or_build_token_store(str(prep_dataset), VOCAB, allow_unks=True)
+
+    numericalizer = Numericalizer(VOCAB, n_cpus=1, allow_unks=True)
+    for file in ['train/file0', 'train/file1', 'valid/file2']:
+        expected, _ = numericalizer.process_one(prep_dataset / file)
+        actual = token_store.get_tokens(prep_dataset / file)
+        assert isinstance(actual, np.memmap)
+        assert actual.dtype == np.uint16
+        assert np.array_equal(expected, actual)
+    assert dict(token_store.unks) == {'Bye': 1}
+
+
+def test_only_new_and_changed_files_numericalized(prep_dataset):
+    load_or_build_token_store(str(prep_dataset), VOCAB, allow_unks=True)
+    (prep_dataset / 'train' / 'file0').write_text('hi hi hi')
+    (prep_dataset / 'train' / 'file3').write_text('My')
+    (prep_dataset / 'train' / 'file1').unlink()
+
+    token_store = load_or_build_token_store(str(prep_dataset), VOCAB, allow_unks=True)
+
+    assert (token_store.statistics.n_hits, token_store.statistics.n_misses, token_store.statistics.n_removed) == \
+        (1, 2, 1)
+    assert token_store.get_tokens(prep_dataset / 'train' / 'file0').tolist() == [5, 5, 5]
+    assert token_store.get_tokens(prep_dataset / 'train' / 'file3').tolist() == [3]
+    assert token_store.get_tokens(prep_dataset / 'valid' / 'file2').tolist() == [4, 0]
+    assert prep_dataset / 'train' / 'file1' not in token_store
+    assert token_store.path == get_token_store_path(str(prep_dataset), VOCAB)
+
+    token_store = load_or_build_token_store(str(prep_dataset), VOCAB, allow_unks=True)
+
+    assert (token_store.statistics.n_hits, token_store.statistics.n_misses) == (3, 0)
+
+
+def test_token_store_with_unks_not_loaded_if_unks_not_allowed(prep_dataset):
+    load_or_build_token_store(str(prep_dataset), VOCAB, allow_unks=True)
+
+    with pytest.raises(ValueError):
+        load_or_build_token_store(str(prep_dataset), VOCAB, allow_unks=False)
+
+
+def test_databunch_items_are_read_from_token_store(prep_dataset):
+    token_store = load_or_build_token_store(str(prep_dataset), VOCAB, allow_unks=True)
+    numericalizer = Numericalizer(VOCAB, n_cpus=1, token_store=token_store)
+
+    class Dataset(object):
+        items = [prep_dataset / 'train' / 'file0', prep_dataset / 'train' / 'file1']
+    numericalizer.process(Dataset)
+
+    assert [items.tolist() for items in Dataset.items] == [[2, 3, 4], [5, 2]]
+
+
+def test_new_files_not_misaligned_after_interrupted_write(prep_dataset):
+    token_store = load_or_build_token_store(str(prep_dataset), VOCAB, allow_unks=True)
+    with open(os.path.join(token_store.path, TOKENS_FILE_NAME), 'ab') as f:
+        f.write(b'\x05')
+    (prep_dataset / 'train' / 'file3').write_text('My hi')
+
+    token_store = load_or_build_token_store(str(prep_dataset), VOCAB, allow_unks=True)
+
+    assert token_store.get_tokens(prep_dataset / 'train' / 'file3').tolist() == [3, 5]
+    assert token_store.get_tokens(prep_dataset / 'train' / 'file0').tolist() == [2, 3, 4]